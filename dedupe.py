@@ -0,0 +1,135 @@
+import re
+from collections import deque
+
+
+FINGERPRINT_BITS = 64
+FINGERPRINT_MASK = (1 << FINGERPRINT_BITS) - 1
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+NUMBER_PATTERN = re.compile(r'\d+')
+
+
+def approximate_tokens(text):
+    """Rough LLM token count for text, at about four UTF-8 bytes per token."""
+    return max(1, (len(text.encode('utf-8')) + 3) // 4)
+
+
+def simhash(text, shingle_size=1):
+    """
+    Return the 64-bit SimHash fingerprint of a message.
+
+    The fingerprint is built from word shingles of the lowercased text with every number replaced by 0,
+    so messages that differ by a few words or amounts end up only a few bits apart.
+
+    Parameters:
+    - text (str): The message text.
+    - shingle_size (int): Words per shingle. Single words suit short chat messages best.
+    """
+    tokens = TOKEN_PATTERN.findall(NUMBER_PATTERN.sub('0', text.lower()))
+    if len(tokens) > shingle_size:
+        features = [' '.join(tokens[i:i + shingle_size]) for i in range(len(tokens) - shingle_size + 1)]
+    else:
+        features = tokens or [text]
+
+    # Each fingerprint bit is set when most feature hashes have it set (counted column-wise over bit strings)
+    rows = [format(hash(feature) & FINGERPRINT_MASK, '064b') for feature in features]
+    bits = ''.join('1' if ''.join(column).count('1') * 2 > len(rows) else '0' for column in zip(*rows))
+    return int(bits, 2)
+
+
+class NearDuplicateFilter:
+    """
+    Streaming near-duplicate detector for the filtered message log.
+
+    Fingerprints of the last `window` kept messages are indexed by band: the 64 bits are split into
+    threshold + 1 bands, so any fingerprint within `threshold` bits of a kept one shares at least one
+    band with it and only those candidates are compared. Memory is bounded by the window size.
+    Messages shorter than min_chars carry too few words for a meaningful fingerprint and are only
+    matched when identical.
+
+    Parameters:
+    - threshold (int): Maximum number of differing fingerprint bits for two messages to count as duplicates.
+    - window (int): Number of recent kept messages a new message is compared against.
+    - min_chars (int): Messages shorter than this are only collapsed into an identical earlier message.
+    - count_tokens (callable): Returns the token count of a text, used to report tokens saved.
+    """
+
+    def __init__(self, threshold=6, window=1000, min_chars=20, count_tokens=approximate_tokens):
+        self.threshold = threshold
+        self.window = window
+        self.min_chars = min_chars
+        self.count_tokens = count_tokens
+        self.band_bits = FINGERPRINT_BITS // (threshold + 1)
+        self.reset()
+
+    def _bands(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        return [(band, fingerprint >> (band * self.band_bits) & mask) for band in range(self.threshold + 1)]
+
+    def reset(self):
+        """
+        Forget every kept message, e.g. at a day boundary.
+
+        Returns:
+        - dict: Stats since the last reset: 'duplicates', 'bytes_saved' and 'tokens_saved'.
+        """
+        stats = getattr(self, 'stats', None)
+        self._recent = deque()
+        self._exact = {}
+        self._index = {}
+        self.stats = {'duplicates': 0, 'bytes_saved': 0, 'tokens_saved': 0}
+        return stats
+
+    def check(self, text, entry_id, size=None):
+        """
+        Check a message against the recent kept messages.
+
+        A new message is remembered under entry_id. A duplicate is counted in the stats and not remembered.
+
+        Parameters:
+        - text (str): The message text.
+        - entry_id: Identifier of the message, returned when later messages duplicate it.
+        - size (int): Bytes the message would take in the filtered log (defaults to its UTF-8 length).
+
+        Returns:
+        - The entry_id of the earlier message this one duplicates, or None if it is new.
+        """
+        duplicate_of = self._exact.get(text)
+        fingerprint = None
+
+        if duplicate_of is None and len(text) >= self.min_chars:
+            fingerprint = simhash(text)
+            for key in self._bands(fingerprint):
+                for candidate_fingerprint, candidate_id in self._index.get(key, ()):
+                    if bin(fingerprint ^ candidate_fingerprint).count('1') <= self.threshold:
+                        duplicate_of = candidate_id
+                        break
+                if duplicate_of is not None:
+                    break
+
+        if duplicate_of is not None:
+            self.stats['duplicates'] += 1
+            self.stats['bytes_saved'] += size if size is not None else len(text.encode('utf-8'))
+            self.stats['tokens_saved'] += self.count_tokens(text)
+            return duplicate_of
+
+        self._remember(text, fingerprint, entry_id)
+        return None
+
+    def _remember(self, text, fingerprint, entry_id):
+        self._recent.append((text, fingerprint, entry_id))
+        self._exact[text] = entry_id
+        if fingerprint is not None:
+            for key in self._bands(fingerprint):
+                self._index.setdefault(key, []).append((fingerprint, entry_id))
+
+        # Drop the oldest message once the window is full
+        if len(self._recent) > self.window:
+            old_text, old_fingerprint, old_id = self._recent.popleft()
+            if self._exact.get(old_text) == old_id:
+                del self._exact[old_text]
+            if old_fingerprint is not None:
+                for key in self._bands(old_fingerprint):
+                    bucket = self._index[key]
+                    bucket.remove((old_fingerprint, old_id))
+                    if not bucket:
+                        del self._index[key]
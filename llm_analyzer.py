@@ -0,0 +1,116 @@
+import json
+import threading
+
+import tiktoken
+
+from llm_payload import format_discussion, RECORD_SEPARATOR
+from prompt import ChatLogAnalysisResponse, PackedChatLogAnalysisResponse, PACKED_PROMPT
+
+
+ANALYSIS_PROMPT_PATH = 'prompt.ini'
+SPAM_PROMPT_PATH = 'prompt_spam.ini'
+
+
+def strict_schema(schema, defs=None):
+    """
+    Return a pydantic JSON schema in the form structured outputs' strict mode accepts: every object closed
+    to additional properties with all of its properties required, and every $ref that has sibling keys
+    (like a field description) replaced by the definition it points to.
+    """
+    if defs is None:
+        defs = schema.get('$defs', {})
+    if isinstance(schema, list):
+        return [strict_schema(item, defs) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    if '$ref' in schema and len(schema) > 1:
+        schema = {**defs[schema['$ref'].split('/')[-1]], **{key: value for key, value in schema.items() if key != '$ref'}}
+    schema = {key: strict_schema(value, defs) for key, value in schema.items()}
+    if schema.get('type') == 'object' and 'properties' in schema:
+        schema['additionalProperties'] = False
+        schema['required'] = list(schema['properties'])
+    return schema
+
+
+def response_format(model):
+    """Return the strict 'json_schema' response_format for a pydantic model, as sent to the chat completions API."""
+    return {'type': 'json_schema',
+            'json_schema': {'name': model.__name__, 'schema': strict_schema(model.model_json_schema()), 'strict': True}}
+
+
+def read_prompt(path):
+    """Return the text of a prompt file."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+class ChatLogAnalyzer:
+    """
+    Everything the LLM analysis needs that doesn't change from one day to the next, loaded once per process.
+
+    Holds the analysis and spam prompts, the compiled ChatLogAnalysisResponse response format and schema
+    (and their PackedChatLogAnalysisResponse counterparts for packed requests), the model's tokenizer and
+    the OpenAI clients (with the SDK's own retries off, as the LLM scheduler retries). Every date and
+    project of a run shares one analyzer, so a day only costs its own request.
+
+    Parameters:
+    - model (str): The OpenAI model to use.
+    - client (OpenAI): Client for synchronous requests.
+    - async_client (AsyncOpenAI): Client for concurrent requests.
+    - prompt_path (str): The analysis system prompt.
+    - spam_prompt_path (str): The spam check prompt, with a '{message_log}' placeholder.
+    """
+
+    def __init__(self, model, client=None, async_client=None, prompt_path=ANALYSIS_PROMPT_PATH,
+                 spam_prompt_path=SPAM_PROMPT_PATH):
+        self.model = model
+        # NOTE: the meat of the prompt is contained in the structured output prompt.py document
+        self.prompt = read_prompt(prompt_path)
+        print(f"Loaded {prompt_path} successfully.")
+        try:
+            self.spam_prompt = read_prompt(spam_prompt_path)
+        except OSError as e:
+            print(f"Error loading '{spam_prompt_path}': {e}")
+            self.spam_prompt = None
+
+        self.response_format = response_format(ChatLogAnalysisResponse)
+        # Part of the LLM cache key, so schema changes miss the cache
+        self.schema = json.dumps(ChatLogAnalysisResponse.model_json_schema(), sort_keys=True)
+
+        # The same for requests that analyse several small days at once
+        self.packed_prompt = self.prompt + PACKED_PROMPT
+        self.packed_response_format = response_format(PackedChatLogAnalysisResponse)
+        self.packed_schema = json.dumps(PackedChatLogAnalysisResponse.model_json_schema(), sort_keys=True)
+
+        try:
+            self.encoding = tiktoken.encoding_for_model(model)
+        except Exception as e:
+            print(f"Error getting encoding for model '{model}': {e}")
+            self.encoding = None
+
+        self.client = client.with_options(max_retries=0) if client is not None else None
+        self.async_client = async_client.with_options(max_retries=0) if async_client is not None else None
+
+    def token_counts(self, discussions):
+        """
+        Count the payload tokens of each discussion with the model's tokenizer, encoding each message once.
+
+        Returns:
+        - list: Token count of each discussion (see discussion_tokens()), or None if the encoding is unavailable.
+        """
+        if self.encoding is None:
+            return None
+        return [len(tokens) for tokens in self.encoding.encode_ordinary_batch(
+            [format_discussion(d) + RECORD_SEPARATOR for d in discussions])]
+
+
+_analyzers = {}
+_analyzers_lock = threading.Lock()
+
+def get_chat_log_analyzer(model, client=None, async_client=None):
+    """Return the process-wide analyzer for a model, creating it with the given clients on first use."""
+    # Days are prepared in worker threads, so the first ones of a run must not each build an analyzer
+    with _analyzers_lock:
+        if model not in _analyzers:
+            _analyzers[model] = ChatLogAnalyzer(model, client, async_client)
+        return _analyzers[model]
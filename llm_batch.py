@@ -0,0 +1,251 @@
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+
+from tg_store import write_json_atomic
+
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+BATCH_DIR = os.path.join('tg', 'batches')
+BATCH_DONE_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+BATCH_PRICE_DISCOUNT = 0.5  # Batch API requests cost half the interactive price
+
+
+def batch_request(custom_id, model, messages, response_format):
+    """Return one request line of a Batch API input file."""
+    return {
+        'custom_id': custom_id,
+        'method': 'POST',
+        'url': BATCH_ENDPOINT,
+        'body': {'model': model, 'messages': messages, 'response_format': response_format}
+    }
+
+
+def write_batch_file(path, requests):
+    """Write batch request lines to a JSONL file atomically."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for request in requests:
+            f.write(json.dumps(request, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+
+
+def parse_batch_results(text):
+    """
+    Parse a Batch API output (or error) file.
+
+    Returns:
+    - dict: {custom_id: (content, error, usage)}, where content is the assistant message text of a successful
+      request, error a description of why the request failed (the other one is None) and usage the
+      request's token usage dict, if any.
+    """
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get('response') or {}
+        body = response.get('body') or {}
+        if record.get('error') or response.get('status_code') != 200:
+            error = record.get('error') or body.get('error') or f"status {response.get('status_code')}"
+            results[record['custom_id']] = (None, json.dumps(error) if not isinstance(error, str) else error, None)
+        else:
+            results[record['custom_id']] = (body['choices'][0]['message']['content'], None, body.get('usage'))
+    return results
+
+
+def batch_state_path(batch_id):
+    """Path of the local record of a submitted batch and its jobs."""
+    return os.path.join(BATCH_DIR, f"{batch_id}.json")
+
+
+def save_batch_state(batch_id, state):
+    """Save the local record of a submitted batch."""
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    write_json_atomic(batch_state_path(batch_id), state)
+
+
+def load_batch_state(batch_id):
+    """Load the local record of a submitted batch."""
+    with open(batch_state_path(batch_id), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class OpenAIBatchBackend:
+    """
+    Submits batch files to the OpenAI Batch API.
+
+    Parameters:
+    - client (OpenAI): The OpenAI client to use.
+    - completion_window (str): Time the API has to finish the batch.
+    """
+
+    def __init__(self, client, completion_window='24h'):
+        self.client = client
+        self.completion_window = completion_window
+
+    def submit(self, path, description=None):
+        """Upload a batch input file and start the batch. Returns the batch id."""
+        with open(path, 'rb') as f:
+            batch_file = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=self.completion_window,
+            metadata={'description': description} if description else None
+        )
+        return batch.id
+
+    def status(self, batch_id):
+        """Return the status of a batch ('validating', 'in_progress', ..., 'completed')."""
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id):
+        """Return the text of the batch's output and error files."""
+        batch = self.client.batches.retrieve(batch_id)
+        text = ''
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                text += self.client.files.content(file_id).text + '\n'
+        return text
+
+
+def schema_placeholder(schema, defs=None):
+    """Return the smallest value that satisfies a JSON schema: empty strings, zeros and nulls where allowed."""
+    if defs is None:
+        defs = schema.get('$defs', {})
+    if '$ref' in schema:
+        return schema_placeholder(defs[schema['$ref'].split('/')[-1]], defs)
+    if 'anyOf' in schema:
+        options = schema['anyOf']
+        if any(option.get('type') == 'null' for option in options):
+            return None
+        return schema_placeholder(options[0], defs)
+
+    schema_type = schema.get('type')
+    if isinstance(schema_type, list):
+        if 'null' in schema_type:
+            return None
+        schema_type = schema_type[0]
+
+    if schema_type == 'object':
+        return {name: schema_placeholder(prop, defs) for name, prop in schema.get('properties', {}).items()}
+    if schema_type == 'array':
+        return []
+    if schema_type == 'string':
+        return ''
+    if schema_type in ('integer', 'number'):
+        return 0
+    if schema_type == 'boolean':
+        return False
+    return None
+
+
+def placeholder_response(body):
+    """Answer a chat completion request body with an empty response that matches its response schema."""
+    response_format = body.get('response_format') or {}
+    schema = (response_format.get('json_schema') or {}).get('schema')
+    return json.dumps(schema_placeholder(schema) if schema else {})
+
+
+class LocalBatchBackend:
+    """
+    Local stand-in for the Batch API, so the batch flow can run without network access.
+
+    Batches are kept under `directory`. A batch stays 'in_progress' for `polls` status checks, then
+    every request is answered by `respond` and the batch is 'completed'.
+
+    Parameters:
+    - directory (str): Where the stand-in keeps its batches.
+    - respond (callable): Called with each request body, returns the assistant message text or raises
+      to fail that request. Defaults to placeholder_response().
+    - polls (int): Status checks before a batch completes.
+    """
+
+    def __init__(self, directory=os.path.join(BATCH_DIR, 'local'), respond=None, polls=1):
+        self.directory = directory
+        self.respond = respond or placeholder_response
+        self.polls = polls
+
+    def _path(self, batch_id, suffix):
+        return os.path.join(self.directory, f"{batch_id}_{suffix}")
+
+    def submit(self, path, description=None):
+        """Copy a batch input file into the stand-in. Returns the batch id."""
+        batch_id = f"local_batch_{uuid.uuid4().hex[:12]}"
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.read()
+        with open(self._path(batch_id, 'input.jsonl'), 'w', encoding='utf-8') as f:
+            f.write(lines)
+        write_json_atomic(self._path(batch_id, 'status.json'),
+                          {'status': 'in_progress', 'polls_left': self.polls, 'description': description})
+        return batch_id
+
+    def status(self, batch_id):
+        """Return the status of a batch, answering its requests once its polls are used up."""
+        status_path = self._path(batch_id, 'status.json')
+        with open(status_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state['status'] == 'in_progress':
+            state['polls_left'] -= 1
+            if state['polls_left'] <= 0:
+                self._run(batch_id)
+                state['status'] = 'completed'
+            write_json_atomic(status_path, state)
+        return state['status']
+
+    def _run(self, batch_id):
+        records = []
+        with open(self._path(batch_id, 'input.jsonl'), 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                record = {'id': f"batch_req_{uuid.uuid4().hex[:12]}", 'custom_id': request['custom_id'],
+                          'response': None, 'error': None}
+                try:
+                    content = self.respond(request['body'])
+                    record['response'] = {'status_code': 200, 'body': {
+                        'model': request['body'].get('model'),
+                        'usage': {'prompt_tokens': sum(len(m['content']) // 4 for m in request['body']['messages']),
+                                  'completion_tokens': len(content) // 4},
+                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                                     'finish_reason': 'stop'}]
+                    }}
+                except Exception as e:
+                    record['error'] = {'code': 'stand_in_error', 'message': str(e)}
+                records.append(record)
+        write_batch_file(self._path(batch_id, 'output.jsonl'), records)
+
+    def results(self, batch_id):
+        """Return the text of the batch's output file."""
+        with open(self._path(batch_id, 'output.jsonl'), 'r', encoding='utf-8') as f:
+            return f.read()
+
+
+def wait_for_batch(backend, batch_id, poll_interval=60, timeout=None):
+    """
+    Poll a batch until it is done.
+
+    Parameters:
+    - backend: OpenAIBatchBackend or LocalBatchBackend.
+    - batch_id (str): The batch to wait for.
+    - poll_interval (float): Seconds between status checks.
+    - timeout (float): Give up after this many seconds (None waits as long as the batch takes).
+
+    Returns:
+    - str: The final status, or the current one if the timeout was reached.
+    """
+    started = time.monotonic()
+    while True:
+        status = backend.status(batch_id)
+        print(f"{datetime.now():%Y-%m-%d %H:%M:%S} Batch {batch_id}: {status}")
+        if status in BATCH_DONE_STATUSES:
+            return status
+        if timeout is not None and time.monotonic() - started + poll_interval > timeout:
+            return status
+        time.sleep(poll_interval)
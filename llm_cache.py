@@ -0,0 +1,113 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+
+CACHE_PATH = os.path.join('tg', 'llm_cache.sqlite')
+MAX_CACHE_BYTES = 256 * 1024 * 1024  # Responses are a few KB each, so this holds well over 50k analyses
+
+
+class LLMResponseCache:
+    """
+    Content-addressed cache of LLM responses, kept in a SQLite file.
+
+    A response is stored under the hash of everything that determines it: the model, the system prompt,
+    the response schema and the chat log sent. Re-running an analysis over unchanged inputs is answered
+    from the cache, while any change to the prompt text, the schema or the messages gives a new key.
+    When the stored responses exceed max_bytes, the least recently used ones are evicted.
+
+    Parameters:
+    - path (str): Location of the SQLite cache file.
+    - max_bytes (int): Maximum total size of the cached responses.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, response TEXT, bytes INTEGER, created_at REAL, used_at REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)")
+        self._db.commit()
+
+    @staticmethod
+    def key(model, prompt, schema, payload):
+        """Return the cache key of a request: the sha256 of its model, prompt, schema and payload."""
+        digest = hashlib.sha256()
+        for part in (model, prompt, schema, payload):
+            data = (part or '').encode('utf-8')
+            # Length-prefix each part so different splits of the same text never collide
+            digest.update(len(data).to_bytes(8, 'big'))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached response for a key, or None on a miss."""
+        row = self._db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._db.execute("UPDATE responses SET used_at = ? WHERE key = ?", (time.time(), key))
+        self._db.commit()
+        return row[0]
+
+    def put(self, key, response):
+        """Store a response, evicting the least recently used ones if the cache grows past max_bytes."""
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses (key, response, bytes, created_at, used_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key, response, len(response.encode('utf-8')), now, now)
+        )
+        self._evict()
+        self._db.commit()
+
+    def _evict(self):
+        total = self.size()
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, bytes FROM responses ORDER BY used_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+
+    def size(self):
+        """Return the total size of the cached responses in bytes."""
+        return self._db.execute("SELECT COALESCE(SUM(bytes), 0) FROM responses").fetchone()[0]
+
+    def stats(self):
+        """Return hit/miss counters and the cache size for reporting."""
+        total = self.hits + self.misses
+        entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': self.size()
+        }
+
+
+_cache = None
+
+def get_llm_cache(path=CACHE_PATH):
+    """Return the process-wide LLM response cache, opening the given file on first use."""
+    global _cache
+    if _cache is None:
+        _cache = LLMResponseCache(path)
+    return _cache
@@ -0,0 +1,259 @@
+import json
+import math
+import os
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+
+LEDGER_PATH = os.path.join('tg', 'llm_ledger.jsonl')
+
+# USD per million tokens: (input, cached input, output). Longest matching model prefix wins.
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.150, 0.075, 0.600),
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4-turbo': (10.00, 10.00, 30.00),
+    'gpt-3.5-turbo': (0.50, 0.50, 1.50),
+    'o1-mini': (3.00, 1.50, 12.00),
+    'o1': (15.00, 7.50, 60.00)
+}
+
+
+def model_prices(model):
+    """Return the (input, cached input, output) prices of a model, or None if it isn't in MODEL_PRICES."""
+    matches = [name for name in MODEL_PRICES if model and model.startswith(name)]
+    return MODEL_PRICES[max(matches, key=len)] if matches else None
+
+
+def request_cost(model, prompt_tokens, completion_tokens, cached_tokens=0, discount=1.0):
+    """
+    Return the USD cost of a request, or None for a model without a known price.
+
+    Parameters:
+    - discount (float): Price multiplier, e.g. 0.5 for Batch API requests.
+    """
+    prices = model_prices(model)
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    cost = ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+            + completion_tokens * output_price) / 1e6
+    return round(cost * discount, 8)
+
+
+def usage_tokens(usage):
+    """Return (prompt, completion, cached) token counts from an OpenAI usage object or dict."""
+    if usage is None:
+        return 0, 0, 0
+    if isinstance(usage, dict):
+        details = usage.get('prompt_tokens_details') or {}
+        return usage.get('prompt_tokens') or 0, usage.get('completion_tokens') or 0, details.get('cached_tokens') or 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return (getattr(usage, 'prompt_tokens', 0) or 0, getattr(usage, 'completion_tokens', 0) or 0,
+            getattr(details, 'cached_tokens', 0) or 0)
+
+
+def split_tokens(tokens, weights):
+    """Split a token count in proportion to weights, as whole numbers that add up to it (largest remainder first)."""
+    total = sum(weights)
+    exact = [tokens * weight / total for weight in weights]
+    shares = [int(share) for share in exact]
+    by_remainder = sorted(range(len(weights)), key=lambda i: exact[i] - shares[i], reverse=True)
+    for i in by_remainder[:tokens - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+
+class LLMLedger:
+    """
+    Append-only JSONL ledger with one record per LLM request: what it was for, its tokens, latency,
+    retries and cost.
+
+    Parameters:
+    - path (str): Location of the ledger file.
+    """
+
+    def __init__(self, path=LEDGER_PATH):
+        self.path = path
+
+    def record(self, kind, model, usage=None, latency=0.0, retries=0, status='ok', project=None, date=None,
+               prompt_version=None, discount=1.0):
+        """
+        Append one request to the ledger.
+
+        Parameters:
+        - kind (str): What the request was, e.g. 'chat_log' or 'spam_check'.
+        - model (str): The model used.
+        - usage: The response's usage (object or dict), None for failed requests.
+        - latency (float): Seconds the request's final attempt took (None for Batch API requests).
+        - retries (int): Retries before the request succeeded or was given up.
+        - status (str): 'ok' or 'failed'.
+        - project (str): Project/group the request was for.
+        - date (str): Day the request was for, 'YYYY-MM-DD'.
+        - prompt_version (str): Version of the prompt in prompt.py.
+        - discount (float): Price multiplier, e.g. 0.5 for Batch API requests.
+
+        Returns:
+        - dict: The record written.
+        """
+        prompt_tokens, completion_tokens, cached_tokens = usage_tokens(usage)
+        return self._write(kind, model, prompt_tokens, completion_tokens, cached_tokens, latency, retries, status,
+                           project, date, prompt_version, discount)
+
+    def record_split(self, kind, model, usage=None, latency=0.0, retries=0, status='ok', days=(),
+                     prompt_version=None, discount=1.0):
+        """
+        Append one request made for several days, e.g. a packed analysis, as one record per day.
+
+        The request's tokens (and so its cost) are split across the days in proportion to their weights,
+        keeping the totals exact. Each record is marked with its 'part' and the number of 'parts', so the
+        summary counts the request, its latency and retries once.
+
+        Parameters:
+        - days (list): (project, date, weight) of each day, weighted e.g. by its payload tokens.
+        - The others as for record().
+
+        Returns:
+        - list: The records written.
+        """
+        days = list(days)
+        total = usage_tokens(usage)
+        weights = [max(weight or 0, 0) for _, _, weight in days]
+        if not sum(weights):
+            weights = [1] * len(days)
+        shares = [split_tokens(tokens, weights) for tokens in total]
+        return [self._write(kind, model, *(share[i] for share in shares), latency, retries, status, project, date,
+                            prompt_version, discount, part=(i, len(days)))
+                for i, (project, date, _) in enumerate(days)]
+
+    def _write(self, kind, model, prompt_tokens, completion_tokens, cached_tokens, latency, retries, status,
+               project, date, prompt_version, discount, part=None):
+        entry = {
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'kind': kind,
+            'project': project,
+            'date': date,
+            'model': model,
+            'prompt_version': prompt_version,
+            'status': status,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'cached_tokens': cached_tokens,
+            'latency': round(latency, 3) if latency is not None else None,
+            'retries': retries,
+            'cost': request_cost(model, prompt_tokens, completion_tokens, cached_tokens, discount)
+        }
+        if part is not None:
+            entry['part'], entry['parts'] = part
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        return entry
+
+    def load(self, since=None):
+        """Return the ledger records, optionally only those written on or after `since` ('YYYY-MM-DD')."""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        if since:
+            records = [record for record in records if record['time'] >= since]
+        return records
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of a list of numbers, or None if it is empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def summarize_ledger(records):
+    """
+    Summarize ledger records for tuning budgets and concurrency.
+
+    Returns:
+    - dict: 'requests', 'failed', 'retries', 'latency' (p50/p95/max seconds of successful requests),
+      'tokens' and 'cost' totals, 'per_project' ({project: requests, tokens, cost, days, cost_per_day},
+      where a request split across days counts as a fraction) and 'tokens_per_day' ({date: tokens}).
+    """
+    # A request split across days (see LLMLedger.record_split()) counts once, by its first part
+    requests = [record for record in records if not record.get('part')]
+    ok = [record for record in requests if record['status'] == 'ok']
+    latencies = [record['latency'] for record in ok if record['latency'] is not None]
+
+    per_project = defaultdict(lambda: {'requests': 0, 'tokens': 0, 'cost': 0.0, 'days': set()})
+    tokens_per_day = defaultdict(int)
+    for record in records:
+        tokens = record['prompt_tokens'] + record['completion_tokens']
+        project = per_project[record.get('project') or '(none)']
+        project['requests'] += 1 / record.get('parts', 1)
+        project['tokens'] += tokens
+        project['cost'] += record['cost'] or 0.0
+        if record.get('date'):
+            project['days'].add(record['date'])
+            tokens_per_day[record['date']] += tokens
+
+    for project in per_project.values():
+        project['requests'] = round(project['requests'], 2)
+        project['days'] = len(project['days'])
+        project['cost'] = round(project['cost'], 4)
+        project['cost_per_day'] = round(project['cost'] / project['days'], 4) if project['days'] else None
+
+    return {
+        'requests': len(requests),
+        'failed': len(requests) - len(ok),
+        'retries': sum(record['retries'] for record in requests),
+        'latency': {
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95),
+            'max': max(latencies) if latencies else None
+        },
+        'tokens': {
+            'prompt': sum(record['prompt_tokens'] for record in records),
+            'cached': sum(record['cached_tokens'] for record in records),
+            'completion': sum(record['completion_tokens'] for record in records)
+        },
+        'cost': round(sum(record['cost'] or 0.0 for record in records), 4),
+        'per_project': dict(per_project),
+        'tokens_per_day': dict(sorted(tokens_per_day.items()))
+    }
+
+
+def print_ledger_summary(since=None, path=LEDGER_PATH):
+    """Print the summary of the ledger (optionally only records since 'YYYY-MM-DD') and return it."""
+    summary = summarize_ledger(LLMLedger(path).load(since))
+    latency = summary['latency']
+    tokens = summary['tokens']
+
+    print(f"LLM requests: {summary['requests']} ({summary['failed']} failed, {summary['retries']} retries)")
+    if latency['p50'] is not None:
+        print(f"Latency: p50 {latency['p50']:.2f}s, p95 {latency['p95']:.2f}s, max {latency['max']:.2f}s")
+    print(f"Tokens: {tokens['prompt']} prompt ({tokens['cached']} cached), {tokens['completion']} completion")
+    print(f"Cost: ${summary['cost']:.4f}")
+    for name, project in sorted(summary['per_project'].items()):
+        per_day = f", ${project['cost_per_day']:.4f}/day" if project['cost_per_day'] is not None else ''
+        print(f"  {name}: {project['requests']} requests, {project['tokens']} tokens, "
+              f"${project['cost']:.4f} over {project['days']} days{per_day}")
+    if summary['tokens_per_day']:
+        per_day = list(summary['tokens_per_day'].values())
+        print(f"Tokens per day: p50 {percentile(per_day, 0.5)}, p95 {percentile(per_day, 0.95)}, max {max(per_day)}")
+    return summary
+
+
+_ledger = None
+
+def get_llm_ledger(path=LEDGER_PATH):
+    """Return the process-wide LLM ledger, writing to the given file (set on first use)."""
+    global _ledger
+    if _ledger is None:
+        _ledger = LLMLedger(path)
+    return _ledger
+
+
+if __name__ == '__main__':
+    # python llm_ledger.py [since YYYY-MM-DD]
+    print_ledger_summary(sys.argv[1] if len(sys.argv) > 1 else None)
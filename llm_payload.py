@@ -0,0 +1,191 @@
+import hashlib
+import json
+import re
+from bisect import bisect_right
+from itertools import accumulate
+from urllib.parse import urlsplit
+
+
+CHUNK_TOKEN_BUDGET = 110000  # Tokens of chat log sent in one analysis request
+PAYLOAD_OVERHEAD_TOKENS = 32  # Upper bound for the tokens of the payload's header line
+APPROXIMATE_TOKEN_MODEL = 'approx'  # Model recorded for token counts that were only estimated
+RECORD_SEPARATOR = '\n'
+PAYLOAD_TAIL = '\n'
+PACK_DAY_TOKENS = 4000  # Days whose chat log fits in this many tokens are packed with other small days
+PACK_TOKEN_BUDGET = 24000  # Tokens of chat logs sent in one packed request
+PACK_MAX_DAYS = 8  # Days in one packed request, which bounds the length of its response
+PACK_LOG_OVERHEAD_TOKENS = 48  # Upper bound for the tokens of a packed day's '### Log' and header lines
+
+URL_PATTERN = re.compile(r'(?:https?://|www\.)[^\s<>"]+', re.IGNORECASE)
+EMOJI_RUN_PATTERN = re.compile(r'([\U0001F000-\U0001FAFF\u2600-\u27BF]\uFE0F?)\1{2,}')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def shorten_url(url):
+    """
+    Shorten a URL to its domain, first path segment and a short tag of the full URL, e.g. 'x.com/elonmusk#3f2a'.
+
+    The same URL always gets the same short form, so repeated links stay recognisable to the LLM.
+    """
+    parts = urlsplit(url if '://' in url else 'http://' + url)
+    domain = parts.netloc.lower()
+    if domain.startswith('www.'):
+        domain = domain[4:]
+    segment = parts.path.strip('/').split('/')[0]
+    tag = hashlib.sha1(url.encode('utf-8')).hexdigest()[:4]
+    return f"{domain}/{segment}#{tag}" if segment else f"{domain}#{tag}"
+
+
+def compact_text(text):
+    """Shorten URLs, collapse runs of one emoji to e.g. '🚀x12' and fold all whitespace into single spaces."""
+    text = URL_PATTERN.sub(lambda m: shorten_url(m.group(0)), text or '')
+    text = EMOJI_RUN_PATTERN.sub(lambda m: f"{m.group(1)}x{len(m.group(0)) // len(m.group(1))}", text)
+    return WHITESPACE_PATTERN.sub(' ', text).strip()
+
+
+def message_time(date):
+    """Return the 'HH:MM' of a 'YYYY-MM-DD HH:MM' date, or the date as it is if it has another format."""
+    date = str(date)
+    if len(date) >= 16 and date[10] == ' ':
+        return date[11:16]
+    return date
+
+
+def format_discussion(discussion):
+    """Serialize one {'date', 'user', 'message'} discussion (plus 'repeats' if set) as its 'HH:MM @user: text' payload line."""
+    line = f"{message_time(discussion['date'])} @{discussion['user']}: {compact_text(discussion['message'])}"
+    if discussion.get('repeats'):
+        line += f" [+{discussion['repeats']} similar]"
+    return line
+
+
+def discussion_tokens(discussion, count_tokens):
+    """
+    Count the tokens one discussion adds to the LLM payload, including the separator that follows it.
+
+    Every line ends in a newline, so the tokenizer never merges tokens across two records and the
+    payload's token count is the sum of its records' counts plus the header line.
+    """
+    return count_tokens(format_discussion(discussion) + RECORD_SEPARATOR)
+
+
+def payload_header(discussions):
+    """Return the header line of a payload, naming the day (or date range) its messages are from."""
+    days = [str(discussions[0]['date'])[:10], str(discussions[-1]['date'])[:10]] if discussions else ['']
+    day = days[0] if days[0] == days[-1] else f"{days[0]}..{days[-1]}"
+    return f"Chat log {day} (UTC), one message per line: HH:MM @user: message\n"
+
+
+def build_payload(discussions):
+    """Build the chat log text sent to the LLM: a header line, then one 'HH:MM @user: text' line per discussion."""
+    return payload_header(discussions) + RECORD_SEPARATOR.join(format_discussion(d) for d in discussions) + PAYLOAD_TAIL
+
+
+def build_json_payload(discussions):
+    """Build the chat log as the JSON text sent before the compact format, for measuring the savings."""
+    records = []
+    for d in discussions:
+        record = {"date": d['date'], "user": d['user'], "message": d['message']}
+        if d.get('repeats'):
+            record['repeats'] = d['repeats']
+        records.append(json.dumps(record, ensure_ascii=False))
+    return '{"discussions": [\n' + ',\n'.join(records) + '\n]}'
+
+
+def payload_savings(discussions, count_tokens):
+    """
+    Measure the tokens the compact payload saves over the JSON payload for the same discussions.
+
+    Returns:
+    - dict: 'json_tokens', 'compact_tokens', 'saved_tokens' and 'saved_ratio'.
+    """
+    json_tokens = count_tokens(build_json_payload(discussions))
+    compact_tokens = count_tokens(build_payload(discussions))
+    return {
+        'json_tokens': json_tokens,
+        'compact_tokens': compact_tokens,
+        'saved_tokens': json_tokens - compact_tokens,
+        'saved_ratio': round(1 - compact_tokens / json_tokens, 3) if json_tokens else 0.0
+    }
+
+
+def fit_discussions(token_counts, budget):
+    """
+    Return how many leading discussions fit in a payload of `budget` tokens.
+
+    Parameters:
+    - token_counts (list): Token count of each discussion, as returned by discussion_tokens().
+    - budget (int): Maximum tokens of the payload, including the payload overhead.
+
+    Returns:
+    - tuple: (number of discussions, upper bound on the payload's tokens).
+    """
+    # Each count ends on the separator's newline, so the prefix sums bound the payload exactly
+    prefix_sums = list(accumulate(token_counts))
+    n = bisect_right(prefix_sums, budget - PAYLOAD_OVERHEAD_TOKENS)
+    return n, (prefix_sums[n - 1] if n else 0) + PAYLOAD_OVERHEAD_TOKENS
+
+
+class TokenChunker:
+    """
+    Cuts a stream of filtered messages into consecutive chunks that each fit a token budget.
+
+    Parameters:
+    - budget (int): Maximum tokens per chunk, including the payload overhead.
+    """
+
+    def __init__(self, budget=CHUNK_TOKEN_BUDGET):
+        self.budget = budget - PAYLOAD_OVERHEAD_TOKENS
+        self.chunks = []
+        self.messages = 0
+        self.tokens = 0
+
+    def add(self, tokens):
+        """Add the next message's token count, starting a new chunk when it would not fit in the current one."""
+        if not self.chunks or (self.chunks[-1]['messages'] and self.chunks[-1]['tokens'] + tokens > self.budget):
+            self.chunks.append({'start': self.messages, 'messages': 0, 'tokens': 0})
+        self.chunks[-1]['messages'] += 1
+        self.chunks[-1]['tokens'] += tokens
+        self.messages += 1
+        self.tokens += tokens
+
+    def metadata(self, model):
+        """
+        Return the chunking for the manifest.
+
+        Returns:
+        - dict: 'model' the counts are for, 'total' tokens and 'chunks', each with the 'start' index and number of
+          'messages' of the filtered messages it covers and its 'tokens'.
+        """
+        return {'model': model, 'total': self.tokens, 'chunks': self.chunks}
+
+
+def build_packed_payload(logs):
+    """Build the text of a packed request from (log_id, discussions) pairs: each day's payload after a '### Log <log_id>' line."""
+    return ''.join(f"### Log {log_id}\n" + build_payload(discussions) for log_id, discussions in logs)
+
+
+def pack_days(token_counts, budget=PACK_TOKEN_BUDGET, max_days=PACK_MAX_DAYS):
+    """
+    Group small days into packs that each fit one request, placing each day in the first pack it fits in.
+
+    Parameters:
+    - token_counts (list): Chat log tokens of each day.
+    - budget (int): Maximum tokens of a pack, including each day's overhead (PACK_LOG_OVERHEAD_TOKENS).
+    - max_days (int): Maximum days in a pack.
+
+    Returns:
+    - list: Packs, each a list of indexes into token_counts in their original order.
+    """
+    packs = []
+    totals = []
+    for i, tokens in enumerate(token_counts):
+        tokens += PACK_LOG_OVERHEAD_TOKENS
+        j = next((j for j in range(len(packs)) if len(packs[j]) < max_days and totals[j] + tokens <= budget), None)
+        if j is None:
+            packs.append([])
+            totals.append(0)
+            j = len(packs) - 1
+        packs[j].append(i)
+        totals[j] += tokens
+    return packs
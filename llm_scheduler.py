@@ -0,0 +1,271 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+import openai
+
+from dedupe import approximate_tokens
+from llm_ledger import get_llm_ledger
+
+
+DEFAULT_RPM = 500  # Requests per minute allowed on the OpenAI account
+DEFAULT_TPM = 200000  # Tokens per minute allowed on the OpenAI account
+COMPLETION_TOKENS_ESTIMATE = 1000  # Tokens reserved for a structured analysis response
+BURST_SECONDS = 10  # The buckets hold this many seconds of budget, so bursts stay well inside a minute's limit
+RETRY_QUEUE_PATH = os.path.join('tg', 'llm_retry_queue.jsonl')
+
+
+def estimate_request_tokens(*texts, completion_tokens=COMPLETION_TOKENS_ESTIMATE):
+    """
+    Estimate the tokens a request counts against the TPM limit before it is sent.
+
+    OpenAI debits the rate limit with a character-based estimate of the prompt plus the completion
+    allowance, so the same estimate is used here rather than running the tokenizer.
+    """
+    return sum(approximate_tokens(text) for text in texts if text) + completion_tokens
+
+
+class RateBudget:
+    """
+    Thread-safe token bucket for a per-minute limit.
+
+    Callers reserve their cost up front and are told how long to wait before using it, so sync and async
+    callers can share one budget: the async ones sleep with asyncio.sleep, the sync ones with time.sleep.
+
+    Parameters:
+    - per_minute (float): The limit per minute.
+    - burst_seconds (float): Seconds of budget the bucket can hold.
+    """
+
+    def __init__(self, per_minute, burst_seconds=BURST_SECONDS):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Take `amount` from the bucket (going into debt if needed) and return the seconds to wait before using it.
+
+        The whole amount is taken even when it exceeds the bucket's capacity, so a request larger than the
+        bucket waits for its full cost to accrue and adjust() refunds against what was actually taken.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= amount
+            return max(0.0, -self.level / self.rate)
+
+    def adjust(self, amount):
+        """Give back (positive) or take (negative) budget once a request's real cost is known."""
+        with self._lock:
+            self.level = min(self.capacity, self.level + amount)
+
+
+def is_retryable(error):
+    """Return True for errors worth retrying: rate limits, timeouts, connection errors and server errors."""
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def retry_after(error):
+    """Return the wait the API asked for in a Retry-After header, in seconds, or None."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+class LLMScheduler:
+    """
+    Paces OpenAI requests against the account's requests-per-minute and tokens-per-minute limits.
+
+    Each request reserves one request and its estimated tokens from two RateBudgets before it is sent.
+    Rate limits, timeouts and server errors are retried with jittered exponential backoff, or after the
+    wait given in Retry-After. A rate limit also pauses every other request briefly, so the whole account
+    backs off together. Requests that still fail, or fail with a permanent error, are appended to a retry
+    queue file so they can be run again later, unless the caller has no way to rerun them. Every request,
+    successful or not, is recorded in the LLM ledger with its tokens, latency and retries; a job with 'days'
+    (a packed request) is recorded per day. The tokens reserved for an attempt that fails are given back,
+    so retries don't charge the budget twice.
+
+    Parameters:
+    - rpm (int): Requests per minute allowed on the account.
+    - tpm (int): Tokens per minute allowed on the account.
+    - max_retries (int): Retries before a request is given up and queued.
+    - base_delay (float): First backoff delay in seconds, doubled on every retry.
+    - max_delay (float): Longest backoff delay in seconds.
+    - retry_queue_path (str): JSONL file failed requests are recorded in.
+    - ledger (LLMLedger): Ledger requests are recorded in (defaults to the process-wide ledger).
+    """
+
+    def __init__(self, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, max_retries=6, base_delay=1.0, max_delay=60.0,
+                 retry_queue_path=RETRY_QUEUE_PATH, ledger=None):
+        self.requests = RateBudget(rpm)
+        self.tokens = RateBudget(tpm)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_queue_path = retry_queue_path
+        self.ledger = ledger or get_llm_ledger()
+        self.paused_until = 0.0
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.tokens_used = 0
+
+    def _admit(self, tokens):
+        # Seconds until both budgets (and any account-wide pause) allow the request
+        pause = max(0.0, self.paused_until - time.monotonic())
+        return max(pause, self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    def _backoff(self, error, attempt):
+        # Retry-After wins; otherwise exponential backoff with jitter so waiting requests don't retry in step
+        delay = retry_after(error)
+        if delay is None:
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+        if isinstance(error, openai.RateLimitError):
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.retries += 1
+        return delay
+
+    def _record(self, job, model, usage, latency, retries, status):
+        job = job or {}
+        if job.get('days'):
+            # A packed request: its usage is split across the days it analysed
+            self.ledger.record_split(job.get('kind', 'request'), model, usage, latency, retries, status,
+                                     [(day.get('project'), day.get('date'), day.get('tokens')) for day in job['days']],
+                                     job.get('prompt_version'))
+            return
+        self.ledger.record(job.get('kind', 'request'), model, usage, latency, retries, status,
+                           job.get('project'), job.get('date'), job.get('prompt_version'))
+
+    def _done(self, response, tokens, job, model, latency, retries):
+        self.calls += 1
+        usage = getattr(response, 'usage', None)
+        used = getattr(usage, 'total_tokens', None)
+        if used is not None:
+            self.tokens_used += used
+            self.tokens.adjust(tokens - used)
+        self._record(job, model, usage, latency, retries, 'ok')
+        return response
+
+    def _give_up(self, label, error, attempts, job, model, latency, queue):
+        self.failures += 1
+        self._record(job, model, None, latency, attempts - 1, 'failed')
+        print(f"LLM request {label} failed after {attempts} attempts: {error}")
+        if not queue:
+            return
+        directory = os.path.dirname(self.retry_queue_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        entry = {'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'label': label,
+                 'error': f"{type(error).__name__}: {error}", 'attempts': attempts, 'job': job}
+        with open(self.retry_queue_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    async def call(self, func, *args, tokens, label='request', job=None, queue=True, **kwargs):
+        """
+        Await func(*args, **kwargs) within the rate limits, retrying transient errors.
+
+        Parameters:
+        - func (coroutine function): The OpenAI call, e.g. async_client.beta.chat.completions.parse.
+        - tokens (int): Estimated tokens of the request (see estimate_request_tokens()).
+        - label (str): Name of the request in log messages and the retry queue.
+        - job (dict): What to record in the retry queue if the request fails for good.
+        - queue (bool): Record the request in the retry queue if it fails for good. Requests nothing can
+          rerun from the queue (see retry_failed_chat_logs()) pass False, so they don't stay in it forever.
+
+        Returns:
+        - The response, or None if the request failed for good.
+        """
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._admit(tokens))
+            started = time.monotonic()
+            try:
+                response = await func(*args, **kwargs)
+                return self._done(response, tokens, job, kwargs.get('model'), time.monotonic() - started, attempt)
+            except Exception as e:
+                # A rejected request used none of its reserved tokens; the next attempt reserves them again
+                self.tokens.adjust(tokens)
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self._give_up(label, e, attempt + 1, job, kwargs.get('model'), time.monotonic() - started, queue)
+                    return None
+                delay = self._backoff(e, attempt)
+                print(f"LLM request {label}: {type(e).__name__}, retrying in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+
+    def call_sync(self, func, *args, tokens, label='request', job=None, queue=True, **kwargs):
+        """Blocking version of call(), for synchronous OpenAI calls."""
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._admit(tokens))
+            started = time.monotonic()
+            try:
+                response = func(*args, **kwargs)
+                return self._done(response, tokens, job, kwargs.get('model'), time.monotonic() - started, attempt)
+            except Exception as e:
+                # A rejected request used none of its reserved tokens; the next attempt reserves them again
+                self.tokens.adjust(tokens)
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self._give_up(label, e, attempt + 1, job, kwargs.get('model'), time.monotonic() - started, queue)
+                    return None
+                delay = self._backoff(e, attempt)
+                print(f"LLM request {label}: {type(e).__name__}, retrying in {delay:.1f}s.")
+                time.sleep(delay)
+
+    def stats(self):
+        """Return counters for reporting."""
+        return {
+            'calls': self.calls,
+            'retries': self.retries,
+            'failures': self.failures,
+            'tokens_used': self.tokens_used
+        }
+
+
+def load_retry_queue(path=RETRY_QUEUE_PATH):
+    """Return the failed requests recorded in the retry queue, oldest first."""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_retry_queue(entries, path=RETRY_QUEUE_PATH):
+    """Replace the retry queue with `entries` (removing the file when none are left)."""
+    if not entries:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+
+
+_scheduler = None
+
+def get_llm_scheduler(rpm=DEFAULT_RPM, tpm=DEFAULT_TPM):
+    """Return the process-wide LLM scheduler, creating it with the given limits on first use."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = LLMScheduler(rpm=rpm, tpm=tpm)
+    return _scheduler
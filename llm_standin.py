@@ -0,0 +1,300 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+
+import httpx
+import openai
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion
+
+from dedupe import approximate_tokens
+
+
+RECORDING_PATH = os.path.join('tg', 'llm_recording.jsonl')
+STANDIN_MODES = ('synthetic', 'replay', 'record')
+SENDER_PATTERN = re.compile(r'Usr:@(\S+)')
+LOG_PATTERN = re.compile(r'^### Log (\S+)$', re.MULTILINE)
+
+
+def request_key(model, messages, response_format=None):
+    """Return the key a chat completion request is recorded and replayed under."""
+    body = json.dumps({'model': model, 'messages': messages, 'response_format': response_format},
+                      sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def synthetic_value(schema, rng, defs=None, name='value'):
+    """
+    Return a random value that satisfies a JSON schema, drawn from rng.
+
+    Integers fall within the schema's minimum/maximum (0-100 when none is given, the range of the analysis
+    scores), nullable values are null one time in ten and strings are short placeholder phrases.
+    """
+    if defs is None:
+        defs = schema.get('$defs', {})
+    if '$ref' in schema:
+        return synthetic_value(defs[schema['$ref'].split('/')[-1]], rng, defs, name)
+    if 'anyOf' in schema:
+        options = [option for option in schema['anyOf'] if option.get('type') != 'null']
+        if not options or (len(options) < len(schema['anyOf']) and rng.random() < 0.1):
+            return None
+        return synthetic_value(rng.choice(options), rng, defs, name)
+    if 'enum' in schema:
+        return rng.choice(schema['enum'])
+
+    schema_type = schema.get('type')
+    if isinstance(schema_type, list):
+        schema_type = rng.choice([t for t in schema_type if t != 'null'] or ['null'])
+
+    if schema_type == 'object':
+        return {key: synthetic_value(prop, rng, defs, key) for key, prop in schema.get('properties', {}).items()}
+    if schema_type == 'array':
+        return [synthetic_value(schema.get('items', {}), rng, defs, name) for _ in range(rng.randint(0, 2))]
+    if schema_type == 'string':
+        return f"synthetic {name} {rng.randint(1, 999)}"
+    if schema_type == 'integer':
+        return rng.randint(schema.get('minimum', 0), schema.get('maximum', 100))
+    if schema_type == 'number':
+        return round(rng.uniform(schema.get('minimum', 0), schema.get('maximum', 100)), 2)
+    if schema_type == 'boolean':
+        return rng.random() < 0.5
+    return None
+
+
+def rate_limit_error(retry_after):
+    """Build the RateLimitError the API raises for a 429, with a Retry-After header."""
+    response = httpx.Response(429, headers={'retry-after': f"{retry_after:.3f}"},
+                              request=httpx.Request('POST', 'https://api.openai.com/v1/chat/completions'))
+    return openai.RateLimitError('Rate limit reached (stand-in)', response=response, body=None)
+
+
+class LLMStandIn:
+    """
+    Local stand-in for the chat completions endpoint, so the analysis pipeline can run and be benchmarked
+    without network access or an OpenAI key.
+
+    Modes:
+    - 'synthetic': answers with random but deterministic JSON that matches the request's response schema
+      (the same request always gets the same answer, and packed requests get one entry per '### Log'),
+      or with a comma separated list of senders for requests without a schema, like the spam check.
+    - 'replay': answers with the responses recorded for identical requests in recording_path, falling
+      back to synthetic answers for requests that were never recorded.
+    - 'record': sends every request to the live API with the given clients and appends the responses,
+      token usage and latencies to recording_path.
+
+    In the synthetic and replay modes every response takes `latency` seconds, give or take `jitter` of it
+    (replayed responses take as long as they did when recorded). Requests beyond the stand-in's own
+    rpm/tpm limits, plus a random `rate_limit_rate` of the rest, fail with a 429 and a Retry-After header.
+    Token usage is estimated from the text like the API's rate limiter does, unless it was recorded.
+
+    Parameters:
+    - mode (str): 'synthetic', 'replay' or 'record'.
+    - latency (float): Seconds each response takes.
+    - jitter (float): Random spread of the latency, as a fraction of it.
+    - rate_limit_rate (float): Fraction of requests answered with a 429.
+    - rpm (int): Requests per minute before requests get a 429 (None for no limit).
+    - tpm (int): Tokens per minute before requests get a 429 (None for no limit).
+    - retry_after (float): Retry-After of the injected 429s when no limit dictates a wait, in seconds.
+    - recording_path (str): JSONL file responses are recorded to and replayed from.
+    - client (OpenAI): Live client for the record mode.
+    - async_client (AsyncOpenAI): Live async client for the record mode.
+    - seed (int): Seed of the latency jitter and the injected 429s.
+    """
+
+    def __init__(self, mode='synthetic', latency=1.0, jitter=0.25, rate_limit_rate=0.0, rpm=None, tpm=None,
+                 retry_after=1.0, recording_path=RECORDING_PATH, client=None, async_client=None, seed=0):
+        if mode not in STANDIN_MODES:
+            raise ValueError(f"Unknown stand-in mode '{mode}', expected one of {STANDIN_MODES}.")
+        if mode == 'record' and (client is None or async_client is None):
+            raise ValueError("The record mode needs live OpenAI clients.")
+        self.mode = mode
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.rpm = rpm
+        self.tpm = tpm
+        self.retry_after = retry_after
+        self.recording_path = recording_path
+        self.live_client = client
+        self.live_async_client = async_client
+        if mode == 'record':
+            # The LLM scheduler does the retrying, as with the live clients
+            self._live_create = client.with_options(max_retries=0).chat.completions.create
+            self._live_acreate = async_client.with_options(max_retries=0).chat.completions.create
+        self.rng = random.Random(seed)
+        self.window = deque()  # (time, tokens) of the requests answered in the last minute
+        self._lock = threading.Lock()
+        self.recordings = self._load_recordings() if mode == 'replay' else {}
+        self.counts = {'requests': 0, 'rate_limited': 0, 'replayed': 0, 'replay_misses': 0, 'recorded': 0,
+                       'prompt_tokens': 0, 'completion_tokens': 0}
+
+    def _load_recordings(self):
+        recordings = {}
+        if os.path.exists(self.recording_path):
+            with open(self.recording_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        recordings[record['key']] = record
+        print(f"Loaded {len(recordings)} recorded LLM responses from '{self.recording_path}'.")
+        return recordings
+
+    def clients(self):
+        """Return (client, async_client) stand-ins for OpenAI and AsyncOpenAI."""
+        return StandInClient(self), StandInClient(self, is_async=True)
+
+    def respond(self, body):
+        """
+        Return the assistant message text for a chat completion request body, without latency or rate limits.
+
+        Also usable as the responder of llm_batch.LocalBatchBackend.
+        """
+        return self._answer(body)[0]
+
+    def _answer(self, body):
+        # Returns (content, usage, latency), the last two only known for replayed responses
+        messages = body['messages']
+        response_format = body.get('response_format')
+        key = request_key(body.get('model'), messages, response_format)
+        if self.mode == 'replay':
+            record = self.recordings.get(key)
+            with self._lock:
+                self.counts['replayed' if record else 'replay_misses'] += 1
+            if record:
+                return record['content'], record.get('usage'), record.get('latency')
+
+        # Seed from the request, so identical requests get identical answers
+        rng = random.Random(key)
+        schema = ((response_format or {}).get('json_schema') or {}).get('schema')
+        if schema:
+            value = synthetic_value(schema, rng)
+            log_ids = LOG_PATTERN.findall(messages[-1]['content'])
+            if log_ids and 'days' in value:
+                # A packed request: one analysis per chat log, under its log_id
+                days_schema = schema['properties']['days']['items']
+                value['days'] = [dict(synthetic_value(days_schema, rng, schema.get('$defs', {})), log_id=log_id)
+                                 for log_id in log_ids]
+            return json.dumps(value), None, None
+        senders = sorted(set(sender for message in messages for sender in SENDER_PATTERN.findall(message['content'])))
+        return ', '.join(rng.sample(senders, min(2, len(senders)))), None, None
+
+    def _admit(self, prompt_tokens):
+        # Returns the 429 to raise for a request over the limits (or picked for injection), else None
+        with self._lock:
+            now = time.monotonic()
+            while self.window and self.window[0][0] <= now - 60:
+                self.window.popleft()
+            wait = None
+            if self.rpm is not None and len(self.window) >= self.rpm:
+                wait = self.window[0][0] + 60 - now
+            elif self.tpm is not None and self.window and sum(tokens for _, tokens in self.window) + prompt_tokens > self.tpm:
+                wait = self.window[0][0] + 60 - now
+            elif self.rng.random() < self.rate_limit_rate:
+                wait = self.retry_after
+            if wait is not None:
+                self.counts['rate_limited'] += 1
+                return rate_limit_error(max(wait, 0.001))
+            self.window.append((now, prompt_tokens))
+            return None
+
+    def _delay(self):
+        with self._lock:
+            return max(0.0, self.latency * (1 + self.rng.uniform(-self.jitter, self.jitter)))
+
+    def _completion(self, body, content, usage=None):
+        if not usage:
+            usage = {'prompt_tokens': sum(approximate_tokens(message['content']) for message in body['messages']),
+                     'completion_tokens': approximate_tokens(content)}
+            usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        with self._lock:
+            self.counts['requests'] += 1
+            self.counts['prompt_tokens'] += usage['prompt_tokens']
+            self.counts['completion_tokens'] += usage['completion_tokens']
+        return ChatCompletion(
+            id=f"chatcmpl-standin-{uuid.uuid4().hex[:12]}",
+            object='chat.completion',
+            created=int(time.time()),
+            model=body.get('model') or 'stand-in',
+            choices=[{'index': 0, 'finish_reason': 'stop',
+                      'message': {'role': 'assistant', 'content': content}}],
+            usage=CompletionUsage(**usage)
+        )
+
+    def _record(self, body, response, latency):
+        usage = response.usage.model_dump() if response.usage is not None else None
+        record = {'key': request_key(body.get('model'), body['messages'], body.get('response_format')),
+                  'model': body.get('model'), 'content': response.choices[0].message.content,
+                  'usage': usage, 'latency': round(latency, 3)}
+        with self._lock:
+            directory = os.path.dirname(self.recording_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.recording_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.counts['requests'] += 1
+            self.counts['recorded'] += 1
+            if usage:
+                self.counts['prompt_tokens'] += usage['prompt_tokens']
+                self.counts['completion_tokens'] += usage['completion_tokens']
+
+    def create(self, **body):
+        """Answer a chat completion request (blocking), like client.chat.completions.create."""
+        if self.mode == 'record':
+            started = time.monotonic()
+            response = self._live_create(**body)
+            self._record(body, response, time.monotonic() - started)
+            return response
+
+        error = self._admit(sum(approximate_tokens(message['content']) for message in body['messages']))
+        if error is not None:
+            raise error
+        content, usage, latency = self._answer(body)
+        time.sleep(latency if latency is not None else self._delay())
+        return self._completion(body, content, usage)
+
+    async def acreate(self, **body):
+        """Answer a chat completion request, like async_client.chat.completions.create."""
+        if self.mode == 'record':
+            started = time.monotonic()
+            response = await self._live_acreate(**body)
+            self._record(body, response, time.monotonic() - started)
+            return response
+
+        error = self._admit(sum(approximate_tokens(message['content']) for message in body['messages']))
+        if error is not None:
+            raise error
+        content, usage, latency = self._answer(body)
+        await asyncio.sleep(latency if latency is not None else self._delay())
+        return self._completion(body, content, usage)
+
+    def stats(self):
+        """Return counters for reporting."""
+        return dict(self.counts)
+
+
+class _Completions:
+    def __init__(self, standin, is_async):
+        self.create = standin.acreate if is_async else standin.create
+
+
+class _Chat:
+    def __init__(self, standin, is_async):
+        self.completions = _Completions(standin, is_async)
+
+
+class StandInClient:
+    """Drop-in for the parts of OpenAI/AsyncOpenAI the pipeline uses: chat.completions.create and with_options()."""
+
+    def __init__(self, standin, is_async=False):
+        self.standin = standin
+        self.chat = _Chat(standin, is_async)
+
+    def with_options(self, **kwargs):
+        return self
@@ -10,6 +10,8 @@ import time
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 
+from tg_store import load_manifest
+
 
 def fetch_price_data(project_name):
     """
@@ -58,13 +60,11 @@ def fetch_price_data(project_name):
         print(f"Project directory '{project_dir}' does not exist.")
         return
 
-    # Get the list of date directories
-    date_dirs = [d for d in os.listdir(project_dir) if os.path.isdir(os.path.join(project_dir, d))]
-    # Filter directories that match 'YYYY-MM-DD' format
-    date_dirs = [d for d in date_dirs if is_valid_date(d)]
+    # Get the list of scraped days from the project manifest
+    date_dirs = list(load_manifest(project_name)['days'])
 
     if not date_dirs:
-        print(f"No date directories found in '{project_dir}'.")
+        print(f"No days recorded in the manifest for '{project_dir}'.")
         return
 
     # Determine the date range
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Union, Optional
+from typing import List, Union, Optional
 
 # Track the version of this prompt. Must be updated manually. 
 __version__ = "1.0.5" 
@@ -90,3 +90,22 @@ class ChatLogAnalysisResponse(BaseModel):
 
     class Config:
         extra = "forbid"  # Disallow any extra fields
+
+
+# Added to the prompt.ini system prompt when several small days are analysed in one request
+PACKED_PROMPT = """
+
+This request contains several chat logs instead of one. Each is the chat log of one day, possibly from a different discussion group, and starts with a line "### Log <log_id>". Analyse each chat log on its own, exactly as if it were the only one sent in its own query, without letting the other logs influence its metrics. Return one entry in days for every chat log, with its log_id."""
+
+class DayAnalysis(BaseModel):
+    log_id: str = Field(description="""The log_id of the chat log this entry analyses, exactly as given in its "### Log <log_id>" line.""")
+    metrics: CommunityMetrics
+
+    class Config:
+        extra = "forbid"  # Disallow any extra fields
+
+class PackedChatLogAnalysisResponse(BaseModel):
+    days: List[DayAnalysis] = Field(description="""One analysis per chat log in the request.""")
+
+    class Config:
+        extra = "forbid"  # Disallow any extra fields
@@ -0,0 +1,351 @@
+import json
+import math
+import os
+import re
+from collections import Counter
+from datetime import datetime, timedelta
+
+from tg_store import write_json_atomic
+
+
+URL_PATTERN = re.compile(r'(https?://\S+|www\.\S+|t\.me/\S+)', re.IGNORECASE)
+ADDRESS_PATTERN = re.compile(r'\b(0x[0-9a-fA-F]{16,}|[1-9A-HJ-NP-Za-km-z]{32,44})\b')
+NUMBER_PATTERN = re.compile(r'[$€£]?\d[\d,.]*[kKmMbB%x]?')
+TICKER_PATTERN = re.compile(r'\$[A-Za-z][A-Za-z0-9]{1,9}\b')
+WORD_PATTERN = re.compile(r'\w', re.UNICODE)
+TOKEN_PUNCTUATION = '()[]{},;:!?"\''
+
+# How much each feature contributes to a sender's spam score (weights sum to 1)
+DEFAULT_WEIGHTS = {
+    'template_ratio': 0.30,
+    'repetition_ratio': 0.15,
+    'numeric_density': 0.25,
+    'regularity': 0.15,
+    'link_only_ratio': 0.15
+}
+
+MIN_REGULARITY_GAPS = 5  # Gaps between posts needed before posting regularity counts towards the score
+
+# Evidence a SpamRegistry entry gets per day it is flagged, by source: Telegram's bot flag and LLM verdicts
+# are trusted on their own, heuristic verdicts have to recur before a sender is dropped without scoring
+EVIDENCE_WEIGHTS = {'bot': 3, 'llm': 3, 'heuristic': 1}
+KNOWN_SPAM_EVIDENCE = 3
+SPAM_REGISTRY_TTL_DAYS = 30
+
+
+def message_template(text):
+    """Reduce a message to its template: lowercased, with links, addresses and numbers replaced by placeholders."""
+    text = URL_PATTERN.sub('<url>', text.lower())
+    text = ADDRESS_PATTERN.sub('<addr>', text)
+    text = NUMBER_PATTERN.sub('<num>', text)
+    return ' '.join(text.split())
+
+
+def parse_timestamp(timestamp):
+    """Return a message timestamp (datetime or 'YYYY-MM-DD HH:MM') as seconds since the epoch, or None."""
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, str):
+        timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M')
+    return timestamp.timestamp()
+
+
+class SenderFeatures:
+    """Running per-sender feature counts, updated one message at a time."""
+
+    def __init__(self):
+        self.messages = 0
+        self.is_bot = False
+        self.texts = Counter()
+        self.templates = Counter()
+        self.numeric_density = 0.0
+        self.link_only = 0
+        # Welford running mean/variance of the gaps between messages
+        self.last_time = None
+        self.gaps = 0
+        self.gap_mean = 0.0
+        self.gap_m2 = 0.0
+
+    def add(self, text, timestamp=None):
+        """Update the counts with one message."""
+        self.messages += 1
+        self.texts[hash(text)] += 1
+        self.templates[hash(message_template(text))] += 1
+
+        tokens = text.split()
+        if tokens:
+            tokens = [token.strip(TOKEN_PUNCTUATION) for token in tokens]
+            numeric = sum(1 for token in tokens if NUMBER_PATTERN.fullmatch(token) or TICKER_PATTERN.fullmatch(token))
+            self.numeric_density += numeric / len(tokens)
+
+        if URL_PATTERN.search(text) and not WORD_PATTERN.search(URL_PATTERN.sub('', text)):
+            self.link_only += 1
+
+        seconds = parse_timestamp(timestamp)
+        if seconds is not None:
+            if self.last_time is not None:
+                gap = abs(seconds - self.last_time)
+                self.gaps += 1
+                delta = gap - self.gap_mean
+                self.gap_mean += delta / self.gaps
+                self.gap_m2 += delta * (gap - self.gap_mean)
+            self.last_time = seconds
+
+    def features(self):
+        """
+        Return the sender's features, each between 0 and 1.
+
+        Returns:
+        - dict: 'repetition_ratio' (share of exact repeats), 'template_ratio' (share of messages reusing a
+          template), 'numeric_density' (average share of number/ticker tokens), 'regularity' (1 for perfectly
+          evenly spaced posts, 0 with fewer than MIN_REGULARITY_GAPS gaps between them) and 'link_only_ratio'
+          (share of messages that are only links).
+        """
+        if self.messages == 0:
+            return {name: 0.0 for name in DEFAULT_WEIGHTS}
+
+        regularity = 0.0
+        # A few gaps look evenly spaced by chance, so regularity only counts once there are enough of them
+        if self.gaps >= MIN_REGULARITY_GAPS and self.gap_mean > 0:
+            # Randomly timed posting has a coefficient of variation around 1, scheduled posting near 0
+            coefficient_of_variation = math.sqrt(self.gap_m2 / self.gaps) / self.gap_mean
+            regularity = max(0.0, 1 - coefficient_of_variation)
+
+        return {
+            'repetition_ratio': 1 - len(self.texts) / self.messages,
+            'template_ratio': 1 - len(self.templates) / self.messages,
+            'numeric_density': self.numeric_density / self.messages,
+            'regularity': regularity,
+            'link_only_ratio': self.link_only / self.messages
+        }
+
+
+class SpamClassifier:
+    """
+    Scores message senders as spam/bot accounts from features gathered in one streaming pass.
+
+    Each sender's score is a weighted sum of their features. Scores at or above spam_threshold are 'spam',
+    below ham_threshold 'ham', and anything in between 'unsure' (the only senders worth asking the LLM
+    about). Senders with fewer than min_messages messages are 'ham' unless flagged as Telegram bots,
+    as a single message says too little about the account.
+
+    Parameters:
+    - spam_threshold (float): Score from which a sender is classified as spam.
+    - ham_threshold (float): Score below which a sender is classified as a regular user.
+    - min_messages (int): Messages needed before a sender can be classified as spam.
+    - weights (dict): Feature weights, defaults to DEFAULT_WEIGHTS.
+    """
+
+    def __init__(self, spam_threshold=0.5, ham_threshold=0.25, min_messages=3, weights=None):
+        self.spam_threshold = spam_threshold
+        self.ham_threshold = ham_threshold
+        self.min_messages = min_messages
+        self.weights = weights or DEFAULT_WEIGHTS
+        self.senders = {}
+
+    def add(self, sender, text, timestamp=None, is_bot=False):
+        """
+        Add one message to its sender's features.
+
+        Parameters:
+        - sender (str): Sender username.
+        - text (str): Message text.
+        - timestamp (datetime or str): Message time, used for posting regularity.
+        - is_bot (bool): Telegram reports the sender as a bot.
+        """
+        features = self.senders.get(sender)
+        if features is None:
+            features = self.senders[sender] = SenderFeatures()
+        features.is_bot = features.is_bot or is_bot
+        features.add(text or '', timestamp)
+
+    def score(self, sender):
+        """Return the spam score of a sender, from 0 (regular user) to 1 (spam/bot)."""
+        features = self.senders.get(sender)
+        if features is None:
+            return 0.0
+        if features.is_bot:
+            return 1.0
+        values = features.features()
+        return sum(weight * values[name] for name, weight in self.weights.items())
+
+    def verdict(self, sender):
+        """Return 'spam', 'ham' or 'unsure' for a sender."""
+        features = self.senders.get(sender)
+        if features is None:
+            return 'ham'
+        if features.is_bot:
+            return 'spam'
+        if features.messages < self.min_messages:
+            return 'ham'
+
+        score = self.score(sender)
+        if score >= self.spam_threshold:
+            return 'spam'
+        if score < self.ham_threshold:
+            return 'ham'
+        return 'unsure'
+
+    def is_spam(self, sender):
+        """Return True if the sender is currently classified as spam."""
+        return self.verdict(sender) == 'spam'
+
+    def classify(self):
+        """Return {sender: (verdict, score)} for every sender seen."""
+        return {sender: (self.verdict(sender), round(self.score(sender), 3)) for sender in self.senders}
+
+
+def message_day(timestamp):
+    """Return the 'YYYY-MM-DD' day of a message timestamp (datetime or string), or today if unknown."""
+    if timestamp is None:
+        return datetime.now().strftime('%Y-%m-%d')
+    if isinstance(timestamp, str):
+        return timestamp[:10]
+    return timestamp.strftime('%Y-%m-%d')
+
+
+class SpamRegistry:
+    """
+    Per-group registry of known spam and bot senders, kept in tg/<group>/<group>_spam_registry.json.
+
+    Each sender records the first and last day they were flagged and on how many days each source flagged
+    them: 'bot' (Telegram's bot flag), 'heuristic' (SpamClassifier) or 'llm' (an LLM spam verdict). A sender
+    only counts as known spam once the weighted evidence (EVIDENCE_WEIGHTS per day and source) reaches
+    known_evidence, so one bot flag or LLM verdict is enough but a heuristic verdict has to recur on
+    several days, and stops counting ttl_days after they were last flagged, so they are classified again.
+    Lookups are a dict access, so known offenders can be dropped before any other filtering.
+
+    Parameters:
+    - group (str): Name of the group.
+    - known_evidence (int): Weighted evidence from which a sender is known spam.
+    - ttl_days (int): Days after the last flag that a sender stays known spam.
+    """
+
+    def __init__(self, group, known_evidence=KNOWN_SPAM_EVIDENCE, ttl_days=SPAM_REGISTRY_TTL_DAYS):
+        self.group = group
+        self.path = os.path.join('tg', group, f"{group}_spam_registry.json")
+        self.known_evidence = known_evidence
+        self.ttl_days = ttl_days
+        self.senders = {}
+        self.dirty = False
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.senders = json.load(f).get('senders', {})
+
+    def is_known(self, sender, day=None):
+        """
+        Return True if a sender is known spam on a day: flagged with enough evidence, and last flagged
+        at most ttl_days before it.
+
+        Parameters:
+        - sender (str): Sender username.
+        - day (str): Day of the message, 'YYYY-MM-DD' (defaults to today).
+        """
+        entry = self.senders.get(sender)
+        if entry is None:
+            return False
+        evidence = sum(EVIDENCE_WEIGHTS.get(source, 1) * days for source, days in entry['evidence'].items())
+        if evidence < self.known_evidence:
+            return False
+        last_seen = datetime.strptime(entry['last_seen'], '%Y-%m-%d')
+        return datetime.strptime(day or message_day(None), '%Y-%m-%d') <= last_seen + timedelta(days=self.ttl_days)
+
+    def record(self, sender, source, day=None):
+        """
+        Record evidence that a sender is spam or a bot. Each source counts once per day.
+
+        Parameters:
+        - sender (str): Sender username.
+        - source (str): 'bot', 'heuristic' or 'llm'.
+        - day (str): Day of the evidence, 'YYYY-MM-DD' (defaults to today).
+        """
+        day = day or message_day(None)
+        entry = self.senders.get(sender)
+        if entry is None:
+            entry = self.senders[sender] = {'first_seen': day, 'last_seen': day, 'evidence': {}, 'last_evidence': {}}
+        last_days = entry['last_evidence']
+        if last_days.get(source) == day:
+            return
+        last_days[source] = day
+        entry['first_seen'] = min(entry['first_seen'], day)
+        entry['last_seen'] = max(entry['last_seen'], day)
+        entry['evidence'][source] = entry['evidence'].get(source, 0) + 1
+        self.dirty = True
+
+    def seen(self, sender, day):
+        """Move a known sender's last_posted forward to `day` (without extending how long they stay known)."""
+        entry = self.senders[sender]
+        if day > entry.get('last_posted', ''):
+            entry['last_posted'] = day
+            self.dirty = True
+
+    def forget(self, sender):
+        """Remove a sender wrongly flagged as spam."""
+        if self.senders.pop(sender, None) is not None:
+            self.dirty = True
+
+    def save(self):
+        """Write the registry to disk if it changed."""
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_json_atomic(self.path, {'group': self.group, 'senders': self.senders})
+        self.dirty = False
+
+
+_registries = {}
+
+def get_spam_registry(group):
+    """Return the process-wide spam registry for a group, loading it on first use."""
+    if group not in _registries:
+        _registries[group] = SpamRegistry(group)
+    return _registries[group]
+
+
+def classify_senders(messages, llm_check=None, classifier=None, registry=None):
+    """
+    Find the spam senders in a list of messages, asking the LLM only about senders the classifier is unsure of.
+
+    Parameters:
+    - messages (list): Message dicts with 'sender_username', 'text' (or 'message') and optionally 'timestamp'.
+    - llm_check (callable): Called with the messages of the unsure senders, returns the usernames it judges
+      to be spam (e.g. check_spam_with_openai). If None, unsure senders are not treated as spam.
+    - classifier (SpamClassifier): Classifier to use, defaults to a new SpamClassifier().
+    - registry (SpamRegistry): Known spam senders of the group (see SpamRegistry.is_known()). They are
+      reported as spam without being classified again, and new verdicts are recorded in it.
+
+    Returns:
+    - list: Usernames classified as spam.
+    """
+    if classifier is None:
+        classifier = SpamClassifier()
+
+    known = set()
+    last_day = {}
+    for entry in messages:
+        sender = entry['sender_username']
+        if registry is not None and registry.is_known(sender, message_day(entry.get('timestamp'))):
+            known.add(sender)
+            continue
+        classifier.add(sender, entry.get('text', entry.get('message')), entry.get('timestamp'))
+        last_day[sender] = message_day(entry.get('timestamp'))
+
+    verdicts = classifier.classify()
+    spam = {sender for sender, (verdict, _) in verdicts.items() if verdict == 'spam'}
+    unsure = {sender for sender, (verdict, _) in verdicts.items() if verdict == 'unsure'}
+    print(f"Spam classifier: {len(known)} known, {len(spam)} spam, {len(unsure)} unsure, "
+          f"{len(verdicts) - len(spam) - len(unsure)} regular senders.")
+
+    llm_spam = set()
+    if unsure and llm_check is not None:
+        unsure_messages = [entry for entry in messages if entry['sender_username'] in unsure]
+        llm_spam = {username for username in llm_check(unsure_messages) if username in unsure}
+
+    if registry is not None:
+        for sender in spam:
+            registry.record(sender, 'heuristic', last_day[sender])
+        for sender in llm_spam:
+            registry.record(sender, 'llm', last_day[sender])
+        registry.save()
+
+    return sorted(known | spam | llm_spam)
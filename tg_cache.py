@@ -0,0 +1,220 @@
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+from telethon import utils
+from telethon.tl.types import User, InputPeerChannel, InputPeerChat, InputPeerUser
+
+from tg_ratelimit import get_rate_limiter
+
+
+SENDER_TTL = 7 * 24 * 3600  # Usernames change rarely, refresh weekly
+ENTITY_TTL = 30 * 24 * 3600  # Access hashes are stable per account, refresh monthly
+
+
+_stores = {}
+
+def open_cache_store(path):
+    """
+    Return the process-wide (connection, sender LRU) of a cache file, opening it on first use.
+
+    Senders look the same from every account, so all accounts share one connection and one in-memory
+    sender table. Separate connections would each hold their pending sender writes in an open
+    transaction and lock the others out of the file until they flush.
+    """
+    if path not in _stores:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(path)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS senders "
+            "(id INTEGER PRIMARY KEY, username TEXT, is_bot INTEGER, fetched_at REAL)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS entities "
+            "(account TEXT, name TEXT, kind TEXT, id INTEGER, access_hash INTEGER, fetched_at REAL, "
+            "PRIMARY KEY (account, name))"
+        )
+        db.commit()
+        _stores[path] = (db, OrderedDict())
+    return _stores[path]
+
+
+class TelegramEntityCache:
+    """
+    Two-level cache of resolved Telegram senders and group entities.
+
+    The first level is an in-process LRU, the second a SQLite file on disk so that
+    resolutions survive between runs. Entries older than their TTL are refetched.
+    Senders are shared by all accounts using the same file (see open_cache_store()),
+    group entities are kept per account.
+
+    Parameters:
+    - path (str): Location of the SQLite cache file.
+    - account (str): Name of the Telegram account/session. Access hashes are only valid
+      for the account that resolved them, so entities are stored per account.
+    - max_entries (int): Maximum number of senders/entities held in memory.
+    - sender_ttl (int): Seconds before a cached sender is refreshed.
+    - entity_ttl (int): Seconds before a cached group entity is refreshed.
+    - limiter (TelegramRateLimiter): Rate limiter used for lookups that go to Telegram, or None.
+    """
+
+    def __init__(
+        self,
+        path=os.path.join('tg', 'telegram_cache.sqlite'),
+        account='session_name',
+        max_entries=20000,
+        sender_ttl=SENDER_TTL,
+        entity_ttl=ENTITY_TTL,
+        limiter=None
+    ):
+        self.path = path
+        self.account = account
+        self.max_entries = max_entries
+        self.sender_ttl = sender_ttl
+        self.entity_ttl = entity_ttl
+        self.limiter = limiter
+        self.hits = 0
+        self.misses = 0
+
+        self._db, self._senders = open_cache_store(path)
+        self._entities = OrderedDict()
+
+    def _remember(self, table, key, value):
+        table[key] = value
+        table.move_to_end(key)
+        if len(table) > self.max_entries:
+            table.popitem(last=False)
+
+    def get_sender(self, sender_id):
+        """Return the cached (username, is_bot) for a sender id, or None if unknown or stale."""
+        entry = self._senders.get(sender_id)
+        if entry is None:
+            row = self._db.execute(
+                "SELECT username, is_bot, fetched_at FROM senders WHERE id = ?", (sender_id,)
+            ).fetchone()
+            if row is not None:
+                entry = (row[0], bool(row[1]), row[2])
+
+        if entry is None or time.time() - entry[2] > self.sender_ttl:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._remember(self._senders, sender_id, entry)
+        return entry[0], entry[1]
+
+    def put_sender(self, sender_id, username, is_bot):
+        """Store a resolved sender in memory and on disk."""
+        entry = (username, bool(is_bot), time.time())
+        self._remember(self._senders, sender_id, entry)
+        self._db.execute(
+            "INSERT OR REPLACE INTO senders (id, username, is_bot, fetched_at) VALUES (?, ?, ?, ?)",
+            (sender_id, entry[0], int(entry[1]), entry[2])
+        )
+
+    async def resolve_sender(self, message):
+        """
+        Resolve the sender of a Telethon message to (username, is_bot), hitting Telegram only on a cache miss.
+
+        The username is the sender's @username, or 'id_<id>' if they have none, or 'null' if unknown.
+        """
+        sender_id = message.sender_id
+        if sender_id is not None:
+            cached = self.get_sender(sender_id)
+            if cached is not None:
+                return cached
+
+        sender = message.sender
+        if sender is None:
+            if self.limiter is not None:
+                sender = await self.limiter.call(message.get_sender, method='get_sender')
+            else:
+                sender = await message.get_sender()
+
+        try:
+            sender_username = sender.username if sender.username else f"id_{sender.id}"
+        except:
+            sender_username = "null"
+        is_bot = isinstance(sender, User) and bool(sender.bot)
+
+        if sender_id is not None and sender is not None:
+            self.put_sender(sender_id, sender_username, is_bot)
+
+        return sender_username, is_bot
+
+    async def resolve_entity(self, tg_client, name):
+        """
+        Resolve a group username or t.me link to an input peer, reusing the cached id and access hash.
+
+        Parameters:
+        - tg_client: The TelegramClient instance to use on a cache miss.
+        - name (str): Telegram group username or link, as stored in coins.ini.
+        """
+        entry = self._entities.get(name)
+        if entry is None:
+            row = self._db.execute(
+                "SELECT kind, id, access_hash, fetched_at FROM entities WHERE account = ? AND name = ?",
+                (self.account, name)
+            ).fetchone()
+            if row is not None:
+                entry = tuple(row)
+
+        if entry is not None and time.time() - entry[3] <= self.entity_ttl:
+            self.hits += 1
+            self._remember(self._entities, name, entry)
+            kind, entity_id, access_hash, _ = entry
+            if kind == 'channel':
+                return InputPeerChannel(entity_id, access_hash)
+            if kind == 'chat':
+                return InputPeerChat(entity_id)
+            return InputPeerUser(entity_id, access_hash)
+
+        self.misses += 1
+        if self.limiter is not None:
+            entity = await self.limiter.call(tg_client.get_entity, name, method='get_entity')
+        else:
+            entity = await tg_client.get_entity(name)
+        peer = utils.get_input_peer(entity)
+
+        if isinstance(peer, InputPeerChannel):
+            entry = ('channel', peer.channel_id, peer.access_hash, time.time())
+        elif isinstance(peer, InputPeerChat):
+            entry = ('chat', peer.chat_id, None, time.time())
+        elif isinstance(peer, InputPeerUser):
+            entry = ('user', peer.user_id, peer.access_hash, time.time())
+        else:
+            return peer
+
+        self._remember(self._entities, name, entry)
+        self._db.execute(
+            "INSERT OR REPLACE INTO entities (account, name, kind, id, access_hash, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (self.account, name) + entry
+        )
+        self._db.commit()
+        return peer
+
+    def flush(self):
+        """Commit pending sender writes to disk."""
+        self._db.commit()
+
+    def stats(self):
+        """Return hit/miss counters for reporting."""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0
+        }
+
+
+_caches = {}
+
+def get_entity_cache(account='session_name'):
+    """Return the process-wide cache for an account (rate limited by its account limiter), creating it on first use."""
+    if account not in _caches:
+        _caches[account] = TelegramEntityCache(account=account, limiter=get_rate_limiter(account))
+    return _caches[account]
@@ -0,0 +1,154 @@
+import asyncio
+import configparser
+import os
+import time
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+
+from tg_cache import get_entity_cache
+from tg_ratelimit import get_rate_limiter
+
+
+def load_telegram_accounts(accounts_file='telegram_accounts.ini', default_account=None):
+    """
+    Load the Telegram accounts available for scraping.
+
+    Each section of the accounts file is one account; the section name doubles as the session file name:
+
+        [scraper1]
+        api_id = 123456
+        api_hash = 0123456789abcdef
+        phone = +15550000000
+        max_concurrency = 4
+
+    Parameters:
+    - accounts_file (str): Path to the accounts INI file.
+    - default_account (dict): Account used when the file does not exist, normally the one built from
+      the TELEGRAM_* environment variables.
+
+    Returns:
+    - list: One dict per account with 'name', 'api_id', 'api_hash', 'phone' and 'max_concurrency'.
+    """
+    if not os.path.exists(accounts_file):
+        return [default_account] if default_account else []
+
+    config = configparser.ConfigParser()
+    config.read(accounts_file)
+
+    accounts = []
+    for name in config.sections():
+        section = config[name]
+        if not section.get('api_id') or not section.get('api_hash'):
+            print(f"Skipping account '{name}' in {accounts_file}: api_id or api_hash missing.")
+            continue
+        accounts.append({
+            'name': name,
+            'api_id': int(section.get('api_id')),
+            'api_hash': section.get('api_hash'),
+            'phone': section.get('phone'),
+            'max_concurrency': section.getint('max_concurrency', fallback=4)
+        })
+
+    return accounts
+
+
+class TelegramSession:
+    """A connected account in the pool, with its own rate limiter and entity cache."""
+
+    def __init__(self, account):
+        self.name = account['name']
+        self.account = account
+        self.client = TelegramClient(account['name'], account['api_id'], account['api_hash'])
+        self.limiter = get_rate_limiter(account['name'])
+        self.cache = get_entity_cache(account['name'])
+        self.max_concurrency = account.get('max_concurrency', 4)
+        self.jobs_done = 0
+        self.handoffs = 0
+
+
+class TelegramSessionPool:
+    """
+    Pool of Telegram accounts that share one queue of jobs.
+
+    Every account runs up to max_concurrency workers. A worker only takes the next job while its
+    account has spare rate budget, so idle or fast accounts naturally pick up more of the work.
+    A job that hits a FloodWaitError is put back on the queue for another account while the
+    flooded account waits it out.
+
+    Parameters:
+    - accounts (list): Account dicts as returned by load_telegram_accounts().
+    """
+
+    def __init__(self, accounts):
+        if not accounts:
+            raise ValueError("No Telegram accounts configured.")
+        self.sessions = [TelegramSession(account) for account in accounts]
+
+    async def __aenter__(self):
+        for session in self.sessions:
+            await session.client.start(phone=session.account.get('phone'))
+            print(f"Telegram client '{session.name}' started.")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        for session in self.sessions:
+            await session.client.disconnect()
+            print(f"Telegram client '{session.name}' disconnected.")
+
+    async def run(self, jobs, handle_job, poll_interval=0.5):
+        """
+        Run every job to completion across the pool.
+
+        Parameters:
+        - jobs (list): Job descriptions (any object); handle_job may update a job in place to record progress.
+        - handle_job (coroutine function): Called as handle_job(session, job). If it raises FloodWaitError
+          the job is re-queued for another account.
+        - poll_interval (float): Seconds a worker without spare budget waits before looking again.
+
+        Returns:
+        - list: (job, error) pairs for jobs that failed with an error other than a flood wait.
+        """
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+
+        pending = len(jobs)
+        failures = []
+        started = time.monotonic()
+
+        async def worker(session):
+            nonlocal pending
+            while pending > 0:
+                # Leave the job for another account while this one has no budget to spare
+                if session.limiter.spare_budget() < 1 or queue.empty():
+                    await asyncio.sleep(poll_interval)
+                    continue
+
+                job = queue.get_nowait()
+                try:
+                    await handle_job(session, job)
+                    session.jobs_done += 1
+                    pending -= 1
+                except FloodWaitError as e:
+                    session.handoffs += 1
+                    print(f"[{session.name}] Flood limited for {e.seconds}s, handing job back to the pool: {job}")
+                    queue.put_nowait(job)
+                except Exception as e:
+                    print(f"[{session.name}] Job failed: {job}: {e}")
+                    failures.append((job, e))
+                    pending -= 1
+
+        workers = [
+            worker(session)
+            for session in self.sessions
+            for _ in range(session.max_concurrency)
+        ]
+        await asyncio.gather(*workers)
+
+        print(f"\n--- Session pool summary ({round(time.monotonic() - started, 1)}s) ---")
+        for session in self.sessions:
+            print(f"{session.name}: jobs={session.jobs_done}, handoffs={session.handoffs}, "
+                  f"limiter={session.limiter.stats()}")
+
+        return failures
@@ -0,0 +1,152 @@
+import asyncio
+import random
+import time
+
+from telethon.errors import FloodWaitError
+
+
+MESSAGES_PER_REQUEST = 100  # iter_messages fetches history in pages of this size
+
+
+class TokenBucket:
+    """
+    Async token bucket. Callers wait (without blocking the event loop) until a token is available.
+
+    Parameters:
+    - rate (float): Tokens added per second.
+    - capacity (float): Maximum number of tokens, i.e. the allowed burst.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        """Return the number of tokens currently available."""
+        self._refill()
+        return self.tokens
+
+    async def acquire(self, tokens=1):
+        """Wait until `tokens` tokens are available and take them."""
+        while True:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class TelegramRateLimiter:
+    """
+    Rate limiter shared by every Telegram call made on one account.
+
+    Requests draw from a token bucket. When Telegram answers with a FloodWaitError the affected
+    method is paused for the requested number of seconds and the bucket rate is halved, then
+    recovered gradually as calls succeed again. All waiting is done with asyncio.sleep, so only
+    the task that hit the limit is suspended.
+
+    Parameters:
+    - account (str): Name of the Telegram account/session this limiter belongs to.
+    - rate (float): Sustained requests per second allowed on the account.
+    - capacity (float): Burst size of the token bucket.
+    - min_rate (float): Floor for the adaptive rate after repeated flood waits.
+    """
+
+    def __init__(self, account='session_name', rate=1.0, capacity=5, min_rate=0.05):
+        self.account = account
+        self.base_rate = rate
+        self.min_rate = min_rate
+        self.bucket = TokenBucket(rate, capacity)
+        self.blocked_until = {}  # method -> monotonic time the flood wait ends
+        self.flood_waits = 0
+        self.flood_seconds = 0
+        self.calls = 0
+
+    def is_flooded(self, method='default'):
+        """Return True while `method` is paused by a flood wait."""
+        return self.blocked_until.get(method, 0) > time.monotonic()
+
+    def spare_budget(self):
+        """Return the number of requests that can be made right now without waiting."""
+        if any(until > time.monotonic() for until in self.blocked_until.values()):
+            return 0
+        return self.bucket.available()
+
+    async def acquire(self, method='default'):
+        """Wait out any flood wait on `method`, then take a token from the account bucket."""
+        remaining = self.blocked_until.get(method, 0) - time.monotonic()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        await self.bucket.acquire()
+        self.calls += 1
+
+        # Recover towards the configured rate while calls are going through
+        if self.bucket.rate < self.base_rate:
+            self.bucket.rate = min(self.base_rate, self.bucket.rate * 1.05)
+
+    def record_flood(self, seconds, method='default'):
+        """
+        Record a FloodWaitError: pause `method` for the requested time and halve the account rate.
+
+        Parameters:
+        - seconds (int): The wait Telegram asked for (FloodWaitError.seconds).
+        - method (str): The call that was flood limited.
+
+        Returns:
+        - float: Seconds until the method may be called again.
+        """
+        self.flood_waits += 1
+        self.flood_seconds += seconds
+        self.bucket.rate = max(self.min_rate, self.bucket.rate / 2)
+
+        wait = seconds + random.uniform(0, 1)  # Small jitter so waiting tasks don't all resume at once
+        self.blocked_until[method] = max(self.blocked_until.get(method, 0), time.monotonic() + wait)
+        print(f"[{self.account}] FloodWait on '{method}': waiting {seconds}s, rate now {self.bucket.rate:.2f} req/s.")
+        return wait
+
+    async def flood_wait(self, seconds, method='default'):
+        """Record a FloodWaitError and suspend the calling task until it has passed."""
+        await asyncio.sleep(self.record_flood(seconds, method))
+
+    async def call(self, func, *args, method='default', max_retries=5, **kwargs):
+        """
+        Await func(*args, **kwargs) under the rate limit, retrying after flood waits.
+
+        Parameters:
+        - func (coroutine function): The Telegram call, e.g. tg_client.get_entity.
+        - method (str): Name used to track flood waits for this kind of call.
+        - max_retries (int): Flood waits tolerated before the error is raised to the caller.
+        """
+        for attempt in range(max_retries + 1):
+            await self.acquire(method)
+            try:
+                return await func(*args, **kwargs)
+            except FloodWaitError as e:
+                if attempt == max_retries:
+                    raise
+                await self.flood_wait(e.seconds, method)
+
+    def stats(self):
+        """Return counters for reporting."""
+        return {
+            'calls': self.calls,
+            'flood_waits': self.flood_waits,
+            'flood_seconds': self.flood_seconds,
+            'rate': round(self.bucket.rate, 3)
+        }
+
+
+_limiters = {}
+
+def get_rate_limiter(account='session_name'):
+    """Return the process-wide rate limiter for an account, creating it on first use."""
+    if account not in _limiters:
+        _limiters[account] = TelegramRateLimiter(account=account)
+    return _limiters[account]
@@ -4,10 +4,10 @@ from telethon.errors import FloodWaitError
 from telethon.tl.types import User, Channel
 from datetime import datetime
 import asyncio
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import os
 from dotenv import load_dotenv
-from prompt import ChatLogAnalysisResponse, CommunityMetrics
+from prompt import ChatLogAnalysisResponse, PackedChatLogAnalysisResponse, CommunityMetrics
 import tiktoken
 import json
 from datetime import datetime, timedelta, timezone
@@ -15,8 +15,23 @@ import time
 import configparser
 from collections import Counter
 import re
+import copy
+from contextlib import asynccontextmanager
 from prompt import __version__
 from price import fetch_price_data
+from tg_cache import get_entity_cache
+from tg_ratelimit import get_rate_limiter, MESSAGES_PER_REQUEST
+from tg_pool import load_telegram_accounts, TelegramSessionPool
+from spam import SpamClassifier, classify_senders, get_spam_registry
+from dedupe import NearDuplicateFilter, approximate_tokens
+from llm_payload import build_payload, build_packed_payload, pack_days, payload_savings, discussion_tokens, fit_discussions, TokenChunker, CHUNK_TOKEN_BUDGET, PAYLOAD_OVERHEAD_TOKENS, PACK_DAY_TOKENS, APPROXIMATE_TOKEN_MODEL
+from llm_cache import get_llm_cache
+from llm_standin import LLMStandIn
+from llm_analyzer import get_chat_log_analyzer
+from llm_ledger import get_llm_ledger, print_ledger_summary
+from llm_scheduler import get_llm_scheduler, estimate_request_tokens, COMPLETION_TOKENS_ESTIMATE, load_retry_queue, save_retry_queue
+from llm_batch import BATCH_DIR, BATCH_PRICE_DISCOUNT, OpenAIBatchBackend, LocalBatchBackend, batch_request, write_batch_file, parse_batch_results, save_batch_state, load_batch_state, wait_for_batch
+from tg_store import load_sync_state, save_sync_state, TelegramDayLog, DayMessageBuffer, load_discussions, load_manifest, manifest_input_file, output_key, record_manifest_output, write_json_atomic
 
 
 
@@ -31,21 +46,47 @@ try:
     phone = os.getenv('TELEGRAM_PHONE')
     openai_api_key = os.getenv('OPENAI_API_KEY')
     openai_version = os.getenv('OPENAI_VERSION') #version of the LLM to use
-
-    client = OpenAI(api_key=openai_api_key)
+    tg_max_concurrency = int(os.getenv('TELEGRAM_MAX_CONCURRENCY', '4')) #groups fetched at once per account
+    llm_max_concurrency = int(os.getenv('OPENAI_MAX_CONCURRENCY', '8')) #LLM requests in flight at once
+    openai_rpm = int(os.getenv('OPENAI_RPM', '500')) #requests per minute allowed on the OpenAI account
+    openai_tpm = int(os.getenv('OPENAI_TPM', '200000')) #tokens per minute allowed on the OpenAI account
+    llm_standin_mode = os.getenv('OPENAI_STANDIN') #'synthetic', 'replay' or 'record' to run against llm_standin.py
 
     # Check for missing environment variables
     required_vars = {
         'TELEGRAM_API_ID': api_id,
         'TELEGRAM_API_HASH': api_hash,
-        'TELEGRAM_PHONE': phone,
-        'OPENAI_API_KEY': openai_api_key
+        'TELEGRAM_PHONE': phone
     }
+    if llm_standin_mode in (None, 'record'):
+        required_vars['OPENAI_API_KEY'] = openai_api_key
 
     for var_name, var_value in required_vars.items():
         if not var_value:
             raise EnvironmentError(f"The environment variable {var_name} is missing.")
 
+    if llm_standin_mode:
+        # Offline runs: synthetic/replayed responses get their own cache and ledger, so they never
+        # answer or get billed as live requests
+        llm_standin = LLMStandIn(
+            llm_standin_mode,
+            latency=float(os.getenv('OPENAI_STANDIN_LATENCY', '1.0')), #seconds per response
+            rate_limit_rate=float(os.getenv('OPENAI_STANDIN_429_RATE', '0')), #fraction of requests answered with a 429
+            rpm=openai_rpm,
+            tpm=openai_tpm,
+            client=OpenAI(api_key=openai_api_key) if llm_standin_mode == 'record' else None,
+            async_client=AsyncOpenAI(api_key=openai_api_key) if llm_standin_mode == 'record' else None
+        )
+        client, async_client = llm_standin.clients()
+        if llm_standin_mode != 'record':
+            get_llm_cache(os.path.join('tg', 'llm_cache_standin.sqlite'))
+            get_llm_ledger(os.path.join('tg', 'llm_ledger_standin.jsonl'))
+        print(f"Using the LLM stand-in in {llm_standin_mode} mode.")
+    else:
+        llm_standin = None
+        client = OpenAI(api_key=openai_api_key)
+        async_client = AsyncOpenAI(api_key=openai_api_key)
+
     print("Environment variables loaded successfully.")
 
 except Exception as e:
@@ -117,6 +158,62 @@ def extract_metadata_socials_and_user_stats(data):
     return result
 
 
+@asynccontextmanager
+async def telegram_session(tg_client=None):
+    """
+    Yield a connected TelegramClient. If tg_client is given it is reused as-is (and left open),
+    otherwise a new client is started for the duration of the block.
+
+    Parameters:
+    - tg_client: An already connected TelegramClient instance, or None.
+    """
+    if tg_client is not None:
+        yield tg_client
+        return
+
+    async with TelegramClient('session_name', api_id, api_hash) as tg_client:
+        print("Telegram client started.")
+        yield tg_client
+    print("Telegram client disconnected.")
+
+_token_encoding = None
+
+def token_encoding():
+    """Return the tokenizer of the configured OpenAI model, loading it on first use, or None if it cannot be loaded."""
+    global _token_encoding
+    if _token_encoding is None:
+        try:
+            _token_encoding = tiktoken.encoding_for_model(openai_version)
+        except Exception as e:
+            print(f"Error getting encoding for model '{openai_version}', estimating token counts instead: {e}")
+            _token_encoding = False
+    return _token_encoding or None
+
+def count_tokens(text):
+    """
+    Count the LLM tokens in text with the tokenizer of the configured OpenAI model, or estimate them
+    if the tokenizer cannot be loaded.
+
+    Special-token strings such as '<|endoftext|>' in a message count as plain text, the same as in
+    ChatLogAnalyzer.token_counts().
+    """
+    encoding = token_encoding()
+    if encoding is None:
+        return approximate_tokens(text)
+    return len(encoding.encode_ordinary(text))
+
+def token_count_model():
+    """
+    Return the model count_tokens() counts for, recorded with the counts in the manifest, or
+    APPROXIMATE_TOKEN_MODEL when it only estimates them, so estimates are never reused as exact counts.
+    """
+    return openai_version if token_encoding() is not None else APPROXIMATE_TOKEN_MODEL
+
+def report_duplicates(group, day, stats):
+    """Print how much the near-duplicate filter saved on a day."""
+    if stats and stats['duplicates']:
+        print(f"[{group}] {day.strftime('%Y-%m-%d')}: collapsed {stats['duplicates']} near-duplicate messages, "
+              f"saving {stats['bytes_saved']} bytes / {stats['tokens_saved']} tokens.")
 
 async def fetch_telegram_messages(
     tg_client,
@@ -124,7 +221,12 @@ async def fetch_telegram_messages(
     username,
     date_offset,
     max_filtered_filesize=150 * 1024,  # Default to 150 KB
-    n=25  # For logging every nth message
+    n=25,  # For logging every nth message
+    cache=None,
+    spam_classifier=None,
+    dedupe_filter=None,
+    spam_registry=None,
+    max_filtered_tokens=None
 ):
     """
     Fetch text messages from a Telegram group starting from a specific date until constraints are met.
@@ -136,16 +238,34 @@ async def fetch_telegram_messages(
     - date_offset (datetime): The date from which to start fetching messages.
     - max_filtered_filesize (int): Maximum size of filtered messages in bytes.
     - n (int): Print metadata every nth message.
+    - cache (TelegramEntityCache): Sender/entity cache. Defaults to the process-wide cache.
+    - spam_classifier (SpamClassifier): Scores senders as the messages stream in; senders it classifies
+      as spam are left out of the filtered log. Defaults to a new SpamClassifier().
+    - dedupe_filter (NearDuplicateFilter): Collapses near-duplicate messages into the earlier filtered message,
+      counted in its 'repeats'. Defaults to a new NearDuplicateFilter().
+    - spam_registry (SpamRegistry): Known spam/bot senders of the group, dropped from the filtered log before
+      any other check. Bots and senders the classifier flags are added to it. Defaults to the group's registry.
+    - max_filtered_tokens (int): If set, stop once the filtered messages reach this many tokens of the analysis
+      model instead of max_filtered_filesize bytes.
 
     Returns:
     - message_log_raw: List of dictionaries containing raw messages.
-    - message_log_filtered: List of dictionaries containing filtered messages.
+    - message_log_filtered: List of dictionaries containing filtered messages, each with its LLM payload 'tokens'.
     """
 
     print("Fetching messages from group:", username)
-    
+
+    if cache is None:
+        cache = get_entity_cache()
+    if spam_classifier is None:
+        spam_classifier = SpamClassifier()
+    if dedupe_filter is None:
+        dedupe_filter = NearDuplicateFilter(count_tokens=count_tokens)
+    if spam_registry is None:
+        spam_registry = get_spam_registry(group)
+
     try:
-        channel = await tg_client.get_entity(username)
+        channel = await cache.resolve_entity(tg_client, username)
         print(f"Successfully obtained entity for {username}")
     except Exception as e:
         print(f"Error getting Telegram entity for '{username}': {e}")
@@ -155,7 +275,8 @@ async def fetch_telegram_messages(
     message_log_filtered = []
     total_messages = 0
     filtered_messages_size = 0  # Accumulated size of filtered messages in bytes
-    previous_message_text = None  # For duplicate message checking in filtered output
+    filtered_tokens = 0  # Accumulated LLM payload tokens of filtered messages
+    filtered_by_id = {}  # Filtered entries by message id, for counting repeats
     last_message_id = None  # Keep track of the last message ID
 
     # Set date boundaries
@@ -170,22 +291,32 @@ async def fetch_telegram_messages(
 
     print(f"Retrieving messages starting from {start_date} until {end_date}...")
 
-    delay_between_requests = 0  # Adjust this value as needed (in seconds)
+    limiter = get_rate_limiter()
 
     last_message_id = 0  # Initialize to 0 to avoid NoneType issues
 
     while True:
         try:
+            # Take a rate limit token per page of history requested from Telegram
+            await limiter.acquire('iter_messages')
+            fetched_in_pass = 0
+
             async for message in tg_client.iter_messages(
                 channel,
                 reverse=True,
                 offset_date=start_date,
                 min_id=last_message_id,  # Start from the last message ID
             ):
+                fetched_in_pass += 1
+                if fetched_in_pass % MESSAGES_PER_REQUEST == 0:
+                    await limiter.acquire('iter_messages')
+
                 message_date = message.date
 
                 if message_date >= end_date:
                     print("Reached the end of the day.")
+                    cache.flush()
+                    spam_registry.save()
                     return message_log_raw, message_log_filtered
 
                 if message_date < start_date:
@@ -194,13 +325,8 @@ async def fetch_telegram_messages(
                 total_messages += 1  # Track total number of messages fetched
 
                 if message.message:
-                    sender = await message.get_sender()
-
-                    # Extract sender username
-                    try:
-                        sender_username = sender.username if sender.username else f"id_{sender.id}"
-                    except:
-                        sender_username = "null"
+                    # Resolve sender username and bot flag, from the cache where possible
+                    sender_username, is_bot = await cache.resolve_sender(message)
 
                     # Every nth message, print out some metadata
                     if total_messages % n == 0:
@@ -220,49 +346,63 @@ async def fetch_telegram_messages(
                     message_log_raw.append(message_entry)
 
                     # For filtered output, apply filters:
-                    # - Skip messages from bots
-                    # - Skip duplicate messages (same as previous message)
-                    try:
-                        is_bot = isinstance(sender, User) and sender.bot
-                        if is_bot:
-                            continue  # Skip bots in filtered output
-                        if previous_message_text is not None and text == previous_message_text:
-                            continue  # Skip duplicate messages in filtered output
-                    except Exception as e:
-                        pass  # Handle exception silently
-
-                    # If passes filters, add to filtered log
-                    message_log_filtered.append(message_entry)
-
-                    # Update previous message text
-                    previous_message_text = text
+                    # - Skip known spam/bot senders of the group straight away
+                    # - Skip messages from bots and senders scored as spam
+                    # - Skip near-duplicates of recent messages, counting them as repeats of the first one
+                    day_str = timestamp[:10]
+                    if spam_registry.is_known(sender_username, day_str):
+                        spam_registry.seen(sender_username, day_str)
+                        continue
+
+                    spam_classifier.add(sender_username, text, message_date, is_bot)
+                    if is_bot:
+                        spam_registry.record(sender_username, 'bot', day_str)
+                        continue  # Skip bots in filtered output
+                    if spam_classifier.is_spam(sender_username):
+                        spam_registry.record(sender_username, 'heuristic', day_str)
+                        continue
 
                     # Calculate the size of the message entry when formatted
                     formatted_message_entry = f"Date:{timestamp}\nUsr:@{sender_username}\nMsg:{text}\n--\n"
                     message_entry_size = len(formatted_message_entry.encode('utf-8'))
+
+                    repeat_of = dedupe_filter.check(text, message.id, message_entry_size)
+                    if repeat_of is not None:
+                        original = filtered_by_id[repeat_of]
+                        original['repeats'] = original.get('repeats', 0) + 1
+                        continue  # Skip duplicate messages in filtered output
+
+                    # If passes filters, add to filtered log
+                    message_entry['tokens'] = discussion_tokens(
+                        {'date': timestamp, 'user': sender_username, 'message': text}, count_tokens
+                    )
+                    message_log_filtered.append(message_entry)
+                    filtered_by_id[message.id] = message_entry
                     filtered_messages_size += message_entry_size
+                    filtered_tokens += message_entry['tokens']
 
-                    if filtered_messages_size >= max_filtered_filesize:
+                    if max_filtered_tokens is not None and filtered_tokens >= max_filtered_tokens:
+                        print("Reached maximum filtered token count.")
+                        cache.flush()
+                        spam_registry.save()
+                        return message_log_raw, message_log_filtered
+                    if max_filtered_tokens is None and filtered_messages_size >= max_filtered_filesize:
                         print("Reached maximum filtered file size.")
+                        cache.flush()
+                        spam_registry.save()
                         return message_log_raw, message_log_filtered
 
                     # Update last_message_id to resume later if needed
                     last_message_id = message.id
 
-                    # Optional: Add a small delay between processing messages to avoid rate limits
-                    await asyncio.sleep(delay_between_requests)
-
             # If the loop completes without hitting the end date or size limit, break
             break
 
         except FloodWaitError as e:
             print(f"FloodWaitError: Telegram is asking you to wait for {e.seconds} seconds.")
-            # Wait for the required amount of time
-            for remaining in range(e.seconds, 0, -1):
-                sys.stdout.write(f"\rWaiting for {remaining} seconds...")
-                sys.stdout.flush()
-                time.sleep(1)
-            print("\nResuming message retrieval...")
+            # Suspend only this task; other groups keep fetching while we wait
+            await limiter.flood_wait(e.seconds, 'iter_messages')
+            print("Resuming message retrieval...")
             # After waiting, the loop will restart and continue fetching messages
 
         # except Exception as e:
@@ -272,16 +412,240 @@ async def fetch_telegram_messages(
 
     print(f"Total messages fetched: {total_messages}")
     print(f"Messages after filtering: {len(message_log_filtered)}")
+    report_duplicates(group, start_date, dedupe_filter.stats)
+    print(f"Sender/entity cache: {cache.stats()}")
 
+    cache.flush()
+    spam_registry.save()
     return message_log_raw, message_log_filtered
 
+async def fetch_telegram_messages_by_day(
+    tg_client,
+    group,
+    username,
+    date_start,
+    date_end,
+    max_filtered_filesize=150 * 1024,  # Default to 150 KB per day
+    n=25,  # For logging every nth message
+    cache=None,
+    limiter=None,
+    flood_handoff_seconds=None,
+    min_id=0,
+    open_day=DayMessageBuffer,
+    spam_classifier=None,
+    dedupe_filter=None,
+    spam_registry=None,
+    max_filtered_tokens=None
+):
+    """
+    Stream messages for a whole date range in one pass over iter_messages, splitting them into
+    per-day buckets. Each day is yielded as soon as the stream crosses its end boundary, so every
+    message is fetched exactly once no matter how many days are requested.
+
+    Messages are handed to a day log as they arrive. With open_day=TelegramDayLog-style writers they go
+    straight to disk, so memory stays flat however busy the day is. The caller must commit() or
+    discard() each yielded day log.
+
+    Parameters:
+    - tg_client: The TelegramClient instance to use.
+    - group (str): Name of the group.
+    - username (str): Telegram group username or link.
+    - date_start (datetime): First day of the range.
+    - date_end (datetime): Last day of the range (inclusive).
+    - max_filtered_filesize (int): Maximum size of filtered messages per day in bytes. Once a day
+      reaches it, later messages of that day are kept in the raw log only.
+    - n (int): Print metadata every nth message.
+    - cache (TelegramEntityCache): Sender/entity cache. Defaults to the process-wide cache.
+    - limiter (TelegramRateLimiter): Rate limiter for the account. Defaults to the process-wide limiter.
+    - flood_handoff_seconds (int): If set, a FloodWaitError of at least this many seconds is recorded on
+      the limiter and re-raised instead of waited out, so a session pool can move the work elsewhere.
+    - min_id (int): Only return messages with a Telegram id greater than this (for incremental syncs).
+    - open_day (callable): Called with each day to create its day log (default keeps lists in memory). If the
+      first day's log has a resume_id (see TelegramDayLog), the stream starts after that id.
+    - spam_classifier (SpamClassifier): Scores senders as the messages stream in; once a sender is
+      classified as spam their later messages are left out of the filtered log. Defaults to a new
+      SpamClassifier() for the range.
+    - dedupe_filter (NearDuplicateFilter): Collapses near-duplicate messages into the earlier filtered message
+      as a repeat count. Reset for every day; its stats are left on the day log as day_log.dedupe.
+      Defaults to a new NearDuplicateFilter().
+    - spam_registry (SpamRegistry): Known spam/bot senders of the group, dropped from the filtered log before
+      any other check. Bots and senders the classifier flags are added to it. Defaults to the group's registry.
+    - max_filtered_tokens (int): If set, the daily cap on filtered messages is this many tokens of the analysis
+      model instead of max_filtered_filesize bytes.
+
+    Every filtered message entry carries its LLM payload token count as 'tokens', so day logs can cut the day
+    into analysis chunks without encoding it again.
+
+    Yields:
+    - (day, day_log) for every day in the range, including empty days.
+    """
+
+    print(f"[{group}] Fetching messages from group: {username}")
+
+    if cache is None:
+        cache = get_entity_cache()
+    if limiter is None:
+        limiter = get_rate_limiter()
+    if spam_classifier is None:
+        spam_classifier = SpamClassifier()
+    if dedupe_filter is None:
+        dedupe_filter = NearDuplicateFilter(count_tokens=count_tokens)
+    if spam_registry is None:
+        spam_registry = get_spam_registry(group)
+
+    # Ensure the boundaries are timezone-aware in UTC
+    if date_start.tzinfo is None:
+        date_start = date_start.replace(tzinfo=timezone.utc)
+    if date_end.tzinfo is None:
+        date_end = date_end.replace(tzinfo=timezone.utc)
+    range_end = date_end + timedelta(days=1)
+
+    try:
+        channel = await cache.resolve_entity(tg_client, username)
+        print(f"[{group}] Successfully obtained entity for {username}")
+    except Exception as e:
+        print(f"[{group}] Error getting Telegram entity for '{username}': {e}")
+        return
+
+    print(f"[{group}] Retrieving messages starting from {date_start} until {range_end}...")
+
+    # State of the day bucket currently being filled
+    day = date_start
+    day_log = open_day(day)
+    filtered_messages_size = 0
+    filtered_tokens = 0
+
+    total_messages = 0
+    last_message_id = min_id  # Resume point after a flood wait
+    # A day log continuing an interrupted run already holds the first day's messages up to its resume_id
+    last_message_id = max(last_message_id, getattr(day_log, 'resume_id', 0))
+
+    while True:
+        try:
+            # Take a rate limit token per page of history requested from Telegram
+            await limiter.acquire('iter_messages')
+            fetched_in_pass = 0
+
+            async for message in tg_client.iter_messages(
+                channel,
+                reverse=True,
+                offset_date=date_start,
+                min_id=last_message_id,
+            ):
+                fetched_in_pass += 1
+                if fetched_in_pass % MESSAGES_PER_REQUEST == 0:
+                    await limiter.acquire('iter_messages')
+
+                message_date = message.date
+                last_message_id = message.id
+
+                if message_date < date_start:
+                    continue  # Skip messages before the start date (shouldn't happen)
+
+                if message_date >= range_end:
+                    break
+
+                # Flush every day whose boundary the stream has now crossed
+                while message_date >= day + timedelta(days=1):
+                    day_log.dedupe = dedupe_filter.reset()
+                    report_duplicates(group, day, day_log.dedupe)
+                    spam_registry.save()
+                    yield day, day_log
+                    day += timedelta(days=1)
+                    day_log = open_day(day)
+                    filtered_messages_size = 0
+                    filtered_tokens = 0
+
+                total_messages += 1
+
+                if not message.message:
+                    continue
+
+                sender_username, is_bot = await cache.resolve_sender(message)
+
+                if total_messages % n == 0:
+                    print(f"[{group}] Pulling message #{total_messages}, date={message_date}, user={sender_username}")
+
+                text = message.message
+                message_entry = {
+                    'id': message.id,
+                    'timestamp': message_date.strftime('%Y-%m-%d %H:%M'),
+                    'sender_username': sender_username,
+                    'text': text
+                }
+
+                # Known spam/bot senders of the group are dropped before any other check
+                day_str = message_entry['timestamp'][:10]
+                if spam_registry.is_known(sender_username, day_str):
+                    spam_registry.seen(sender_username, day_str)
+                    day_log.add(message_entry, False)
+                    continue
+
+                spam_classifier.add(sender_username, text, message_date, is_bot)
+                if is_bot:
+                    spam_registry.record(sender_username, 'bot', day_str)
+                elif spam_classifier.is_spam(sender_username):
+                    spam_registry.record(sender_username, 'heuristic', day_str)
+
+                # Filtered output skips bots and spam senders, near-duplicates of recent messages (counted as
+                # repeats of the first one instead) and anything past the daily size cap
+                formatted_message_entry = f"Date:{message_entry['timestamp']}\nUsr:@{sender_username}\nMsg:{text}\n--\n"
+                message_entry_size = len(formatted_message_entry.encode('utf-8'))
+                if max_filtered_tokens is not None:
+                    over_cap = filtered_tokens >= max_filtered_tokens
+                else:
+                    over_cap = filtered_messages_size >= max_filtered_filesize
+                repeat_of = None
+                keep = not (
+                    is_bot
+                    or spam_classifier.is_spam(sender_username)
+                    or over_cap
+                )
+                if keep:
+                    repeat_of = dedupe_filter.check(text, message.id, message_entry_size)
+                    keep = repeat_of is None
+                if keep:
+                    message_entry['tokens'] = discussion_tokens(
+                        {'date': message_entry['timestamp'], 'user': sender_username, 'message': text}, count_tokens
+                    )
+                    filtered_messages_size += message_entry_size
+                    filtered_tokens += message_entry['tokens']
+                day_log.add(message_entry, keep, repeat_of)
+
+            # The stream is exhausted or past the end of the range
+            break
+
+        except FloodWaitError as e:
+            print(f"[{group}] FloodWaitError: Telegram is asking you to wait for {e.seconds} seconds.")
+            if flood_handoff_seconds is not None and e.seconds >= flood_handoff_seconds:
+                limiter.record_flood(e.seconds, 'iter_messages')
+                cache.flush()
+                spam_registry.save()
+                day_log.discard()
+                raise
+            await limiter.flood_wait(e.seconds, 'iter_messages')
+            print(f"[{group}] Resuming message retrieval after message id {last_message_id}...")
+
+    cache.flush()
+    spam_registry.save()
+    print(f"[{group}] Total messages fetched: {total_messages}, rate limiter: {limiter.stats()}")
+
+    # Flush the last partially filled day and any trailing empty days
+    while day < range_end:
+        day_log.dedupe = dedupe_filter.reset()
+        report_duplicates(group, day, day_log.dedupe)
+        yield day, day_log
+        day += timedelta(days=1)
+        day_log = open_day(day)
+
 async def fetch_telegram_messages_for_date_range(
     group,
     date_start,
     date_end,
     ini_file='coins.ini',
     ini_index='tg',  # New parameter for specifying the INI index (default to 'tg')
-    max_filtered_filesize=1024 * 1024  # Default to 1MB
+    max_filtered_filesize=1024 * 1024,  # Default to 1MB
+    tg_client=None
 ):
     """
     Fetch telegram messages for a date range, and save the chat histories into subdirectories.
@@ -293,6 +657,10 @@ async def fetch_telegram_messages_for_date_range(
     - ini_file (str): Path to the INI file for group info.
     - ini_index (str): The index in the INI file to reference for the username (default is 'tg').
     - max_filtered_filesize (int): Maximum size of filtered messages in bytes.
+    - tg_client: Optional shared TelegramClient. If None, a client is opened for this call.
+
+    Returns:
+    - dict: Totals for the group with the number of 'days' saved and 'raw'/'filtered' message counts.
     """
 
     # Load the INI file and retrieve the group information
@@ -307,22 +675,22 @@ async def fetch_telegram_messages_for_date_range(
     if not username:
         raise ValueError(f"'{ini_index}' for group '{group}' not found in {ini_file}")
 
-    async with TelegramClient('session_name', api_id, api_hash) as tg_client:
-        print("Telegram client started.")
+    totals = {'days': 0, 'raw': 0, 'filtered': 0}  # Per-group totals returned to the caller
 
-        current_date = date_start
+    async with telegram_session(tg_client) as tg_client:
 
-        while current_date <= date_end:
-            print(f"Fetching messages for date: {current_date.strftime('%Y-%m-%d')}")
-
-            message_log_raw, message_log_filtered = await fetch_telegram_messages(
-                tg_client,
-                group=group,
-                username=username,
-                date_offset=current_date,
-                max_filtered_filesize=max_filtered_filesize,
-                n=25
-            )
+        # One streaming pass over the whole range, yielding each day as it completes
+        async for current_date, day_log in fetch_telegram_messages_by_day(
+            tg_client,
+            group=group,
+            username=username,
+            date_start=date_start,
+            date_end=date_end,
+            max_filtered_filesize=max_filtered_filesize,
+            n=25
+        ):
+            print(f"Fetched messages for date: {current_date.strftime('%Y-%m-%d')}")
+            message_log_raw, message_log_filtered = day_log.raw, day_log.filtered
 
             timestamps = [datetime.strptime(entry['timestamp'], '%Y-%m-%d %H:%M') for entry in message_log_filtered]
 
@@ -378,11 +746,11 @@ async def fetch_telegram_messages_for_date_range(
                 except Exception as e:
                     print(f"Error writing to '{output_path_filtered}': {e}")
 
-                print("Pausing for 2 seconds...")
-                time.sleep(2)
+                totals['days'] += 1
+                totals['raw'] += total_messages_raw
+                totals['filtered'] += total_messages_filtered
 
-            current_date += timedelta(days=1)
-    print("Telegram client disconnected.")
+    return totals
 
 async def fetch_telegram_messages_for_date_range_json(
     group,
@@ -390,10 +758,12 @@ async def fetch_telegram_messages_for_date_range_json(
     date_end,
     ini_file='coins.ini',
     ini_index='tg',
-    max_filtered_filesize=1024 * 1024
+    max_filtered_filesize=1024 * 1024,
+    max_filtered_tokens=None,
+    tg_client=None
 ):
     """
-    Fetch telegram messages for a date range, and save the chat histories in JSON format.
+    Fetch telegram messages for a date range, and stream the chat histories to JSON lines files.
 
     Parameters:
     - group (str): Name of the group.
@@ -402,6 +772,12 @@ async def fetch_telegram_messages_for_date_range_json(
     - ini_file (str): Path to the INI file for group info.
     - ini_index (str): The index in the INI file to reference for the username (default is 'tg').
     - max_filtered_filesize (int): Maximum size of filtered messages in bytes.
+    - max_filtered_tokens (int): If set, cap the filtered messages per day at this many tokens of the analysis
+      model instead of max_filtered_filesize bytes.
+    - tg_client: Optional shared TelegramClient. If None, a client is opened for this call.
+
+    Returns:
+    - dict: Totals for the group with the number of 'days' saved and 'raw'/'filtered' message counts.
     """
 
     # Load the INI file and retrieve the group information
@@ -416,89 +792,34 @@ async def fetch_telegram_messages_for_date_range_json(
     if not username:
         raise ValueError(f"'{ini_index}' for group '{group}' not found in {ini_file}")
 
-    async with TelegramClient('session_name', api_id, api_hash) as tg_client:
-        print("Telegram client started.")
-
-        current_date = date_start
-
-        while current_date <= date_end:
-            print(f"Fetching messages for date: {current_date.strftime('%Y-%m-%d')}")
-
-            # Fetch messages for the current date
-            message_log_raw, message_log_filtered = await fetch_telegram_messages(
-                tg_client,
-                group=group,
-                username=username,
-                date_offset=current_date,
-                max_filtered_filesize=max_filtered_filesize,
-                n=25
-            )
-
-            # Process timestamps to get date ranges
-            timestamps = [datetime.strptime(entry['timestamp'], '%Y-%m-%d %H:%M') for entry in message_log_filtered]
-
-            if timestamps:
-                date_min = min(timestamps).strftime('%Y-%m-%d')
+    totals = {'days': 0, 'raw': 0, 'filtered': 0}  # Per-group totals returned to the caller
+
+    async with telegram_session(tg_client) as tg_client:
+
+        # One streaming pass over the whole range, yielding each day as it completes
+        async for current_date, day_log in fetch_telegram_messages_by_day(
+            tg_client,
+            group=group,
+            username=username,
+            date_start=date_start,
+            date_end=date_end,
+            max_filtered_filesize=max_filtered_filesize,
+            max_filtered_tokens=max_filtered_tokens,
+            n=25,
+            open_day=lambda day: TelegramDayLog(group, day, count_tokens=count_tokens, token_model=token_count_model())
+        ):
+            print(f"Fetched messages for date: {current_date.strftime('%Y-%m-%d')}")
+
+            if day_log.n_filtered > 4:
+                day_log.commit()
+
+                totals['days'] += 1
+                totals['raw'] += day_log.n_raw
+                totals['filtered'] += day_log.n_filtered
             else:
-                date_min = current_date.strftime('%Y-%m-%d')
-
-            total_messages_raw = len(message_log_raw)
-            total_messages_filtered = len(message_log_filtered)
-
-            if total_messages_filtered > 4:
-                # Format raw messages for JSON
-                discussions_raw = [
-                    {
-                        "date": entry['timestamp'],
-                        "user": entry['sender_username'],
-                        "message": entry['text']
-                    }
-                    for entry in message_log_raw
-                ]
-
-                # Format filtered messages for JSON
-                discussions_filtered = [
-                    {
-                        "date": entry['timestamp'],
-                        "user": entry['sender_username'],
-                        "message": entry['text']
-                    }
-                    for entry in message_log_filtered
-                ]
-
-                # Create the group directory if it doesn't exist
-                group_dir = os.path.join('tg', group, date_min)
-                os.makedirs(group_dir, exist_ok=True)
-
-                # Prepare the JSON output filenames, using only date_min (YYYY-MM-DD)
-                output_filename_raw = f"{group}_raw_{date_min}.json"
-                output_path_raw = os.path.join(group_dir, output_filename_raw)
-
-                output_filename_filtered = f"{group}_filtered_{date_min}.json"
-                output_path_filtered = os.path.join(group_dir, output_filename_filtered)
-
-                # Save the raw messages to a JSON file
-                try:
-                    with open(output_path_raw, 'w', encoding='utf-8') as f:
-                        json.dump({"discussions": discussions_raw}, f, indent=4, ensure_ascii=False)
-                    print(f"Raw Telegram messages saved to '{output_path_raw}'.")
-                except Exception as e:
-                    print(f"Error writing to '{output_path_raw}': {e}")
-
-                # Save the filtered messages to a JSON file
-                try:
-                    with open(output_path_filtered, 'w', encoding='utf-8') as f:
-                        json.dump({"discussions": discussions_filtered}, f, indent=4, ensure_ascii=False)
-                    print(f"Filtered Telegram messages saved to '{output_path_filtered}'.")
-                except Exception as e:
-                    print(f"Error writing to '{output_path_filtered}': {e}")
-
-                print("Pausing for 2 seconds...")
-                time.sleep(2)
+                day_log.discard()
 
-            current_date += timedelta(days=1)
-
-    print("Telegram client disconnected.")
+    return totals
 
 async def fetch_telegram_messages_for_date_range_fill_in_blanks_json(
     group,
@@ -506,12 +827,15 @@ async def fetch_telegram_messages_for_date_range_fill_in_blanks_json(
     date_end,
     ini_file='coins.ini',
     ini_index='tg',
-    max_filtered_filesize=1024 * 1024
+    max_filtered_filesize=1024 * 1024,
+    max_filtered_tokens=None,
+    tg_client=None
 ):
     """
     Fetch telegram messages for a date range, working backwards in 7-day batches,
-    and save the chat histories in JSON format. Skips dates where data already exists,
-    and stops if 5 out of 7 days have no new messages.
+    and stream the chat histories to JSON lines files. Skips dates where data already exists,
+    and stops if 5 out of 7 days have no new messages. Each run of consecutive missing days
+    in a batch is fetched in a single streaming pass.
 
     Parameters:
     - group (str): Name of the group.
@@ -520,6 +844,12 @@ async def fetch_telegram_messages_for_date_range_fill_in_blanks_json(
     - ini_file (str): Path to the INI file for group info.
     - ini_index (str): The index in the INI file to reference for the username (default is 'tg').
     - max_filtered_filesize (int): Maximum size of filtered messages in bytes.
+    - max_filtered_tokens (int): If set, cap the filtered messages per day at this many tokens of the analysis
+      model instead of max_filtered_filesize bytes.
+    - tg_client: Optional shared TelegramClient. If None, a client is opened for this call.
+
+    Returns:
+    - dict: Totals for the group with the number of 'days' saved and 'raw'/'filtered' message counts.
     """
 
     # Load the INI file and retrieve the group information
@@ -534,8 +864,10 @@ async def fetch_telegram_messages_for_date_range_fill_in_blanks_json(
     if not username:
         raise ValueError(f"'{ini_index}' for group '{group}' not found in {ini_file}")
 
-    async with TelegramClient('session_name', api_id, api_hash) as tg_client:
-        print("Telegram client started.")
+    totals = {'days': 0, 'raw': 0, 'filtered': 0}  # Per-group totals returned to the caller
+    saved_days = load_manifest(group)['days']
+
+    async with telegram_session(tg_client) as tg_client:
 
         current_date = date_end  # Start from the end date
         overall_start_date = date_start
@@ -550,143 +882,383 @@ async def fetch_telegram_messages_for_date_range_fill_in_blanks_json(
 
             print(f"\nProcessing batch from {batch_start_date.strftime('%Y-%m-%d')} to {batch_end_date.strftime('%Y-%m-%d')}")
 
-            # Iterate over each day in the batch
-            for day_offset in range((batch_end_date - batch_start_date).days + 1):
-                fetch_date = batch_end_date - timedelta(days=day_offset)
+            # Work out which days of the batch still need fetching
+            batch_dates = [batch_end_date - timedelta(days=day_offset)
+                           for day_offset in range((batch_end_date - batch_start_date).days + 1)]
+            missing_dates = []
+            for fetch_date in batch_dates:
                 fetch_date_str = fetch_date.strftime('%Y-%m-%d')
-                print(f"\nFetching messages for date: {fetch_date_str}")
-
-                # Check if data for this date already exists
-                group_dir = os.path.join('tg', group, fetch_date_str)
-                if os.path.exists(group_dir) and os.listdir(group_dir):
+                if saved_days.get(fetch_date_str, {}).get('files'):
                     print(f"Data for {fetch_date_str} already exists and is not empty. Skipping.")
                     continue
-
-                # Fetch messages for the current date
-                message_log_raw, message_log_filtered = await fetch_telegram_messages(
+                missing_dates.append(fetch_date)
+
+            if not missing_dates:
+                current_date = batch_start_date - timedelta(days=1)
+                continue
+
+            # Split the missing days (newest first) into runs of consecutive days, so days already on disk
+            # between them aren't fetched again
+            missing_runs = []
+            for fetch_date in missing_dates:
+                if missing_runs and (missing_runs[-1][0] - fetch_date).days == 1:
+                    missing_runs[-1][0] = fetch_date
+                else:
+                    missing_runs.append([fetch_date, fetch_date])
+
+            # Stream each run once, saving each day as it completes. Days are compared as 'YYYY-MM-DD'
+            # strings, since the batch dates and the yielded days needn't agree on a timezone
+            missing_date_strs = {fetch_date.strftime('%Y-%m-%d') for fetch_date in missing_dates}
+            empty_dates = set()
+            for run_start, run_end in reversed(missing_runs):
+                async for fetch_date, day_log in fetch_telegram_messages_by_day(
                     tg_client,
                     group=group,
                     username=username,
-                    date_offset=fetch_date,
+                    date_start=run_start,
+                    date_end=run_end,
                     max_filtered_filesize=max_filtered_filesize,
-                    n=25
-                )
-
-                total_messages_filtered = len(message_log_filtered)
-
-                if total_messages_filtered > 0:
-                    consecutive_empty_days = 0  # Reset consecutive empty days
-
-                    # Format raw messages for JSON
-                    discussions_raw = [
-                        {
-                            "date": entry['timestamp'],
-                            "user": entry['sender_username'],
-                            "message": entry['text']
-                        }
-                        for entry in message_log_raw
-                    ]
-
-                    # Format filtered messages for JSON
-                    discussions_filtered = [
-                        {
-                            "date": entry['timestamp'],
-                            "user": entry['sender_username'],
-                            "message": entry['text']
-                        }
-                        for entry in message_log_filtered
-                    ]
-
-                    # Create the group directory if it doesn't exist
-                    os.makedirs(group_dir, exist_ok=True)
-
-                    # Prepare the JSON output filenames
-                    output_filename_raw = f"{group}_raw_{fetch_date_str}.json"
-                    output_path_raw = os.path.join(group_dir, output_filename_raw)
-
-                    output_filename_filtered = f"{group}_filtered_{fetch_date_str}.json"
-                    output_path_filtered = os.path.join(group_dir, output_filename_filtered)
-
-                    # Save the raw messages to a JSON file
-                    try:
-                        with open(output_path_raw, 'w', encoding='utf-8') as f:
-                            json.dump({"discussions": discussions_raw}, f, indent=4, ensure_ascii=False)
-                        print(f"Raw Telegram messages saved to '{output_path_raw}'.")
-                    except Exception as e:
-                        print(f"Error writing to '{output_path_raw}': {e}")
-
-                    # Save the filtered messages to a JSON file
-                    try:
-                        with open(output_path_filtered, 'w', encoding='utf-8') as f:
-                            json.dump({"discussions": discussions_filtered}, f, indent=4, ensure_ascii=False)
-                        print(f"Filtered Telegram messages saved to '{output_path_filtered}'.")
-                    except Exception as e:
-                        print(f"Error writing to '{output_path_filtered}': {e}")
-
-                    print("Pausing for 2 seconds...")
-                    await asyncio.sleep(2)
-                else:
-                    print(f"No new messages found for {fetch_date_str}.")
+                    max_filtered_tokens=max_filtered_tokens,
+                    n=25,
+                    open_day=lambda day: TelegramDayLog(group, day, count_tokens=count_tokens, token_model=token_count_model())
+                ):
+                    fetch_date_str = fetch_date.strftime('%Y-%m-%d')
+                    if fetch_date_str not in missing_date_strs:
+                        day_log.discard()
+                        continue  # Already on disk
+
+                    if day_log.n_filtered > 0:
+                        day_log.commit()
+
+                        totals['days'] += 1
+                        totals['raw'] += day_log.n_raw
+                        totals['filtered'] += day_log.n_filtered
+                    else:
+                        day_log.discard()
+                        print(f"No new messages found for {fetch_date_str}.")
+                        empty_dates.add(fetch_date_str)
+
+            # Walk the batch backwards to check if we've hit 5 consecutive empty days
+            for fetch_date in missing_dates:
+                if fetch_date.strftime('%Y-%m-%d') in empty_dates:
                     consecutive_empty_days += 1
+                else:
+                    consecutive_empty_days = 0  # Reset consecutive empty days
 
-                # Check if we've hit 5 empty days out of the last 7
                 if consecutive_empty_days >= 5:
                     print(f"\nReached {consecutive_empty_days} consecutive empty days. Assuming beginning of chat logs. Ending execution.")
-                    return
+                    return totals
 
             # Move to the next batch
             current_date = batch_start_date - timedelta(days=1)
 
         print("Finished processing all batches.")
-    print("Telegram client disconnected.")
+
+    return totals
+
+async def sync_telegram_messages_json(
+    group,
+    date_start,
+    date_end=None,
+    ini_file='coins.ini',
+    ini_index='tg',
+    max_filtered_filesize=1024 * 1024,
+    max_filtered_tokens=None,
+    tg_client=None
+):
+    """
+    Incrementally sync a group: fetch only messages newer than the last one persisted and append them
+    to their day's JSON lines files. The newest message id and date are kept in tg/<group>/<group>_sync.json
+    and updated after every day written, so an interrupted sync resumes where it stopped.
+
+    Parameters:
+    - group (str): Name of the group.
+    - date_start (datetime): Where to start if the group has never been synced (timezone-aware in UTC).
+    - date_end (datetime): Last day to sync (inclusive). Defaults to today.
+    - ini_file (str): Path to the INI file for group info.
+    - ini_index (str): The index in the INI file to reference for the username (default is 'tg').
+    - max_filtered_filesize (int): Maximum size of filtered messages per day in bytes.
+    - max_filtered_tokens (int): If set, cap the filtered messages per day at this many tokens of the analysis
+      model instead of max_filtered_filesize bytes.
+    - tg_client: Optional shared TelegramClient. If None, a client is opened for this call.
+
+    Returns:
+    - dict: Totals for the group with the number of 'days' written and 'raw'/'filtered' message counts.
+    """
+
+    # Load the INI file and retrieve the group information
+    config = configparser.ConfigParser()
+    config.read(ini_file)
+
+    if group not in config:
+        raise ValueError(f"Group '{group}' not found in {ini_file}")
+
+    username = config[group].get(ini_index)
+    if not username:
+        raise ValueError(f"'{ini_index}' for group '{group}' not found in {ini_file}")
+
+    if date_end is None:
+        date_end = datetime.now(timezone.utc)
+
+    state = load_sync_state(group)
+    if state:
+        # Resume from the day of the last persisted message, asking only for newer ids
+        min_id = state['last_id']
+        sync_start = datetime.strptime(state['last_date'][:10], '%Y-%m-%d').replace(tzinfo=timezone.utc)
+        print(f"[{group}] Syncing messages after id {min_id} ({state['last_date']}).")
+    else:
+        min_id = 0
+        sync_start = date_start
+        print(f"[{group}] No sync state, starting from {date_start.strftime('%Y-%m-%d')}.")
+
+    totals = {'days': 0, 'raw': 0, 'filtered': 0}  # Per-group totals returned to the caller
+
+    async with telegram_session(tg_client) as tg_client:
+        async for day, day_log in fetch_telegram_messages_by_day(
+            tg_client,
+            group=group,
+            username=username,
+            date_start=sync_start,
+            date_end=date_end,
+            max_filtered_filesize=max_filtered_filesize,
+            max_filtered_tokens=max_filtered_tokens,
+            min_id=min_id,
+            # A first sync replaces whatever was there; later syncs append to the day
+            open_day=lambda day: TelegramDayLog(group, day, append=bool(state), count_tokens=count_tokens, token_model=token_count_model())
+        ):
+            if day_log.n_raw == 0:
+                day_log.discard()
+                continue
+
+            day_log.commit()
+            save_sync_state(group, day_log.last_entry['id'], day_log.last_entry['timestamp'])
+
+            totals['days'] += 1
+            totals['raw'] += day_log.n_raw
+            totals['filtered'] += day_log.n_filtered
+
+    print(f"[{group}] Sync complete: {totals}")
+    return totals
+
+async def scrape_groups(
+    groups,
+    date_start,
+    date_end,
+    fetcher=fetch_telegram_messages_for_date_range_fill_in_blanks_json,
+    max_concurrency=None,
+    ini_file='coins.ini',
+    ini_index='tg'
+):
+    """
+    Fetch several coins.ini groups concurrently over one long-lived TelegramClient.
+
+    Parameters:
+    - groups (list): Section names from the INI file to scrape.
+    - date_start (datetime): Starting date of the range (timezone-aware in UTC).
+    - date_end (datetime): Ending date of the range (timezone-aware in UTC).
+    - fetcher (coroutine function): Per-group date-range fetcher, called with tg_client=<shared client>.
+    - max_concurrency (int): Maximum number of groups fetched at once on the account
+      (defaults to TELEGRAM_MAX_CONCURRENCY, or 4).
+    - ini_file (str): Path to the INI file for group info.
+    - ini_index (str): The index in the INI file to reference for the username (default is 'tg').
+
+    Returns:
+    - dict: Per-group results keyed by group name, each with 'status', 'seconds' and the fetcher's totals.
+    """
+    if max_concurrency is None:
+        max_concurrency = tg_max_concurrency
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = {}
+    run_started = time.monotonic()
+
+    async def scrape_group(tg_client, group):
+        async with semaphore:
+            started = time.monotonic()
+            print(f"[{group}] Started ({len(results)}/{len(groups)} groups finished).")
+            try:
+                totals = await fetcher(
+                    group,
+                    date_start,
+                    date_end,
+                    ini_file=ini_file,
+                    ini_index=ini_index,
+                    tg_client=tg_client
+                )
+                result = {'status': 'ok', **(totals or {})}
+            except Exception as e:
+                print(f"[{group}] Error while scraping: {e}")
+                result = {'status': 'error', 'error': str(e)}
+
+            result['seconds'] = round(time.monotonic() - started, 1)
+            results[group] = result
+            print(f"[{group}] Finished in {result['seconds']}s ({len(results)}/{len(groups)} groups finished).")
+
+    async with telegram_session() as tg_client:
+        print(f"Scraping {len(groups)} groups with up to {max_concurrency} at a time.")
+        await asyncio.gather(*(scrape_group(tg_client, group) for group in groups))
+
+    # Report per-group and overall totals
+    print("\n--- Scrape summary ---")
+    for group in groups:
+        result = results.get(group, {})
+        print(f"{group}: status={result.get('status')}, days={result.get('days', 0)}, "
+              f"raw={result.get('raw', 0)}, filtered={result.get('filtered', 0)}, seconds={result.get('seconds')}")
+
+    ok_results = [r for r in results.values() if r['status'] == 'ok']
+    print(f"Groups: {len(ok_results)} ok, {len(results) - len(ok_results)} failed. "
+          f"Days: {sum(r.get('days', 0) for r in ok_results)}, "
+          f"raw messages: {sum(r.get('raw', 0) for r in ok_results)}, "
+          f"filtered messages: {sum(r.get('filtered', 0) for r in ok_results)}, "
+          f"wall-clock: {round(time.monotonic() - run_started, 1)}s")
+
+    return results
+
+async def scrape_groups_multi_account(
+    groups,
+    date_start,
+    date_end,
+    accounts_file='telegram_accounts.ini',
+    days_per_job=1,
+    flood_handoff_seconds=30,
+    max_filtered_filesize=1024 * 1024,
+    max_filtered_tokens=None,
+    ini_file='coins.ini',
+    ini_index='tg'
+):
+    """
+    Fetch several coins.ini groups across a pool of Telegram accounts and stream each day to JSON lines files.
+
+    The date range of every group is split into group/day jobs (or spans of days_per_job days, which
+    are streamed in one pass). Jobs go to whichever account has spare rate budget, and a job whose
+    account is flood limited for flood_handoff_seconds or more is handed to another account, resuming
+    from the first day it had not saved yet.
+
+    Parameters:
+    - groups (list): Section names from the INI file to scrape.
+    - date_start (datetime): Starting date of the range (timezone-aware in UTC).
+    - date_end (datetime): Ending date of the range (timezone-aware in UTC).
+    - accounts_file (str): INI file listing the accounts (see tg_pool.load_telegram_accounts). If it does
+      not exist, the single account from the environment variables is used.
+    - days_per_job (int): Number of days per job.
+    - flood_handoff_seconds (int): Flood waits at least this long move the job to another account.
+    - max_filtered_filesize (int): Maximum size of filtered messages per day in bytes.
+    - max_filtered_tokens (int): If set, cap the filtered messages per day at this many tokens of the analysis
+      model instead of max_filtered_filesize bytes.
+    - ini_file (str): Path to the INI file for group info.
+    - ini_index (str): The index in the INI file to reference for the username (default is 'tg').
+
+    Returns:
+    - dict: Per-group totals with the number of 'days' saved and 'raw'/'filtered' message counts.
+    """
+    config = configparser.ConfigParser()
+    config.read(ini_file)
+
+    accounts = load_telegram_accounts(
+        accounts_file,
+        default_account={'name': 'session_name', 'api_id': api_id, 'api_hash': api_hash,
+                         'phone': phone, 'max_concurrency': tg_max_concurrency}
+    )
+
+    # Build group/day jobs
+    jobs = []
+    results = {}
+    for group in groups:
+        username = config[group].get(ini_index) if group in config else None
+        if not username:
+            print(f"Skipping '{group}': '{ini_index}' not found in {ini_file}")
+            continue
+        results[group] = {'days': 0, 'raw': 0, 'filtered': 0}
+
+        job_start = date_start
+        while job_start <= date_end:
+            job_end = min(date_end, job_start + timedelta(days=days_per_job - 1))
+            jobs.append({'group': group, 'username': username, 'date_start': job_start, 'date_end': job_end})
+            job_start = job_end + timedelta(days=1)
+
+    print(f"Scraping {len(results)} groups as {len(jobs)} jobs over {len(accounts)} Telegram account(s).")
+
+    async def handle_job(session, job):
+        async for day, day_log in fetch_telegram_messages_by_day(
+            session.client,
+            group=job['group'],
+            username=job['username'],
+            date_start=job['date_start'],
+            date_end=job['date_end'],
+            max_filtered_filesize=max_filtered_filesize,
+            max_filtered_tokens=max_filtered_tokens,
+            cache=session.cache,
+            limiter=session.limiter,
+            flood_handoff_seconds=flood_handoff_seconds if len(accounts) > 1 else None,
+            open_day=lambda day: TelegramDayLog(job['group'], day, count_tokens=count_tokens, token_model=token_count_model())
+        ):
+            if day_log.n_filtered > 4:
+                day_log.commit()
+                totals = results[job['group']]
+                totals['days'] += 1
+                totals['raw'] += day_log.n_raw
+                totals['filtered'] += day_log.n_filtered
+            else:
+                day_log.discard()
+
+            # Record progress so a handed-off job resumes after the last completed day
+            job['date_start'] = day + timedelta(days=1)
+
+    async with TelegramSessionPool(accounts) as pool:
+        failures = await pool.run(jobs, handle_job)
+
+    for job, error in failures:
+        print(f"Failed: {job['group']} from {job['date_start'].strftime('%Y-%m-%d')}: {error}")
+    for group, totals in results.items():
+        print(f"{group}: days={totals['days']}, raw={totals['raw']}, filtered={totals['filtered']}")
+
+    return results
 
 def normalize_username(username):
     # Remove leading special characters like '!', '@', '#', etc.
     return username.lstrip('!@#')
 
-def check_spam_with_openai(messages,llm_model):
+def check_spam_with_openai(messages,llm_model, group=None):
     """
     Identify spam users from a list of messages using OpenAI.
 
     Parameters:
     - messages: List of dictionaries containing 'message' and 'sender_username'.
+    - group (str): Name of the group the messages are from, recorded in the LLM ledger.
 
     Returns:
     - ignore_list: List of usernames identified as spam.
     """
     print("Starting spam check with OpenAI...")
 
-    # Read the prompt from prompt_spam.ini
-    try:
-        with open('prompt_spam.ini', 'r', encoding='utf-8') as file:
-            spam_prompt_template = file.read()
-        #print("Loaded prompt_spam.ini successfully.")
-    except Exception as e:
-        print(f"Error loading 'prompt_spam.ini': {e}")
+    # The prompt from prompt_spam.ini is loaded once with the analyzer
+    analyzer = chat_log_analyzer(llm_model)
+    if analyzer.spam_prompt is None:
         return []
 
     message_log_text = ''
     for entry in messages:
         message_log_text += f"Usr:@{entry['sender_username']}\nMsg:{entry['message']}\n--\n"
 
-    final_prompt = prompt_template.replace('{message_log}', message_log_text)
-
     # Prepare the final prompt
-    final_prompt = spam_prompt_template.replace('{message_log}', message_log_text)
+    final_prompt = analyzer.spam_prompt.replace('{message_log}', message_log_text)
     print("Prepared the final prompt for OpenAI API.")
 
-    # Call the OpenAI API
-    try:
-        print("Sending spam check request to OpenAI API...")
-        response = client.beta.chat.completions.parse(
-            model=llm_model,
-            messages=[{'role': 'user', 'content': final_prompt}],
-            max_tokens=500
-        )
-        print("Received response from OpenAI API.")
-    except Exception as e:
-        print(f"OpenAI API Error during spam check: {e}")
+    # Call the OpenAI API within the account's rate limits
+    print("Sending spam check request to OpenAI API...")
+    response = get_llm_scheduler(openai_rpm, openai_tpm).call_sync(
+        analyzer.client.chat.completions.create,
+        model=llm_model,
+        messages=[{'role': 'user', 'content': final_prompt}],
+        max_tokens=500,
+        tokens=estimate_request_tokens(final_prompt, completion_tokens=500),
+        label='spam check',
+        job={'kind': 'spam_check', 'project': group, 'model': llm_model},
+        queue=False  # Checked again whenever the group is scraped, so there is nothing to retry
+    )
+    if response is None:
         return []
+    print("Received response from OpenAI API.")
 
     # Extract the assistant's response
     ai_response = response.choices[0].message.content.strip()
@@ -709,94 +1281,418 @@ def check_spam_with_openai(messages,llm_model):
         print(ai_response)
         return []
 
-def analyze_messages_with_openai(input_file, output_file, llm_model):
+def find_spam_senders(messages, group=None, llm_model=openai_version):
+    """
+    Identify spam users from a list of messages with the local spam classifier, asking OpenAI only
+    about the senders the classifier is unsure of.
+
+    Parameters:
+    - messages: List of dictionaries containing 'sender_username', 'text' (or 'message') and optionally 'timestamp'.
+    - group (str): Name of the group. If given, senders already in its spam registry are not checked again
+      and new verdicts are added to it.
+    - llm_model (str): The OpenAI model used for unsure senders.
+
+    Returns:
+    - ignore_list: List of usernames identified as spam.
+    """
+    def llm_check(unsure_messages):
+        return check_spam_with_openai(
+            [{'sender_username': entry['sender_username'], 'message': entry.get('text', entry.get('message'))}
+             for entry in unsure_messages],
+            llm_model,
+            group
+        )
+
+    registry = get_spam_registry(group) if group else None
+    return classify_senders(messages, llm_check=llm_check, registry=registry)
+
+def analyze_messages_with_openai(input_file, output_file, llm_model, chunk=None, job=None):
     """Read messages from a file, trim content to be under a specified size, send to OpenAI API, and save the response.
 
     Parameters:
     - input_file (str): Path to the input text file containing messages.
     - output_file (str): Path to the output file where the response will be saved.
     - llm_model (str): The OpenAI model to use.
+    - chunk (dict): A token-budgeted chunk of the filtered messages from the manifest ('start', 'messages',
+      'tokens'). Its messages are sent as they are, using the precomputed token count instead of encoding them.
+    - job (dict): The day being analysed, recorded in the LLM retry queue if the request fails for good.
     """
-    max_token_limit = 110000  # Set the maximum token limit
-
     print("Starting analyze_messages_with_openai function.")
-    # Read the initialization prompt from prompt.ini
-    # NOTE: the meat of the prompt is contained in the structured output prompt.py document
-    try:
-        with open('prompt.ini', 'r', encoding='utf-8') as file:
-            prompt_template = file.read()
-        print("Loaded prompt.ini successfully.")
-    except Exception as e:
+    prepared = prepare_chat_log(input_file, llm_model, chunk)
+    if prepared is None:
+        return
+    return send_messages_to_openai(*prepared, output_file, llm_model, job)
+
+def prepare_chat_log(input_file, llm_model, chunk=None):
+    """
+    Load the prompt and a day's messages, and build the chat log payload, trimmed to the token limit.
+
+    Parameters:
+    - input_file (str): Path to the stored messages.
+    - llm_model (str): The OpenAI model the payload is for.
+    - chunk (dict): Optional token-budgeted chunk from the manifest (see analyze_messages_with_openai).
+
+    Returns:
+    - tuple: (prompt_template, discussions, message_log_text), or None if the messages could not be prepared
+      or not even the first one fits the token limit.
+    """
+    max_token_limit = 110000  # Set the maximum token limit
+
+    analyzer = chat_log_analyzer(llm_model)
+    prompt_template = analyzer.prompt
+    discussions = load_chat_log(input_file)
+    if discussions is None:
+        return
+    n_messages = len(discussions)
+
+    if chunk is not None:
+        # The scraper already counted this chunk's tokens, so its size is known without encoding anything
+        discussions = discussions[chunk['start']:chunk['start'] + chunk['messages']]
+        n_messages = len(discussions)
+        token_length = chunk['tokens'] + PAYLOAD_OVERHEAD_TOKENS
+        print(f"Using precomputed chunk of {n_messages} messages, {token_length} tokens.")
+
+    if chunk is None or token_length > max_token_limit:
+        # Encode each message once, then keep the longest prefix of messages that fits the limit. The prefix
+        # sums bound the payload exactly (see fit_discussions()), so the payload itself is never encoded.
+        # A chunk only gets here if it is a lone message over the limit (the chunker never splits a message)
+        token_counts = analyzer.token_counts(discussions)
+        if token_counts is None:
+            return
+        n_messages_to_keep, token_length = fit_discussions(token_counts, max_token_limit)
+        print(f"Total token size for message_log_text: {sum(token_counts) + PAYLOAD_OVERHEAD_TOKENS}")
+
+        # Check if trimming is needed
+        if n_messages_to_keep < n_messages:
+            print(f"Token length exceeds {max_token_limit}. Trimming messages to first {n_messages_to_keep} messages.")
+            discussions = discussions[:n_messages_to_keep]
+            print(f"New total token size after trimming: {token_length}")
+        else:
+            print("No trimming needed.")
+
+    message_log_text = build_payload(discussions)
+
+    if n_messages and not discussions:
+        # Not even the first message fits; sending the empty payload would still be billed
+        print(f"Not even one message of '{input_file}' fits in {max_token_limit} tokens. Skipping.")
+        return
+
+    return prompt_template, discussions, message_log_text
+
+def chat_log_analyzer(llm_model):
+    """
+    Return the process-wide analyzer for a model: the prompts, response schema, tokenizer and OpenAI clients,
+    loaded on first use and shared by every day and project of the run. Exits if prompt.ini is missing.
+    """
+    try:
+        return get_chat_log_analyzer(llm_model, client, async_client)
+    except OSError as e:
         print(f"Error loading prompt.ini: {e}")
         exit(1)
-    
+
+def load_chat_log(input_file):
+    """Read the 'discussions' list of a day (archive, .jsonl day log or older .json file), or None on error."""
     try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            message_log_text = f.read()
+        discussions = load_discussions(input_file)
         print(f"Loaded '{input_file}' successfully.")
+        print(f"Total number of messages: {len(discussions)}")
     except Exception as e:
         print(f"Error reading '{input_file}': {e}")
-        return
+        return None
+    return discussions
 
-    # Parse message_log_text into message_log_data
-    try:
-        message_log_data = json.loads(message_log_text)
-        # Access the 'discussions' list
-        discussions = message_log_data.get('discussions', [])
-        n_messages = len(discussions)
-        print(f"Total number of messages: {n_messages}")
-    except Exception as e:
-        print(f"Error parsing '{input_file}': {e}")
-        return
+def prepare_chat_log_chunks(input_file, llm_model, chunks=None):
+    """
+    Load the prompt and a whole day's messages, cut into payloads that each fit the token budget.
 
-    # Get the encoding for the model
-    try:
-        encoding = tiktoken.encoding_for_model(llm_model)
-    except Exception as e:
-        print(f"Error getting encoding for model '{llm_model}': {e}")
+    Parameters:
+    - input_file (str): Path to the stored messages.
+    - llm_model (str): The OpenAI model the payloads are for.
+    - chunks (list): Token-budgeted chunks from the manifest. If None, the messages are counted and cut here.
+
+    Returns:
+    - tuple: (prompt_template, discussions, [(chunk discussions, payload text), ...]), or None on error.
+    """
+    analyzer = chat_log_analyzer(llm_model)
+    prompt_template = analyzer.prompt
+    discussions = load_chat_log(input_file)
+    if discussions is None:
+        return None
+
+    if chunks is None:
+        token_counts = analyzer.token_counts(discussions)
+        if token_counts is None:
+            return None
+        chunker = TokenChunker(CHUNK_TOKEN_BUDGET)
+        for tokens in token_counts:
+            chunker.add(tokens)
+        chunks = chunker.chunks
+
+    parts = []
+    for chunk in chunks:
+        chunk_discussions = discussions[chunk['start']:chunk['start'] + chunk['messages']]
+        parts.append((chunk_discussions, build_payload(chunk_discussions)))
+    print(f"Split {len(discussions)} messages into {len(parts)} chunks.")
+    return prompt_template, discussions, parts
+
+def send_messages_to_openai(prompt_template, discussions, message_log_text, output_file, llm_model, job=None):
+    """
+    Send a prepared chat log to the OpenAI API, add the non-LLM metrics and save the structured response.
+
+    Parameters:
+    - prompt_template (str): The system prompt.
+    - discussions (list): The discussions contained in message_log_text.
+    - message_log_text (str): The chat log payload, as built by build_payload().
+    - output_file (str): Path to the output file where the response will be saved.
+    - llm_model (str): The OpenAI model to use.
+    - job (dict): The day being analysed, recorded in the LLM retry queue if the request fails for good.
+    """
+    # Reuse the response to an identical earlier request
+    cache_key = analysis_cache_key(prompt_template, message_log_text, llm_model)
+    ai_response = get_llm_cache().get(cache_key)
+    if ai_response is not None:
+        print("Using cached OpenAI response.")
+        return save_chat_log_analysis(ai_response, discussions, output_file)
+
+    # Proceed to call the OpenAI API, paced and retried by the LLM scheduler
+    print("Sending request to OpenAI API...")
+    analyzer = chat_log_analyzer(llm_model)
+    response = get_llm_scheduler(openai_rpm, openai_tpm).call_sync(
+        analyzer.client.chat.completions.create,
+        model=llm_model,
+        messages=[
+            {'role': 'system', 'content': prompt_template},
+            {'role': 'user', 'content': message_log_text}],
+        response_format=analyzer.response_format,
+        tokens=estimate_request_tokens(prompt_template, message_log_text),
+        label=os.path.basename(output_file),
+        job=job
+    )
+    if response is None:
         return
+    print("Received response from OpenAI API.")
 
-    # Calculate the number of tokens in message_log_text
-    token_length = len(encoding.encode(message_log_text))
-    print(f"Total token size for message_log_text: {token_length}")
+    metrics_dict = save_chat_log_analysis(response.choices[0].message.content, discussions, output_file, cache_key)
 
-    # Check if trimming is needed
-    if token_length > max_token_limit:
-        # Calculate the proportion to keep
-        proportion_to_keep = max_token_limit / token_length
-        n_messages_to_keep = int(n_messages * proportion_to_keep)
-        print(f"Token length exceeds {max_token_limit}. Trimming messages to first {n_messages_to_keep} messages.")
+    # Optionally, display the response
+    print("\n--- OpenAI GPT-4 Response ---\n")
+    
+    if metrics_dict is not None:
+        print(json.dumps(metrics_dict, indent=4, ensure_ascii=False))
 
-        # Trim 'discussions' list
-        discussions = discussions[:n_messages_to_keep]
-        message_log_data['discussions'] = discussions
+    return metrics_dict
 
-        # Reconstruct message_log_text
-        message_log_text = json.dumps(message_log_data, ensure_ascii=False)
+async def analyze_messages_with_openai_async(input_file, output_file, llm_model, chunk=None, semaphore=None, job=None):
+    """
+    Async version of analyze_messages_with_openai(), sending the request with the async OpenAI client
+    so many days can be scored at once.
 
-        # Recalculate token_length
-        token_length = len(encoding.encode(message_log_text))
-        print(f"New total token size after trimming: {token_length}")
-    else:
-        print("No trimming needed.")
+    Parameters:
+    - semaphore (asyncio.Semaphore): Bounds the OpenAI requests in flight across concurrent calls.
+    - job (dict): The day being analysed, recorded in the LLM retry queue if the request fails for good.
 
-    # Proceed to call the OpenAI API
-    try:
-        print("Sending request to OpenAI API...")
-        response = client.beta.chat.completions.parse(
+    Returns:
+    - dict: The saved metrics, or None if the day could not be scored.
+    """
+    # Reading and tokenizing runs in a worker thread so it doesn't hold up other requests
+    prepared = await asyncio.to_thread(prepare_chat_log, input_file, llm_model, chunk)
+    if prepared is None:
+        return None
+    prompt_template, discussions, message_log_text = prepared
+
+    ai_response = await score_chat_log_async(prompt_template, message_log_text, llm_model, semaphore, job)
+    if ai_response is None:
+        return None
+    return save_chat_log_analysis(ai_response, discussions, output_file)
+
+async def analyze_messages_map_reduce_async(input_file, output_file, llm_model, chunks=None, semaphore=None, job=None):
+    """
+    Score a whole day, however busy, by scoring its token-budgeted chunks concurrently and merging the results.
+
+    Days that fit in one chunk are scored as usual. Otherwise every chunk is sent with the same prompt and
+    ChatLogAnalysisResponse schema, the analyses are merged with merge_chunk_analyses(), and the non-LLM
+    metrics are computed over all of the day's messages. The output is marked with a 'map_reduce' entry
+    listing the chunk sizes.
+
+    Parameters:
+    - input_file (str): Path to the stored messages.
+    - output_file (str): Path to the output file where the merged response will be saved.
+    - llm_model (str): The OpenAI model to use.
+    - chunks (list): Token-budgeted chunks from the manifest, or None to cut the day here.
+    - semaphore (asyncio.Semaphore): Bounds the OpenAI requests in flight across concurrent calls.
+    - job (dict): The day being analysed, recorded in the LLM retry queue if a request fails for good.
+
+    Returns:
+    - dict: The saved metrics, or None if any chunk could not be scored.
+    """
+    prepared = await asyncio.to_thread(prepare_chat_log_chunks, input_file, llm_model, chunks)
+    if prepared is None:
+        return None
+    prompt_template, discussions, parts = prepared
+
+    ai_responses = await asyncio.gather(
+        *(score_chat_log_async(prompt_template, message_log_text, llm_model, semaphore, job) for _, message_log_text in parts))
+    if any(ai_response is None for ai_response in ai_responses):
+        print(f"Could not score every chunk of '{input_file}'; not saving a partial day.")
+        return None
+    if len(parts) == 1:
+        return save_chat_log_analysis(ai_responses[0], discussions, output_file)
+
+    weights = [len(chunk_discussions) for chunk_discussions, _ in parts]
+    merged = merge_chunk_analyses([json.loads(ai_response) for ai_response in ai_responses], weights)
+    return save_chat_log_analysis(json.dumps(merged), discussions, output_file,
+                                  extra={'map_reduce': {'chunks': len(parts), 'messages': weights}})
+
+async def analyze_packed_chat_logs_async(days, llm_model, semaphore=None, job=None):
+    """
+    Score several small days, possibly of different projects, with one request and save each day's usual output.
+
+    The days' payloads are sent together with the packed system prompt (prompt.ini plus PACKED_PROMPT), each
+    after a '### Log <project>/<date>' line. The response's per-day CommunityMetrics are split back into
+    the days' output files, marked with a 'packed' entry giving the number of days in the request.
+
+    Parameters:
+    - days (list): (project_name, date_str, input_file, output_file, chunk) of each day, where chunk is the
+      day's only token-budgeted chunk from the manifest.
+    - llm_model (str): The OpenAI model to use.
+    - semaphore (asyncio.Semaphore): Bounds the OpenAI requests in flight across concurrent calls.
+    - job (dict): The pack, recorded in the LLM retry queue if the request fails for good.
+
+    Returns:
+    - list: The saved metrics of each day, or None for the days that could not be scored.
+    """
+    prepared = await asyncio.gather(
+        *(asyncio.to_thread(prepare_chat_log, input_file, llm_model, chunk) for _, _, input_file, _, chunk in days))
+    logs = [(f"{project_name}/{date_str}", day[1])
+            for (project_name, date_str, _, _, _), day in zip(days, prepared) if day is not None]
+    results = [None] * len(days)
+    if not logs:
+        return results
+
+    ai_response = await score_chat_log_async(chat_log_analyzer(llm_model).packed_prompt, build_packed_payload(logs),
+                                             llm_model, semaphore, job, days=len(logs))
+    if ai_response is None:
+        return results
+
+    answers = {day['log_id']: day['metrics'] for day in json.loads(ai_response)['days']}
+    for i, (project_name, date_str, _, output_file, _) in enumerate(days):
+        if prepared[i] is None:
+            continue
+        metrics = answers.get(f"{project_name}/{date_str}")
+        if metrics is None:
+            print(f"The packed response has no analysis of {project_name} {date_str}.")
+            continue
+        results[i] = save_chat_log_analysis(json.dumps({'metrics': metrics}), prepared[i][1], output_file,
+                                            extra={'packed': {'days': len(logs)}})
+    return results
+
+async def score_chat_log_async(prompt_template, message_log_text, llm_model, semaphore=None, job=None, days=None):
+    """
+    Get the analysis of one chat log payload from the LLM cache or the async OpenAI client.
+
+    Requests are paced and retried by the LLM scheduler; one that fails for good is recorded in its retry queue.
+
+    Parameters:
+    - days (int): For a packed payload (see analyze_packed_chat_logs_async()), the number of days in it.
+      The request then asks for a PackedChatLogAnalysisResponse.
+
+    Returns:
+    - str: The assistant's response, validated against ChatLogAnalysisResponse (or PackedChatLogAnalysisResponse),
+      or None on failure.
+    """
+    cache_key = analysis_cache_key(prompt_template, message_log_text, llm_model, packed=days is not None)
+    ai_response = get_llm_cache().get(cache_key)
+    if ai_response is not None:
+        return ai_response
+
+    if days is not None:
+        label = f"pack of {days} days"
+    else:
+        label = f"{job['project']}/{job['date']}" if job else 'chat log'
+    analyzer = chat_log_analyzer(llm_model)
+    async with semaphore or asyncio.Semaphore():
+        response = await get_llm_scheduler(openai_rpm, openai_tpm).call(
+            analyzer.async_client.chat.completions.create,
             model=llm_model,
             messages=[
                 {'role': 'system', 'content': prompt_template},
                 {'role': 'user', 'content': message_log_text}],
-                response_format=ChatLogAnalysisResponse
+            response_format=analyzer.response_format if days is None else analyzer.packed_response_format,
+            tokens=estimate_request_tokens(prompt_template, message_log_text,
+                                           completion_tokens=COMPLETION_TOKENS_ESTIMATE * (days or 1)),
+            label=label,
+            job=job
         )
-        print("Received response from OpenAI API.")
-    except Exception as e: 
-        print(f"OpenAI API Error: {e}")
-        return
+    if response is None:
+        return None
 
-    # Extract the assistant's response
-    ai_response = response.choices[0].message.content.strip()
+    try:
+        ai_response = response.choices[0].message.content
+        response_model = ChatLogAnalysisResponse if days is None else PackedChatLogAnalysisResponse
+        response_model(**json.loads(ai_response))
+    except Exception as e:
+        print(f"Error parsing or validating the AI response for {label}: {e}")
+        return None
+
+    get_llm_cache().put(cache_key, ai_response)
+    return ai_response
+
+def merge_chunk_analyses(analyses, weights):
+    """
+    Merge the analyses of one day's chunks into a single daily analysis.
+
+    Each emotional metric's intensity is the average of the chunks' intensities weighted by their message
+    counts (chunks that gave no intensity are left out), and its context joins the chunks' contexts in
+    order. The catch phrase and description come from the chunk with the most messages.
+
+    Parameters:
+    - analyses (list): ChatLogAnalysisResponse dicts, one per chunk in message order.
+    - weights (list): Number of messages in each chunk.
+
+    Returns:
+    - dict: The merged ChatLogAnalysisResponse dict.
+    """
+    heaviest = max(range(len(analyses)), key=lambda i: weights[i])
+    merged = copy.deepcopy(analyses[heaviest])
+
+    emotional_metrics = merged['metrics']['emotional_metrics']
+    for name, metric in emotional_metrics.items():
+        scored = []
+        contexts = []
+        for analysis, weight in zip(analyses, weights):
+            chunk_metric = analysis['metrics']['emotional_metrics'][name]
+            if chunk_metric.get('intensity') is not None:
+                scored.append((chunk_metric['intensity'], weight))
+            if chunk_metric.get('context') and chunk_metric['context'] not in contexts:
+                contexts.append(chunk_metric['context'])
+
+        metric['intensity'] = round(sum(i * w for i, w in scored) / sum(w for _, w in scored)) if scored else None
+        if contexts:
+            metric['context'] = ' '.join(contexts)
+
+    return merged
+
+def analysis_cache_key(prompt_template, message_log_text, llm_model, packed=False):
+    """Return the LLM cache key of a chat log analysis request (or of a packed one)."""
+    analyzer = chat_log_analyzer(llm_model)
+    schema = analyzer.packed_schema if packed else analyzer.schema
+    return get_llm_cache().key(llm_model, prompt_template, schema, message_log_text)
+
+def save_chat_log_analysis(ai_response, discussions, output_file, cache_key=None, extra=None):
+    """
+    Validate the assistant's JSON answer against ChatLogAnalysisResponse, add the non-LLM metrics and save it.
+
+    Parameters:
+    - ai_response (str): The assistant message text.
+    - discussions (list): The discussions that were sent.
+    - output_file (str): Path to the output file where the response will be saved.
+    - cache_key (str): If set, a valid response is stored in the LLM cache under this key.
+    - extra (dict): Additional top-level entries for the output, e.g. the 'map_reduce' marker.
+
+    Returns:
+    - dict: The saved metrics, or None if the response could not be parsed.
+    """
+    ai_response = ai_response.strip()
 
     # Attempt to parse the response as JSON
     try:
@@ -810,6 +1706,9 @@ def analyze_messages_with_openai(input_file, output_file, llm_model):
         print(ai_response)
         return
 
+    if cache_key is not None:
+        get_llm_cache().put(cache_key, ai_response)
+
     # Perform some additional processing with non-LLM analysis
     try:
         # discussions variable is already available from earlier
@@ -827,81 +1726,491 @@ def analyze_messages_with_openai(input_file, output_file, llm_model):
     except Exception as e:
         print(f"Error processing additional metrics: {e}")
 
+    if extra:
+        metrics_dict.update(extra)
+
     # Save the structured response to a JSON file
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(metrics_dict, f, indent=4, ensure_ascii=False)
+        write_json_atomic(output_file, metrics_dict)
         print(f"OpenAI response saved to '{output_file}'.")
     except Exception as e:
         print(f"Error writing to '{output_file}': {e}")
+        return None
 
-    # Optionally, display the response
-    print("\n--- OpenAI GPT-4 Response ---\n")
-    
-    try:
-        print(json.dumps(metrics_dict, indent=4, ensure_ascii=False))
-    except json.JSONDecodeError:
-        # If the response is not valid JSON, print as raw text
-        print(ai_response)
+    return metrics_dict
 
-def process_chat_logs(project_name, date_min, date_max,model=openai_version):
+def process_chat_logs(project_name, date_min, date_max,model=openai_version, overwrite=False):
     """
     Process chat logs by calling analyze_messages_with_openai() for each date in the date range.
 
+    Days are looked up in the project manifest, so days without messages and days already analysed
+    with this model and prompt version are skipped without touching the filesystem.
+
     Parameters:
     - project_name (str): The name of the project.
     - date_min (str): The start date in 'YYYY-MM-DD' format.
     - date_max (str): The end date in 'YYYY-MM-DD' format.
+    - model (str): The OpenAI model to use.
+    - overwrite (bool): Analyse days again even if the manifest already has an output for them.
+    """
+    for date_str, input_file, output_file, chunks in chat_log_jobs(project_name, date_min, date_max, model, overwrite):
+        # Call analyze_messages_with_openai() with the first chunk of the day
+        analyze_messages_with_openai(input_file=input_file, output_file=output_file, llm_model=model,
+                                     chunk=chunks[0] if chunks else None,
+                                     job=chat_log_job(project_name, date_str, model))
+
+        if os.path.exists(output_file):
+            record_manifest_output(project_name, date_str, model, __version__, output_file)
+
+    print(f"LLM cache: {get_llm_cache().stats()}")
+    print(f"LLM scheduler: {get_llm_scheduler(openai_rpm, openai_tpm).stats()}")
+
+def chat_log_job(project_name, date_str, model, map_reduce=False):
+    """Describe a day's analysis for the LLM retry queue and ledger."""
+    return {'kind': 'chat_log', 'project': project_name, 'date': date_str, 'model': model,
+            'prompt_version': __version__, 'map_reduce': map_reduce}
+
+def chat_log_pack_job(days, model):
+    """
+    Describe a packed request of several days (see analyze_packed_chat_logs_async()) for the LLM retry queue
+    and ledger. Each day carries its payload 'tokens', by which the ledger splits the request's usage.
+    """
+    return {'kind': 'chat_log_pack', 'model': model, 'prompt_version': __version__,
+            'days': [{'project': project_name, 'date': date_str, 'tokens': (chunk or {}).get('tokens')}
+                     for project_name, date_str, _, _, chunk in days]}
+
+def pack_chat_log_jobs(jobs):
+    """
+    Group the small days among chat log jobs into packs that are each analysed with one request.
+
+    A day is small when the scraper counted it as a single chunk of at most PACK_DAY_TOKENS tokens.
+    Small days are packed in job order up to PACK_TOKEN_BUDGET tokens and PACK_MAX_DAYS days per pack.
+
+    Parameters:
+    - jobs (list): (project_name, date_str, input_file, output_file, chunks) tuples.
+
+    Returns:
+    - tuple: (the jobs analysed on their own, [packs of (project_name, date_str, input_file, output_file, chunk)]).
+    """
+    small = []
+    others = []
+    for job in jobs:
+        chunks = job[4]
+        (small if chunks and len(chunks) == 1 and chunks[0]['tokens'] <= PACK_DAY_TOKENS else others).append(job)
+    packs = []
+    for indexes in pack_days([job[4][0]['tokens'] for job in small]):
+        if len(indexes) == 1:
+            others.append(small[indexes[0]])
+        else:
+            packs.append([small[i][:4] + (small[i][4][0],) for i in indexes])
+    return others, packs
+
+def chat_log_jobs(project_name, date_min, date_max, model=openai_version, overwrite=False):
+    """
+    List the days of a project that need analysing, from its manifest.
+
+    Parameters:
+    - project_name (str): The name of the project.
+    - date_min (str): The start date in 'YYYY-MM-DD' format.
+    - date_max (str): The end date in 'YYYY-MM-DD' format.
+    - model (str): The OpenAI model to use.
+    - overwrite (bool): Include days the manifest already has an output for.
+
+    Returns:
+    - list: (date_str, input_file, output_file, chunks) tuples, in date order. chunks are the day's
+      token-budgeted chunks counted by the scraper, or None if they weren't counted for this model.
     """
     # Parse the date strings
     date_start = datetime.strptime(date_min, '%Y-%m-%d')
     date_end = datetime.strptime(date_max, '%Y-%m-%d')
 
-    # For each date in the range
+    saved_days = load_manifest(project_name)['days']
+    key = output_key(model, __version__)
+
+    jobs = []
     current_date = date_start
     while current_date <= date_end:
         date_str = current_date.strftime('%Y-%m-%d')
-        directory = os.path.join('tg',project_name, date_str)
+        day = saved_days.get(date_str, {})
+        input_file = manifest_input_file(project_name, date_str, day)
 
-        if os.path.exists(directory):
-            # List files in the directory
-            files = [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
+        if input_file is None:
+            print(f"No filtered messages recorded for {project_name} on {date_str}")
+        elif key in day.get('outputs', {}) and not overwrite:
+            print(f"{project_name} {date_str} already analysed with {key}. Skipping.")
+        else:
+            output_file = os.path.join('tg', project_name, date_str, f"{project_name}_filtered_{date_str}_{key}.json")
 
-            # Filter files that have 'filtered' in the filename, end with '.json', and do not contain 'llm=' or 'prompt='
-            # Do this to not accidentially select a post-processed file as our LLM target. 
-            filtered_files = [f for f in files if 'filtered' in f and f.endswith('.json') and 'llm=' not in f and 'prompt=' not in f]
+            # Reuse the token-budgeted chunks counted by the scraper when they were counted for this model
+            tokens = day.get('tokens') or {}
+            chunks = tokens['chunks'] if tokens.get('model') == model and tokens.get('chunks') else None
+            jobs.append((date_str, input_file, output_file, chunks))
 
-            if filtered_files:
-                # If duplicates exist, use the one with the latest modification time
-                files_with_mtime = []
-                for f in filtered_files:
-                    file_path = os.path.join(directory, f)
-                    mtime = os.path.getmtime(file_path)
-                    files_with_mtime.append((file_path, mtime))
+        # Move to the next date
+        current_date += timedelta(days=1)
 
-                # Sort files by modification time, latest first
-                files_with_mtime.sort(key=lambda x: x[1], reverse=True)
+    return jobs
 
-                # Select the latest file
-                input_file = files_with_mtime[0][0]
+def measure_payload_savings(project_name, date_min, date_max):
+    """
+    Report, per day, how many input tokens the compact chat log payload saves over the JSON payload.
 
-                # Prepare the output file path
-                output_directory = os.path.join(project_name)
-                if not os.path.exists(output_directory):
-                    os.makedirs(output_directory)
+    Tokens are counted with the configured model's tokenizer (see count_tokens()).
 
-                output_file = os.path.join('tg',output_directory,date_str, f"{project_name}_filtered_{date_str}_llm={model}_prompt={__version__}.json")
+    Parameters:
+    - project_name (str): The name of the project.
+    - date_min (str): The start date in 'YYYY-MM-DD' format.
+    - date_max (str): The end date in 'YYYY-MM-DD' format.
 
-                # Call analyze_messages_with_openai()
-                analyze_messages_with_openai(input_file=input_file, output_file=output_file, llm_model=model)
+    Returns:
+    - dict: {date: payload_savings() dict} for every day with filtered messages.
+    """
+    date_start = datetime.strptime(date_min, '%Y-%m-%d')
+    date_end = datetime.strptime(date_max, '%Y-%m-%d')
+    saved_days = load_manifest(project_name)['days']
 
-            else:
-                print(f"No filtered text files found in directory {directory}")
+    savings = {}
+    current_date = date_start
+    while current_date <= date_end:
+        date_str = current_date.strftime('%Y-%m-%d')
+        input_file = manifest_input_file(project_name, date_str, saved_days.get(date_str, {}))
+        if input_file is not None:
+            day = payload_savings(load_discussions(input_file), count_tokens)
+            savings[date_str] = day
+            print(f"{project_name} {date_str}: {day['compact_tokens']} tokens instead of {day['json_tokens']} "
+                  f"({day['saved_ratio']:.0%} saved)")
+        current_date += timedelta(days=1)
+
+    json_tokens = sum(day['json_tokens'] for day in savings.values())
+    compact_tokens = sum(day['compact_tokens'] for day in savings.values())
+    if json_tokens:
+        print(f"{project_name}: {compact_tokens} tokens instead of {json_tokens} "
+              f"({1 - compact_tokens / json_tokens:.0%} saved) over {len(savings)} days.")
+    return savings
+
+async def process_chat_logs_async(projects, date_min, date_max, model=openai_version, max_concurrency=None, overwrite=False, map_reduce=False, pack=False):
+    """
+    Analyse the chat logs of many projects and days concurrently with the async OpenAI client.
+
+    At most max_concurrency requests are in flight at once. Each result is written and recorded in its
+    project's manifest as soon as it finishes, so an interrupted run keeps every finished day and a rerun
+    only requests the rest.
+
+    Parameters:
+    - projects (list or str): Project names.
+    - date_min (str): The start date in 'YYYY-MM-DD' format.
+    - date_max (str): The end date in 'YYYY-MM-DD' format.
+    - model (str): The OpenAI model to use.
+    - max_concurrency (int): Requests in flight at once (defaults to OPENAI_MAX_CONCURRENCY, 8).
+    - overwrite (bool): Analyse days again even if the manifest already has an output for them.
+    - map_reduce (bool): Score every chunk of busy days and merge them (see analyze_messages_map_reduce_async())
+      instead of only their first chunk.
+    - pack (bool): Analyse small days, across projects, several to a request (see pack_chat_log_jobs()).
+
+    Returns:
+    - dict: {project: [dates analysed]}.
+    """
+    if isinstance(projects, str):
+        projects = [projects]
+    # Days in progress and requests in flight are bounded separately, so a busy day's chunks share the cap
+    day_slots = asyncio.Semaphore(max_concurrency or llm_max_concurrency)
+    semaphore = asyncio.Semaphore(max_concurrency or llm_max_concurrency)
+
+    jobs = [(project_name,) + job for project_name in projects
+            for job in chat_log_jobs(project_name, date_min, date_max, model, overwrite)]
+    total = len(jobs)
+    packs = []
+    if pack:
+        jobs, packs = pack_chat_log_jobs(jobs)
+        print(f"Packed {sum(len(days) for days in packs)} small days into {len(packs)} requests.")
+    print(f"Analysing {total} days of {len(projects)} projects, {max_concurrency or llm_max_concurrency} at a time.")
+
+    done = {project_name: [] for project_name in projects}
+    finished = 0
+    started = time.monotonic()
+
+    def finish(project_name, date_str, output_file, metrics):
+        # Manifest updates run on the event loop thread between awaits, so they never interleave
+        nonlocal finished
+        finished += 1
+        if metrics is not None:
+            record_manifest_output(project_name, date_str, model, __version__, output_file)
+            done[project_name].append(date_str)
+            status = 'done'
         else:
-            print(f"Directory {directory} does not exist")
+            status = 'failed'
+        elapsed = time.monotonic() - started
+        print(f"[{finished}/{total}] {project_name} {date_str} {status} ({elapsed:.1f}s elapsed)")
+
+    async def run_job(project_name, date_str, input_file, output_file, chunks):
+        job = chat_log_job(project_name, date_str, model, map_reduce)
+        async with day_slots:
+            if map_reduce:
+                metrics = await analyze_messages_map_reduce_async(input_file, output_file, model, chunks, semaphore, job)
+            else:
+                metrics = await analyze_messages_with_openai_async(
+                    input_file, output_file, model, chunks[0] if chunks else None, semaphore, job)
+        finish(project_name, date_str, output_file, metrics)
 
-        # Move to the next date
-        current_date += timedelta(days=1)
+    async def run_pack(days):
+        async with day_slots:
+            results = await analyze_packed_chat_logs_async(days, model, semaphore, chat_log_pack_job(days, model))
+        for (project_name, date_str, _, output_file, _), metrics in zip(days, results):
+            finish(project_name, date_str, output_file, metrics)
+
+    await asyncio.gather(*(run_job(*job) for job in jobs), *(run_pack(days) for days in packs))
+
+    analysed = sum(len(dates) for dates in done.values())
+    print(f"Analysed {analysed}/{total} days in {time.monotonic() - started:.1f}s.")
+    print(f"LLM cache: {get_llm_cache().stats()}")
+    print(f"LLM scheduler: {get_llm_scheduler(openai_rpm, openai_tpm).stats()}")
+    return done
+
+def run_chat_log_pipeline(projects, date_min, date_max, model=openai_version, max_concurrency=None, overwrite=False, map_reduce=False, pack=False):
+    """
+    Run process_chat_logs_async() from synchronous code, stopping cleanly on Ctrl-C.
+
+    Results are written atomically as each day finishes, so on Ctrl-C the in-flight requests are
+    cancelled and every finished day stays in place for the next run.
+    """
+    try:
+        return asyncio.run(process_chat_logs_async(projects, date_min, date_max, model, max_concurrency, overwrite, map_reduce, pack))
+    except KeyboardInterrupt:
+        print("Interrupted. Finished days are saved; run again to analyse the rest.")
+        return None
+
+def benchmark_chat_log_pipeline(projects, date_min, date_max, model=openai_version, max_concurrency=None, map_reduce=False, pack=False):
+    """
+    Time the analysis pipeline end to end: analyse every day in the range again, then roll each project up.
+
+    Meant for runs with OPENAI_STANDIN set, so concurrency, caching and rate limit changes can be load
+    tested without network access; against the live API it spends real tokens. Days already in the LLM
+    cache are answered from it, so running it twice compares a cold cache with a warm one.
+
+    Parameters:
+    - projects (list or str): Project names.
+    - date_min (str): The start date in 'YYYY-MM-DD' format.
+    - date_max (str): The end date in 'YYYY-MM-DD' format.
+    - model (str): The OpenAI model to use.
+    - max_concurrency (int): Maximum OpenAI requests in flight at once.
+    - map_reduce (bool): Score whole days in chunks (see analyze_messages_map_reduce_async()).
+    - pack (bool): Analyse small days several to a request (see pack_chat_log_jobs()).
+
+    Returns:
+    - dict: 'days' analysed, 'seconds' of the analysis and of the rollups, 'days_per_second', and the
+      LLM cache, scheduler and stand-in counters at the end of the run.
+    """
+    if isinstance(projects, str):
+        projects = [projects]
+
+    started = time.monotonic()
+    done = run_chat_log_pipeline(projects, date_min, date_max, model, max_concurrency, overwrite=True, map_reduce=map_reduce, pack=pack)
+    if done is None:
+        return None
+    analysed = time.monotonic() - started
+    for project_name in projects:
+        rollup_project_data(project_name, model, __version__)
+    rolled_up = time.monotonic() - started - analysed
+
+    days = sum(len(dates) for dates in done.values())
+    result = {
+        'days': days,
+        'seconds': {'analysis': round(analysed, 2), 'rollup': round(rolled_up, 2)},
+        'days_per_second': round(days / analysed, 2) if analysed else None,
+        'cache': get_llm_cache().stats(),
+        'scheduler': get_llm_scheduler(openai_rpm, openai_tpm).stats(),
+        'standin': llm_standin.stats() if llm_standin else None
+    }
+    print(f"Benchmark: {days} days in {analysed:.1f}s ({result['days_per_second']} days/s), "
+          f"rollups in {rolled_up:.1f}s.")
+    if llm_standin:
+        print(f"LLM stand-in ({llm_standin.mode}): {result['standin']}")
+    return result
+
+def retry_failed_chat_logs(max_concurrency=None):
+    """
+    Analyse again the days whose requests failed for good and were recorded in the LLM retry queue.
+
+    Days that are analysed this time are removed from the queue, as are spam checks, which aren't rerun from
+    it; the other entries, and requests that failed again during this run, stay in it.
+
+    Returns:
+    - dict: {project: [dates analysed]}.
+    """
+    entries = load_retry_queue()
+    days = {}
+    for entry in entries:
+        job = entry.get('job') or {}
+        if job.get('kind') == 'chat_log':
+            days.setdefault((job['model'], job.get('map_reduce', False), False, job['project']), set()).add(job['date'])
+        elif job.get('kind') == 'chat_log_pack':
+            for day in job['days']:
+                days.setdefault((job['model'], False, True, day['project']), set()).add(day['date'])
+
+    done = {}
+    for (model, map_reduce, pack, project_name), dates in days.items():
+        result = run_chat_log_pipeline(project_name, min(dates), max(dates), model, max_concurrency,
+                                       map_reduce=map_reduce, pack=pack)
+        if result is None:
+            break
+        done.setdefault(project_name, []).extend(result.get(project_name, []))
+
+    def analysed(project_name, date_str, model):
+        outputs = load_manifest(project_name)['days'].get(date_str, {}).get('outputs', {})
+        return output_key(model, __version__) in outputs
+
+    # The scheduler appended the requests that failed again while the days ran, so reload the queue rather
+    # than overwrite it, and keep the entries with a day that still has no output (each job once, latest first)
+    remaining = []
+    seen = set()
+    for entry in reversed(load_retry_queue()):
+        job = entry.get('job') or {}
+        if job.get('kind') == 'spam_check':
+            # Queued by earlier versions; a spam check is redone whenever its group is scraped
+            continue
+        if job.get('kind') == 'chat_log' and analysed(job['project'], job['date'], job['model']):
+            continue
+        if job.get('kind') == 'chat_log_pack' and all(analysed(day['project'], day['date'], job['model']) for day in job['days']):
+            continue
+        key = json.dumps(job, sort_keys=True, default=str) if job else id(entry)
+        if key in seen:
+            continue
+        seen.add(key)
+        remaining.append(entry)
+    remaining.reverse()
+    save_retry_queue(remaining)
+    print(f"Retried {len(entries)} queued requests, {len(remaining)} left in the queue.")
+    return done
+
+def default_batch_backend():
+    """Return the Batch API backend, or a local batch answered by the LLM stand-in in its offline modes."""
+    if llm_standin is None:
+        return OpenAIBatchBackend(client)
+    if llm_standin.mode == 'record':
+        return OpenAIBatchBackend(llm_standin.live_client)
+    return LocalBatchBackend(respond=llm_standin.respond)
+
+def submit_chat_log_batch(projects, date_min, date_max, model=openai_version, overwrite=False, backend=None):
+    """
+    Submit every pending (project, date) analysis as one Batch API job.
+
+    The requests are written to a JSONL batch file under tg/batches, and the jobs they belong to are kept
+    in tg/batches/<batch_id>.json so collect_chat_log_batch() can fan the results out later, even from
+    another run.
+
+    Parameters:
+    - projects (list or str): Project names.
+    - date_min (str): The start date in 'YYYY-MM-DD' format.
+    - date_max (str): The end date in 'YYYY-MM-DD' format.
+    - model (str): The OpenAI model to use.
+    - overwrite (bool): Include days the manifest already has an output for.
+    - backend: OpenAIBatchBackend or LocalBatchBackend (default: see default_batch_backend()).
+
+    Returns:
+    - str: The batch id, or None if there was nothing to submit.
+    """
+    if isinstance(projects, str):
+        projects = [projects]
+    if backend is None:
+        backend = default_batch_backend()
+    response_format = chat_log_analyzer(model).response_format
+
+    requests = []
+    jobs = {}
+    for project_name in projects:
+        for date_str, input_file, output_file, chunks in chat_log_jobs(project_name, date_min, date_max, model, overwrite):
+            chunk = chunks[0] if chunks else None
+            prepared = prepare_chat_log(input_file, model, chunk)
+            if prepared is None:
+                continue
+            prompt_template, discussions, message_log_text = prepared
+
+            # Days already answered for this exact input are saved from the cache instead of resubmitted
+            cache_key = analysis_cache_key(prompt_template, message_log_text, model)
+            ai_response = get_llm_cache().get(cache_key)
+            if ai_response is not None:
+                if save_chat_log_analysis(ai_response, discussions, output_file) is not None:
+                    record_manifest_output(project_name, date_str, model, __version__, output_file)
+                continue
+
+            custom_id = f"{project_name}/{date_str}"
+            requests.append(batch_request(custom_id, model, [
+                {'role': 'system', 'content': prompt_template},
+                {'role': 'user', 'content': message_log_text}], response_format))
+            jobs[custom_id] = {'project': project_name, 'date': date_str, 'input_file': input_file,
+                               'output_file': output_file, 'chunk': chunk, 'cache_key': cache_key}
+
+    if not requests:
+        print("No pending days to submit.")
+        return None
+
+    batch_file = os.path.join(BATCH_DIR, f"chat_logs_{datetime.now():%Y%m%d_%H%M%S}_input.jsonl")
+    write_batch_file(batch_file, requests)
+    batch_id = backend.submit(batch_file, description=f"chat log analysis {date_min}..{date_max}")
+    save_batch_state(batch_id, {'batch_id': batch_id, 'model': model, 'prompt_version': __version__,
+                                'input_file': batch_file, 'jobs': jobs})
+    print(f"Submitted batch {batch_id} with {len(requests)} days of {len(projects)} projects.")
+    return batch_id
+
+def collect_chat_log_batch(batch_id, backend=None, poll_interval=60, timeout=None):
+    """
+    Wait for a submitted batch and save each result as the day's usual analysis output.
+
+    Every answer is validated against ChatLogAnalysisResponse, merged with the non-LLM metrics of the
+    day's messages and recorded in the project manifest, exactly as process_chat_logs() would.
+
+    Parameters:
+    - batch_id (str): Id returned by submit_chat_log_batch().
+    - backend: The backend the batch was submitted to (default: see default_batch_backend()).
+    - poll_interval (float): Seconds between status checks.
+    - timeout (float): Stop waiting after this many seconds; call again later to collect.
+
+    Returns:
+    - dict: {project: [dates saved]}, or None if the batch is not finished.
+    """
+    if backend is None:
+        backend = default_batch_backend()
+    state = load_batch_state(batch_id)
+
+    status = wait_for_batch(backend, batch_id, poll_interval, timeout)
+    if status != 'completed':
+        print(f"Batch {batch_id} is {status}; nothing collected.")
+        return None
+
+    results = parse_batch_results(backend.results(batch_id))
+    done = {}
+    for custom_id, job in state['jobs'].items():
+        content, error, usage = results.get(custom_id, (None, 'missing from the batch output', None))
+        get_llm_ledger().record('chat_log', state['model'], usage, latency=None,
+                                status='ok' if content is not None else 'failed', project=job['project'],
+                                date=job['date'], prompt_version=state['prompt_version'], discount=BATCH_PRICE_DISCOUNT)
+        if content is None:
+            print(f"Batch request {custom_id} failed: {error}")
+            continue
+
+        # Reload the discussions that were sent, for the non-LLM metrics
+        prepared = prepare_chat_log(job['input_file'], state['model'], job['chunk'])
+        if prepared is None:
+            continue
+        if save_chat_log_analysis(content, prepared[1], job['output_file'], job.get('cache_key')) is not None:
+            record_manifest_output(job['project'], job['date'], state['model'], state['prompt_version'], job['output_file'])
+            done.setdefault(job['project'], []).append(job['date'])
+
+    saved = sum(len(dates) for dates in done.values())
+    print(f"Batch {batch_id}: saved {saved}/{len(state['jobs'])} days.")
+    return done
+
+def process_chat_logs_batch(projects, date_min, date_max, model=openai_version, overwrite=False, backend=None, poll_interval=60):
+    """
+    Analyse a historical backfill through the Batch API: submit every pending day, wait, then save the results.
+
+    Batches cost less than interactive requests and aren't bound by their rate limits, but can take up to
+    a day to finish. See submit_chat_log_batch() and collect_chat_log_batch().
+    """
+    batch_id = submit_chat_log_batch(projects, date_min, date_max, model, overwrite, backend)
+    if batch_id is None:
+        return {}
+    return collect_chat_log_batch(batch_id, backend, poll_interval)
 
 def rollup_project_data(project_name, ll_name, prompt_version):
     """
@@ -925,22 +2234,17 @@ def rollup_project_data(project_name, ll_name, prompt_version):
         print(f"Project directory '{project_dir}' does not exist.")
         return
 
-    # List all subdirectories in the project directory
-    subdirs = [d for d in os.listdir(project_dir) if os.path.isdir(os.path.join(project_dir, d))]
-    # Filter subdirectories that match the date format 'YYYY-MM-DD'
-    date_dirs = [d for d in subdirs if is_valid_date(d)]
-
-    if not date_dirs:
-        print(f"No date directories found in '{project_dir}'.")
+    saved_days = load_manifest(project_name)['days']
+    if not saved_days:
+        print(f"No days recorded in the manifest for '{project_dir}'.")
         return
 
-    for date_dir in sorted(date_dirs):
-        date_path = os.path.join(project_dir, date_dir)
-        # Construct the expected JSON filename
-        json_filename = f"{project_name}_filtered_{date_dir}_llm={ll_name}_prompt={prompt_version}.json"
-        json_filepath = os.path.join(date_path, json_filename)
+    key = output_key(ll_name, prompt_version)
+    for date_dir in sorted(saved_days):
+        output = saved_days[date_dir].get('outputs', {}).get(key)
+        json_filepath = os.path.join(project_dir, date_dir, output['name'] if output else f"{project_name}_filtered_{date_dir}_{key}.json")
 
-        if os.path.exists(json_filepath):
+        if output:
             try:
                 with open(json_filepath, 'r', encoding='utf-8') as json_file:
                     data = json.load(json_file)
@@ -953,6 +2257,9 @@ def rollup_project_data(project_name, ll_name, prompt_version):
                 rollup_data["date_data"][date_dir] = {
                     "metrics": emotional_metrics
                 }
+                for marker in ("map_reduce", "packed"):
+                    if marker in data:
+                        rollup_data["date_data"][date_dir][marker] = data[marker]
 
             except Exception as e:
                 print(f"Error processing '{json_filepath}': {e}")
@@ -976,74 +2283,55 @@ def is_valid_date(date_str):
     except ValueError:
         return False
 
-async def check_telegram_activity(
-    groupname,
-    ini_file='coins.ini',
-    ini_index='tg',
-    n=25  # For logging every nth message
-):
+def telegram_username(tg_address):
+    """Extract the group username from a coins.ini Telegram address such as 'https://t.me/username'."""
+    if 't.me/' in tg_address:
+        return tg_address.split('t.me/')[-1].strip('/')
+    return tg_address.strip('/')
+
+async def measure_telegram_activity(tg_client, username, cache=None, limiter=None, n=25):
     """
-    Check if a Telegram group is active based on the number of non-bot messages in the last 3 days.
+    Count recent non-bot messages in a Telegram group over an open client.
 
     Parameters:
-    - groupname (str): The name of the group as specified in the coins.ini file.
-    - ini_file (str): The path to the ini file (default is 'coins.ini').
-    - ini_index (str): The field in the ini file to use for the username (default is 'tg').
+    - tg_client: A connected TelegramClient instance.
+    - username (str): Telegram group username.
+    - cache (TelegramEntityCache): Entity/sender cache. Defaults to the shared cache for the session.
+    - limiter (TelegramRateLimiter): Rate limiter for the account. Defaults to the shared limiter.
     - n (int): Print metadata every nth message.
 
     Returns:
-    - bool: True if the group is active, False otherwise.
+    - dict: 'healthy' (bool), 'non_bot_messages', 'messages' and 'last_message' ('YYYY-MM-DD HH:MM' or None).
     """
+    if cache is None:
+        cache = get_entity_cache()
+    if limiter is None:
+        limiter = get_rate_limiter()
 
-    # Load the INI file and retrieve the group information
-    config = configparser.ConfigParser()
-    config.read(ini_file)
+    # Get the entity for the group
+    channel = await cache.resolve_entity(tg_client, username)
+    print(f"Successfully obtained entity for {username}")
 
-    if groupname not in config:
-        print(f"Group '{groupname}' not found in {ini_file}")
-        return False
+    # Calculate the date range: last 3 days starting from yesterday
+    today = datetime.now(timezone.utc).date()
+    start_date = today - timedelta(days=4)
+    end_date = today - timedelta(days=2)
 
-    # Fetch the 'tg' field for the group
-    tg_address = config[groupname].get(ini_index)
-    if not tg_address:
-        print(f"'{ini_index}' (Telegram address) for group '{groupname}' not found in {ini_file}")
-        return False
-
-    # Extract the username from the tg_address
-    # Assuming the tg_address is in the format 'https://t.me/username'
-    if 't.me/' in tg_address:
-        username = tg_address.split('t.me/')[-1].strip('/')
-    else:
-        username = tg_address.strip('/')
-
-    # Initialize the Telegram client within an async context manager
-    async with TelegramClient('session_name', api_id, api_hash) as tg_client:
-        print("Telegram client started.")
-
-        try:
-            # Get the entity for the group
-            channel = await tg_client.get_entity(username)
-            print(f"Successfully obtained entity for {username}")
-        except Exception as e:
-            print(f"Error getting Telegram entity for '{username}': {e}")
-            return False
+    # Set date boundaries
+    start_datetime = datetime.combine(start_date, datetime.min.time()).replace(tzinfo=timezone.utc)
+    end_datetime = datetime.combine(end_date + timedelta(days=1), datetime.min.time()).replace(tzinfo=timezone.utc)
 
-        # Calculate the date range: last 3 days starting from yesterday
-        today = datetime.now(timezone.utc).date()
-        start_date = today - timedelta(days=4)
-        end_date = today - timedelta(days=2)
+    print(f"Retrieving messages for {username} from {start_datetime} until {end_datetime}...")
 
+    while True:
         # Initialize counters
         non_bot_messages = 0
         total_messages_fetched = 0
-
-        # Set date boundaries
-        start_datetime = datetime.combine(start_date, datetime.min.time()).replace(tzinfo=timezone.utc)
-        end_datetime = datetime.combine(end_date + timedelta(days=1), datetime.min.time()).replace(tzinfo=timezone.utc)
-
-        print(f"Retrieving messages from {start_datetime} until {end_datetime}...")
+        last_message = None
 
         try:
+            await limiter.acquire('iter_messages')
+
             async for message in tg_client.iter_messages(
                 channel,
                 reverse=True,
@@ -1056,67 +2344,180 @@ async def check_telegram_activity(
                     continue  # Skip messages outside the date range
 
                 total_messages_fetched += 1
+                last_message = max(last_message, message_date) if last_message else message_date
 
                 # Check if the sender is a bot
-                sender = await message.get_sender()
-                is_bot = isinstance(sender, User) and sender.bot
+                sender_username, is_bot = await cache.resolve_sender(message)
 
                 if not is_bot:
                     non_bot_messages += 1
 
                 # Every nth message, print out some metadata
                 if total_messages_fetched % n == 0:
-                    sender_username = sender.username if sender.username else f"id_{sender.id}"
                     print(f"Pulling message #{total_messages_fetched}, date={message_date}, user={sender_username}")
 
                 # If we have fetched 100 messages, break
                 if total_messages_fetched >= 100:
                     break
 
-            # Determine if the group is active
-            is_active = non_bot_messages > 5
+            break
 
-            # Update the coins.ini file
-            config[groupname]['tg_healthy'] = str(is_active)
-            with open(ini_file, 'w') as configfile:
-                config.write(configfile)
+        except FloodWaitError as e:
+            # Wait it out without blocking other tasks, then count again from the start
+            print(f"FloodWaitError: Telegram is asking you to wait for {e.seconds} seconds.")
+            await limiter.flood_wait(e.seconds, 'iter_messages')
 
-            print(f"Group '{groupname}' is {'healthy' if is_active else 'not healthy (Safeguard?)'}.")
-            print(f"Non-bot messages are above 'healthy' threshold in a 3 day window: {non_bot_messages}")
+    cache.flush()
 
-            return is_active
+    return {
+        'healthy': non_bot_messages > 5,
+        'non_bot_messages': non_bot_messages,
+        'messages': total_messages_fetched,
+        'last_message': last_message.strftime('%Y-%m-%d %H:%M') if last_message else None
+    }
 
-        except FloodWaitError as e:
-            print(f"FloodWaitError: Telegram is asking you to wait for {e.seconds} seconds.")
-            # Handle flood wait as appropriate (e.g., wait or skip)
+def write_ini_atomic(config, ini_file):
+    """Write a ConfigParser to a temporary file and rename it over `ini_file`."""
+    tmp_file = f"{ini_file}.tmp"
+    with open(tmp_file, 'w') as configfile:
+        config.write(configfile)
+    os.replace(tmp_file, ini_file)
 
-            return False
+async def check_telegram_activity(
+    groupname,
+    ini_file='coins.ini',
+    ini_index='tg',
+    n=25,  # For logging every nth message
+    tg_client=None
+):
+    """
+    Check if a Telegram group is active based on the number of non-bot messages in the last 3 days.
+
+    Parameters:
+    - groupname (str): The name of the group as specified in the coins.ini file.
+    - ini_file (str): The path to the ini file (default is 'coins.ini').
+    - ini_index (str): The field in the ini file to use for the username (default is 'tg').
+    - n (int): Print metadata every nth message.
+    - tg_client: Optional shared TelegramClient. If None, a client is opened for this call.
+
+    Returns:
+    - bool: True if the group is active, False otherwise.
+    """
+
+    # Load the INI file and retrieve the group information
+    config = configparser.ConfigParser()
+    config.read(ini_file)
+
+    if groupname not in config:
+        print(f"Group '{groupname}' not found in {ini_file}")
+        return False
+
+    # Fetch the 'tg' field for the group
+    tg_address = config[groupname].get(ini_index)
+    if not tg_address:
+        print(f"'{ini_index}' (Telegram address) for group '{groupname}' not found in {ini_file}")
+        return False
+
+    username = telegram_username(tg_address)
 
+    async with telegram_session(tg_client) as tg_client:
+        try:
+            stats = await measure_telegram_activity(tg_client, username, n=n)
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+            print(f"Error checking Telegram activity for '{username}': {e}")
             return False
 
-async def check_telegram_activity_loop():
-    # Loop through all coins.ini entries and check health status. Assign True, False or skip. 
-    # Load the INI file
+    # Update the coins.ini file
+    config[groupname]['tg_healthy'] = str(stats['healthy'])
+    write_ini_atomic(config, ini_file)
+
+    print(f"Group '{groupname}' is {'healthy' if stats['healthy'] else 'not healthy (Safeguard?)'}.")
+    print(f"Non-bot messages are above 'healthy' threshold in a 3 day window: {stats['non_bot_messages']}")
+
+    return stats['healthy']
+
+async def check_telegram_activity_sweep(
+    ini_file='coins.ini',
+    ini_index='tg',
+    max_concurrency=None,
+    recheck=False,
+    n=25
+):
+    """
+    Check the Telegram activity of every coins.ini section concurrently over one TelegramClient,
+    then write all 'tg_healthy' flags to the INI file in a single atomic write.
+
+    Parameters:
+    - ini_file (str): The path to the ini file (default is 'coins.ini').
+    - ini_index (str): The field in the ini file to use for the username (default is 'tg').
+    - max_concurrency (int): Maximum number of groups checked at once
+      (defaults to TELEGRAM_MAX_CONCURRENCY, or 4).
+    - recheck (bool): Also check sections that already have 'tg_healthy' assigned.
+    - n (int): Print metadata every nth message.
+
+    Returns:
+    - dict: Per-group stats keyed by section name, as returned by measure_telegram_activity(),
+      or {'error': ...} for groups that could not be checked.
+    """
+    if max_concurrency is None:
+        max_concurrency = tg_max_concurrency
+
     config = configparser.ConfigParser()
-    config.read('coins.ini')
+    config.read(ini_file)
 
-    # Iterate over each section (group) in the INI file
+    # Pick the sections with a Telegram address and, unless rechecking, no health status yet
+    groups = []
     for groupname in config.sections():
-        group = config[groupname]
-        tg_health = group.get('tg_healthy')
-        tg = group.get('tg')
-
-        # Check if 'tg_healthy' is unassigned and 'tg' is not blank
-        if (tg_health is None or tg_health.strip() == '') and tg and tg.strip() != '':
-            print(f"\nChecking Telegram activity for group '{groupname}'...")
-            # Call check_telegram_activity() and await its completion
-            await check_telegram_activity(groupname)
-            print("Pausing...")
-            time.sleep(5)
+        tg_health = config[groupname].get('tg_healthy')
+        tg = config[groupname].get(ini_index)
+        if not tg or tg.strip() == '':
+            continue
+        if recheck or tg_health is None or tg_health.strip() == '':
+            groups.append(groupname)
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = {}
+    run_started = time.monotonic()
+
+    async def check_group(tg_client, groupname):
+        async with semaphore:
+            username = telegram_username(config[groupname][ini_index])
+            try:
+                results[groupname] = await measure_telegram_activity(tg_client, username, n=n)
+            except Exception as e:
+                print(f"[{groupname}] Error checking Telegram activity for '{username}': {e}")
+                results[groupname] = {'error': str(e)}
+            print(f"[{groupname}] Checked ({len(results)}/{len(groups)} groups finished).")
+
+    async with telegram_session() as tg_client:
+        print(f"Checking {len(groups)} groups with up to {max_concurrency} at a time.")
+        await asyncio.gather(*(check_group(tg_client, groupname) for groupname in groups))
+
+    # Record every result in one write
+    for groupname, stats in results.items():
+        if 'healthy' in stats:
+            config[groupname]['tg_healthy'] = str(stats['healthy'])
+    write_ini_atomic(config, ini_file)
+
+    print("\n--- Telegram activity summary ---")
+    for groupname in groups:
+        stats = results.get(groupname, {})
+        if 'error' in stats:
+            print(f"{groupname}: error={stats['error']}")
         else:
-            print(f"\nSkipping group '{groupname}': 'tg_healthy' is assigned or 'tg' is blank.")
+            print(f"{groupname}: healthy={stats.get('healthy')}, non_bot_messages={stats.get('non_bot_messages')}, "
+                  f"messages={stats.get('messages')}, last_message={stats.get('last_message')}")
+
+    healthy = sum(1 for stats in results.values() if stats.get('healthy'))
+    errors = sum(1 for stats in results.values() if 'error' in stats)
+    print(f"Groups: {healthy} healthy, {len(results) - healthy - errors} not healthy, {errors} failed. "
+          f"wall-clock: {round(time.monotonic() - run_started, 1)}s")
+
+    return results
+
+async def check_telegram_activity_loop():
+    # Check all coins.ini entries without a health status and assign True or False.
+    return await check_telegram_activity_sweep()
 
 def analyze_coins_ini(ini_file='coins.ini'):
     """
@@ -1172,6 +2573,7 @@ if __name__ == '__main__':
     
     # asyncio.run(check_telegram_activity(group_name))    
     # asyncio.run(check_telegram_activity_loop())
+    # asyncio.run(check_telegram_activity_sweep(recheck=True))
     # analyze_coins_ini()
     # max_filtered_filesize = 1024 * 1024  # 150 KB
 
@@ -1191,6 +2593,13 @@ if __name__ == '__main__':
     # dir_list_batch6 = ['cafe','hund','pundu','4trump','michi','orc','lfgo']
     # dir_list_batch7 = ['lol-3','remilia','venko','cheese-2','mellow-man','dogwifcoin']
 
+    # Scrape a whole list concurrently over one Telegram client
+    # asyncio.run(scrape_groups(dir_list3, date_start, date_end))
+    # ...or over every account in telegram_accounts.ini
+    # asyncio.run(scrape_groups_multi_account(dir_list3, date_start, date_end))
+    # Daily refresh: only messages newer than each group's last synced id
+    # asyncio.run(scrape_groups(dir_list3, date_start, None, fetcher=sync_telegram_messages_json))
+
     for group_name in dir_list3:
 
         # Run the fetching function within the event loop
@@ -1220,6 +2629,22 @@ if __name__ == '__main__':
 
     # batch process
     #process_chat_logs('brainrot', date_min='2024-1-1', date_max='2024-11-1', model=openai_version)
+    # ...or many projects and days at once
+    #run_chat_log_pipeline(dir_list3, date_min='2024-1-1', date_max='2024-11-1', model=openai_version)
+    # ...scoring all of every busy day instead of its first chunk
+    #run_chat_log_pipeline(dir_list3, date_min='2024-1-1', date_max='2024-11-1', model=openai_version, map_reduce=True)
+    # ...packing the quiet days of long-tail groups several to a request
+    #run_chat_log_pipeline(dir_list2, date_min='2024-1-1', date_max='2024-11-1', model=openai_version, pack=True)
+    # ...or as a cheaper Batch API job for historical backfills (LocalBatchBackend() runs it offline)
+    #process_chat_logs_batch(dir_list3, date_min='2024-1-1', date_max='2024-11-1', model=openai_version)
+    # Tokens, latency and cost of the LLM requests so far (also: python llm_ledger.py)
+    #print_ledger_summary()
+    # Load-test the pipeline offline: OPENAI_STANDIN=synthetic (or replay of an OPENAI_STANDIN=record run)
+    #benchmark_chat_log_pipeline(dir_list3, date_min='2024-1-1', date_max='2024-11-1', max_concurrency=16)
+    # Analyse again the days whose requests failed for good
+    #retry_failed_chat_logs()
+    # Compare the compact payload's token count with the old JSON payload
+    #measure_payload_savings('brainrot', date_min='2024-1-1', date_max='2024-11-1')
 
     ############################
     # Roll it up n smoke it
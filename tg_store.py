@@ -0,0 +1,1052 @@
+import os
+import sys
+import json
+import hashlib
+import random
+import shutil
+import tempfile
+import time
+import zlib
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from llm_payload import CHUNK_TOKEN_BUDGET, TokenChunker, discussion_tokens
+
+try:
+    import zstandard
+except ImportError:  # Fall back to zlib when zstandard is not installed
+    zstandard = None
+
+
+ARCHIVE_EXTENSION = '.tglog'
+ARCHIVE_MAGIC = b'TGLOG2'
+LEGACY_ARCHIVE_MAGIC = b'TGLOG1'  # Record-by-record layout, still readable
+CODEC_ZSTD = 1
+CODEC_ZLIB = 2
+DAY_MINUTES = [f"{hour:02d}:{minute:02d}" for hour in range(24) for minute in range(60)]
+
+
+def write_json_atomic(path, data, indent=4):
+    """
+    Write data as JSON to a temporary file and rename it over `path`, so readers never see a partial file.
+
+    Parameters:
+    - path (str): Destination file path.
+    - data: JSON-serializable data.
+    - indent (int): Indentation passed to json.dump.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=indent, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def sync_state_path(group):
+    """Return the path of the group's sync state file, tg/<group>/<group>_sync.json."""
+    return os.path.join('tg', group, f"{group}_sync.json")
+
+
+def load_sync_state(group):
+    """
+    Load the incremental sync state of a group.
+
+    Returns:
+    - dict: {'last_id': int, 'last_date': 'YYYY-MM-DD HH:MM', 'updated': str}, or None if the group was never synced.
+    """
+    path = sync_state_path(group)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error reading sync state '{path}': {e}")
+        return None
+
+
+def save_sync_state(group, last_id, last_date):
+    """
+    Record the newest message persisted for a group.
+
+    Parameters:
+    - group (str): Name of the group.
+    - last_id (int): Telegram id of the newest message written to disk.
+    - last_date (str): Timestamp of that message, 'YYYY-MM-DD HH:MM' in UTC.
+    """
+    os.makedirs(os.path.join('tg', group), exist_ok=True)
+    write_json_atomic(sync_state_path(group), {
+        'last_id': last_id,
+        'last_date': last_date,
+        'updated': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    })
+
+
+class JsonLinesWriter:
+    """
+    Append-only JSON lines file that is written to '<path>.part' in batches and renamed into place on commit.
+
+    Nothing is created on disk until the first batch is flushed. A crash loses at most the unflushed batch,
+    and readers never see a half-written day because the final name only appears on commit. A .part file
+    left by an interrupted run is continued rather than replaced: its complete lines are kept, counted in
+    `count`, and the last of them is available as `last_record` so the caller can resume after it.
+
+    Parameters:
+    - path (str): Final path of the .jsonl file.
+    - batch_size (int): Number of records buffered before they are written and fsynced.
+    - append (bool): Continue an existing file at `path` instead of replacing it.
+    """
+
+    def __init__(self, path, batch_size=200, append=False):
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.batch_size = batch_size
+        self.append = append
+        self.count = 0
+        self.last_record = None
+        self._batch = []
+        self._file = None
+        if os.path.exists(self.part_path):
+            self._recover()
+
+    def _recover(self):
+        # Keep the complete records of the interrupted run's .part file, cutting off a torn last line
+        size = 0
+        with open(self.part_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line) if line.endswith(b'\n') else None
+                except ValueError:
+                    record = None
+                if record is None:
+                    break
+                size += len(line)
+                self.count += 1
+                self.last_record = record
+        with open(self.part_path, 'r+b') as f:
+            f.truncate(size)
+        self._file = open(self.part_path, 'a', encoding='utf-8')
+
+    def write(self, record):
+        """Buffer one record, flushing when the batch is full."""
+        self._batch.append(json.dumps(record, ensure_ascii=False))
+        self.count += 1
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records to the .part file and fsync it."""
+        if not self._batch:
+            return
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if self.append and os.path.exists(self.path):
+                shutil.copyfile(self.path, self.part_path)
+                self._file = open(self.part_path, 'a', encoding='utf-8')
+            else:
+                self._file = open(self.part_path, 'w', encoding='utf-8')
+        self._file.write('\n'.join(self._batch) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._batch = []
+
+    def close(self):
+        """
+        Flush what is left and close the .part file without renaming it.
+
+        Returns:
+        - str: Path of the .part file, or None if nothing was ever written.
+        """
+        self.flush()
+        if self._file is None:
+            return None
+        self._file.close()
+        self._file = None
+        return self.part_path
+
+    def commit(self):
+        """Flush what is left and atomically rename the .part file to its final name."""
+        if self.close() is not None:
+            os.replace(self.part_path, self.path)
+
+    def discard(self):
+        """Drop everything written so far."""
+        self._batch = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.part_path)
+
+
+def _encode_varint(value):
+    """Encode a non-negative integer as a LEB128 varint."""
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _decode_varint(buf, pos):
+    """Decode a LEB128 varint from buf at pos. Returns (value, new_pos)."""
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value):
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+
+def _pack_column(typecode, values):
+    """Pack integers as a little-endian array of the given array typecode."""
+    column = array(typecode, values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tobytes()
+
+
+def _unpack_column(typecode, data):
+    """Unpack a column written by _pack_column."""
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+def _timestamps(date_str, minutes):
+    """Return the 'YYYY-MM-DD HH:MM' timestamps of minute offsets from a day's midnight."""
+    if min(minutes) >= 0 and max(minutes) < 24 * 60:
+        # Format each minute of the day once rather than every message's timestamp
+        labels = [f"{date_str} {clock}" for clock in DAY_MINUTES]
+        return list(map(labels.__getitem__, minutes))
+    day_start = datetime.strptime(date_str, '%Y-%m-%d')
+    return [(day_start + timedelta(minutes=m)).strftime('%Y-%m-%d %H:%M') for m in minutes]
+
+
+def _pack_frame(codec, sections):
+    """Join length-prefixed sections and compress them with the archive codec."""
+    payload = b''.join(_encode_varint(len(section)) + section for section in sections)
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=10).compress(payload)
+    return zlib.compress(payload, 9)
+
+
+def _unpack_frame(codec, data):
+    """Decompress a frame written by _pack_frame and split it back into its sections."""
+    if codec == CODEC_ZSTD:
+        buf = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    else:
+        buf = zlib.decompress(data)
+    sections = []
+    pos = 0
+    while pos < len(buf):
+        length, pos = _decode_varint(buf, pos)
+        sections.append(buf[pos:pos + length])
+        pos += length
+    return sections
+
+
+def _record_sections(records, date_str, users):
+    # The columns of a run of records: id deltas, minute offsets, username indexes, text lengths and texts
+    day_start = datetime.strptime(date_str, '%Y-%m-%d')
+    day_prefix = f"{date_str} "
+    id_deltas = []
+    minutes = []
+    user_indexes = []
+    texts = []
+    previous_id = 0
+
+    for record in records:
+        message_id = record.get('id') or 0
+        date = record['date']
+        if date.startswith(day_prefix) and len(date) == 16:
+            minutes.append(int(date[11:13]) * 60 + int(date[14:16]))
+        else:
+            minutes.append(int((datetime.strptime(date, '%Y-%m-%d %H:%M') - day_start).total_seconds() // 60))
+        user = record['user'] or ''
+        if user not in users:
+            users[user] = len(users)
+        id_deltas.append(message_id - previous_id)
+        user_indexes.append(users[user])
+        texts.append(record['message'] or '')
+        previous_id = message_id
+
+    # Texts are NUL-separated so readers can split them in one call; the rare day with a NUL in a
+    # message stores the text lengths instead
+    if any('\x00' in text for text in texts):
+        lengths, separator = _pack_column('I', [len(text) for text in texts]), ''
+    else:
+        lengths, separator = b'', '\x00'
+    return [
+        _pack_column('q', id_deltas),
+        _pack_column('i', minutes),
+        _pack_column('I', user_indexes),
+        lengths,
+        separator.join(texts).encode('utf-8')
+    ]
+
+
+def _section_records(sections, date_str, users, with_ids):
+    # Build the records of a run of records back from the columns written by _record_sections
+    minutes = _unpack_column('i', sections[1])
+    if not minutes:
+        return []
+    dates = _timestamps(date_str, minutes)
+    names = list(map(users.__getitem__, _unpack_column('I', sections[2])))
+    text = bytes(sections[4]).decode('utf-8')
+    if sections[3]:
+        offsets = list(accumulate(_unpack_column('I', sections[3]), initial=0))
+        messages = [text[start:end] for start, end in zip(offsets, offsets[1:])]
+    else:
+        messages = text.split('\x00')
+    if with_ids:
+        ids = accumulate(_unpack_column('q', sections[0]))
+        return [{"id": i, "date": d, "user": u, "message": m} for i, d, u, m in zip(ids, dates, names, messages)]
+    return [{"date": d, "user": u, "message": m} for d, u, m in zip(dates, names, messages)]
+
+
+def write_day_archive(path, date_str, records):
+    """
+    Write one day of messages to a compact compressed archive.
+
+    Layout: the magic bytes and a codec byte, then two separately zstd- or zlib-compressed frames, the
+    first preceded by its length. The first frame holds the filtered records, so reading them never
+    decompresses the rest of the day; the second holds the other raw records. Within a frame the records
+    are stored column by column, each decoded with one C-level call: message id deltas, minute offsets
+    from the day's midnight, indexes into the username table, and all texts as one NUL-separated UTF-8
+    string (or, if a text contains a NUL, the length of each text and the texts run together). The first frame also holds the date, the username table, the positions of
+    the filtered records among the raw records (so filtered messages are never stored twice) and the
+    repeat counts of filtered messages that near-duplicates were collapsed into.
+
+    Parameters:
+    - path (str): Destination .tglog path. Written to '<path>.part' and renamed into place.
+    - date_str (str): The day, 'YYYY-MM-DD'. Timestamps are stored as minutes from its midnight.
+    - records (iterable): (record, is_filtered) pairs, where record is an {'id', 'date', 'user', 'message'} dict
+      with an optional 'repeats' count.
+
+    Returns:
+    - tuple: (number of raw records, number of filtered records)
+    """
+    filtered = []
+    others = []
+    positions = []
+    repeats = []
+    for index, (record, is_filtered) in enumerate(records):
+        if is_filtered:
+            if record.get('repeats'):
+                repeats += (len(filtered), record['repeats'])
+            positions.append(index)
+            filtered.append(record)
+        else:
+            others.append(record)
+
+    users = {}
+    filtered_sections = _record_sections(filtered, date_str, users)
+    other_sections = _record_sections(others, date_str, users)
+    codec = CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+    first = _pack_frame(codec, [
+        date_str.encode('ascii'),
+        '\x00'.join(users).encode('utf-8'),  # Usernames never contain NUL
+        _pack_column('I', positions),
+        _pack_column('I', repeats)
+    ] + filtered_sections)
+    second = _pack_frame(codec, other_sections)
+
+    part_path = f"{path}.part"
+    with open(part_path, 'wb') as f:
+        f.write(ARCHIVE_MAGIC + bytes([codec]) + _encode_varint(len(first)) + first + second)
+    os.replace(part_path, path)
+    return len(filtered) + len(others), len(filtered)
+
+
+def _open_day_archive(path):
+    # Returns (magic, codec, compressed payload)
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic = data[:len(ARCHIVE_MAGIC)]
+    if magic not in (ARCHIVE_MAGIC, LEGACY_ARCHIVE_MAGIC):
+        raise ValueError(f"'{path}' is not a chat log archive.")
+
+    codec = data[len(ARCHIVE_MAGIC)]
+    if codec == CODEC_ZSTD and zstandard is None:
+        raise ImportError(f"'{path}' is zstd-compressed; install zstandard to read it.")
+    return magic, codec, data[len(ARCHIVE_MAGIC) + 1:]
+
+
+def _read_legacy_day_archive(codec, payload):
+    # Archives written before the framed layout: one compressed stream of varint-encoded records
+    if codec == CODEC_ZSTD:
+        buf = zstandard.ZstdDecompressor().decompressobj().decompress(payload)
+    else:
+        buf = zlib.decompress(payload)
+
+    length, pos = _decode_varint(buf, 0)
+    day_start = datetime.strptime(buf[pos:pos + length].decode('ascii'), '%Y-%m-%d')
+    pos += length
+
+    users = []
+    records = []
+    previous_id = 0
+
+    while buf[pos] == 1:
+        pos += 1
+        delta, pos = _decode_varint(buf, pos)
+        minutes, pos = _decode_varint(buf, pos)
+        user_index, pos = _decode_varint(buf, pos)
+        if user_index == len(users):
+            length, pos = _decode_varint(buf, pos)
+            users.append(buf[pos:pos + length].decode('utf-8'))
+            pos += length
+        length, pos = _decode_varint(buf, pos)
+        message = buf[pos:pos + length].decode('utf-8')
+        pos += length
+
+        previous_id += _unzigzag(delta)
+        timestamp = day_start + timedelta(minutes=_unzigzag(minutes))
+        records.append({
+            "id": previous_id,
+            "date": timestamp.strftime('%Y-%m-%d %H:%M'),
+            "user": users[user_index],
+            "message": message
+        })
+
+    pos += 1  # End marker
+    n_raw, pos = _decode_varint(buf, pos)
+    bitmap_length, pos = _decode_varint(buf, pos)
+    bitmap = buf[pos:pos + bitmap_length]
+    pos += bitmap_length
+
+    # Repeat counts (absent in archives written before near-duplicate collapsing)
+    if pos < len(buf):
+        n_repeats, pos = _decode_varint(buf, pos)
+        for _ in range(n_repeats):
+            index, pos = _decode_varint(buf, pos)
+            records[index]['repeats'], pos = _decode_varint(buf, pos)
+
+    return [(record, bool(bitmap[i // 8] & (1 << (i % 8)))) for i, record in enumerate(records)]
+
+
+def _read_day_frames(codec, payload, which, with_ids=True):
+    # Returns (filtered records, their positions among the raw records, the other raw records or None)
+    length, pos = _decode_varint(payload, 0)
+    sections = _unpack_frame(codec, payload[pos:pos + length])
+    date_str = bytes(sections[0]).decode('ascii')
+    users = bytes(sections[1]).decode('utf-8').split('\x00')
+    positions = _unpack_column('I', sections[2])
+    filtered = _section_records(sections[4:], date_str, users, with_ids)
+    if which != 'raw':
+        repeats = _unpack_column('I', sections[3])
+        for index, count in zip(repeats[::2], repeats[1::2]):
+            filtered[index]['repeats'] = count
+
+    others = None
+    if which != 'filtered':
+        others = _section_records(_unpack_frame(codec, payload[pos + length:]), date_str, users, with_ids)
+    return filtered, positions, others
+
+
+def _merge_raw(filtered, positions, others, mark=False):
+    # Put the filtered and other records back in raw order, as (record, is_filtered) pairs if `mark`
+    merged = [None] * (len(filtered) + len(others))
+    for position, record in zip(positions, filtered):
+        merged[position] = (record, True) if mark else record
+    rest = iter(others)
+    for i, record in enumerate(merged):
+        if record is None:
+            merged[i] = (next(rest), False) if mark else next(rest)
+    return merged
+
+
+def read_day_archive(path):
+    """
+    Read a day archive written by write_day_archive.
+
+    Returns:
+    - list: (record, is_filtered) pairs, with records as {'id', 'date', 'user', 'message'} dicts, plus
+      'repeats' for messages that near-duplicates were collapsed into.
+    """
+    magic, codec, payload = _open_day_archive(path)
+    if magic == LEGACY_ARCHIVE_MAGIC:
+        return _read_legacy_day_archive(codec, payload)
+    filtered, positions, others = _read_day_frames(codec, payload, 'all')
+    return _merge_raw(filtered, positions, others, mark=True)
+
+
+def read_day_discussions(path, which='filtered'):
+    """
+    Read the filtered or raw messages of a day archive as {'date', 'user', 'message'} dicts.
+
+    Filtered messages keep their 'repeats' count. Reading the filtered messages only decompresses and
+    decodes the archive's filtered frame.
+
+    Parameters:
+    - path (str): The .tglog archive.
+    - which (str): 'filtered' or 'raw'.
+    """
+    magic, codec, payload = _open_day_archive(path)
+    if magic == LEGACY_ARCHIVE_MAGIC:
+        discussions = []
+        for record, is_filtered in _read_legacy_day_archive(codec, payload):
+            if which == 'raw' or is_filtered:
+                discussion = {"date": record['date'], "user": record['user'], "message": record['message']}
+                if record.get('repeats') and which != 'raw':
+                    discussion['repeats'] = record['repeats']
+                discussions.append(discussion)
+        return discussions
+
+    filtered, positions, others = _read_day_frames(codec, payload, which, with_ids=False)
+    if which == 'raw':
+        return _merge_raw(filtered, positions, others)
+    return filtered
+
+
+def day_archive_path(group, date_str):
+    """Return the archive path of a group day, tg/<group>/<date>/<group>_<date>.tglog."""
+    return os.path.join('tg', group, date_str, f"{group}_{date_str}{ARCHIVE_EXTENSION}")
+
+
+def to_discussion_record(entry):
+    """Convert a fetcher message entry to the stored {'id', 'date', 'user', 'message'} record (plus its 'tokens' if counted)."""
+    record = {
+        "id": entry.get('id'),
+        "date": entry['timestamp'],
+        "user": entry['sender_username'],
+        "message": entry['text']
+    }
+    if entry.get('tokens') is not None:
+        record['tokens'] = entry['tokens']
+    return record
+
+
+class TelegramDayLog:
+    """
+    Streaming writer for one group day under tg/<group>/<YYYY-MM-DD>/.
+
+    With storage='archive' (the default) messages are streamed to a JSON lines write-ahead file while
+    the day is open, and compacted into a single <group>_<date>.tglog archive on commit. With
+    storage='jsonl' they are kept as <group>_raw_<date>.jsonl and <group>_filtered_<date>.jsonl, which
+    have no place for the repeat counts of collapsed near-duplicates. Either way memory use is bounded by
+    the batch size, not by the day's volume. A day whose write-ahead or .part files were left behind by
+    an interrupted run is continued from them: resume_id is the last message id they hold, and messages
+    up to it are not written again.
+
+    Parameters:
+    - group (str): Name of the group.
+    - day (datetime): The day the messages belong to.
+    - append (bool): Add to the day's existing files instead of replacing them.
+    - batch_size (int): Records buffered per file before flushing.
+    - storage (str): 'archive' or 'jsonl'.
+    - count_tokens (callable): Token counter of the analysis model. If given, archived days are cut into
+      chunks of at most chunk_tokens tokens and the chunking is recorded in the manifest.
+    - token_model (str): Name of the model count_tokens belongs to, or 'approx' if it only estimates.
+    - chunk_tokens (int): Token budget of one analysis chunk.
+    """
+
+    def __init__(self, group, day, append=False, batch_size=200, storage='archive',
+                 count_tokens=None, token_model=None, chunk_tokens=CHUNK_TOKEN_BUDGET):
+        self.group = group
+        self.date_str = day.strftime('%Y-%m-%d')
+        self.append = append
+        self.storage = storage
+        self.n_raw = 0
+        self.n_filtered = 0
+        self.last_entry = None
+        self.repeats = Counter()  # id of a filtered message -> near-duplicates collapsed into it
+        self.dedupe = None  # Near-duplicate stats for the day, set by the fetcher
+        self.count_tokens = count_tokens
+        self.token_model = token_model
+        self.chunker = TokenChunker(chunk_tokens) if count_tokens else None
+
+        group_dir = os.path.join('tg', group, self.date_str)
+        if storage == 'archive':
+            self.archive_path = day_archive_path(group, self.date_str)
+            self.wal = JsonLinesWriter(f"{self.archive_path}.jsonl", batch_size)
+            last_records = [self.wal.last_record]
+            if self.wal.count:
+                with open(self.wal.part_path, 'r', encoding='utf-8') as f:
+                    self.n_filtered = sum(json.loads(line)['filtered'] for line in f)
+                self.n_raw = self.wal.count
+        else:
+            self.raw = JsonLinesWriter(os.path.join(group_dir, f"{group}_raw_{self.date_str}.jsonl"), batch_size, append)
+            self.filtered = JsonLinesWriter(os.path.join(group_dir, f"{group}_filtered_{self.date_str}.jsonl"), batch_size, append)
+            last_records = [self.raw.last_record, self.filtered.last_record]
+            if self.raw.count:
+                # With append, the .part files also hold the day's earlier files; count only this run's messages
+                previous = load_manifest(group)['days'].get(self.date_str, {}) if append else {}
+                self.n_raw = self.raw.count - previous.get('raw', 0)
+                self.n_filtered = self.filtered.count - previous.get('filtered', 0)
+
+        # An interrupted run left the day's messages up to resume_id on disk; the fetch continues after it
+        self.resume_id = 0
+        if self.n_raw:
+            self.resume_id = min((record or {}).get('id') or 0 for record in last_records)
+            record = last_records[0]
+            self.last_entry = {'id': record['id'], 'timestamp': record['date'],
+                               'sender_username': record['user'], 'text': record['message']}
+            print(f"Resuming {group} {self.date_str} after message id {self.resume_id} "
+                  f"({self.n_raw} messages already written).")
+
+    def add(self, entry, keep, repeat_of=None):
+        """
+        Write a message to the raw log, and to the filtered log if `keep` is True.
+
+        Parameters:
+        - entry (dict): The fetcher message entry.
+        - keep (bool): Whether the message belongs in the filtered log.
+        - repeat_of (int): Id of the filtered message this one near-duplicates, counted as a repeat of it.
+        """
+        record = to_discussion_record(entry)
+        if self.storage == 'archive':
+            if not self._is_new(self.wal, record):
+                return  # Already written by the interrupted run this day log resumed
+            self.wal.write({**record, "filtered": keep})
+            self.n_filtered += int(keep)
+        else:
+            record.pop('tokens', None)
+            # The filtered .part file can lag behind the raw one by an unflushed batch
+            if keep and self._is_new(self.filtered, record):
+                self.filtered.write(record)
+                self.n_filtered += 1
+            if not self._is_new(self.raw, record):
+                return
+            self.raw.write(record)
+
+        if repeat_of is not None:
+            self.repeats[repeat_of] += 1
+        self.n_raw += 1
+        self.last_entry = entry
+
+    @staticmethod
+    def _is_new(writer, record):
+        # Whether a record comes after everything the writer recovered from an interrupted run
+        if writer.last_record is None or record['id'] is None:
+            return True
+        return record['id'] > (writer.last_record.get('id') or 0)
+
+    def _archive_records(self, wal_path):
+        # Records already archived for the day come first when appending
+        if self.append and os.path.exists(self.archive_path):
+            for record, is_filtered in read_day_archive(self.archive_path):
+                yield self._chunk(record, is_filtered)
+
+        with open(wal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if record['id'] in self.repeats:
+                        record['repeats'] = self.repeats[record['id']]
+                    yield self._chunk(record, record.pop('filtered'))
+
+    def _chunk(self, record, is_filtered):
+        # Count filtered records into the analysis chunks, recounting any whose repeats changed their text
+        tokens = record.pop('tokens', None)
+        if self.chunker is not None and is_filtered:
+            if tokens is None or record.get('repeats'):
+                tokens = discussion_tokens(record, self.count_tokens)
+            self.chunker.add(tokens)
+        return record, is_filtered
+
+    def commit(self):
+        """Finish the day, moving its files into place."""
+        tokens = None
+        if self.storage == 'archive':
+            wal_path = self.wal.close()
+            if wal_path is None:
+                return
+            n_raw, n_filtered = write_day_archive(self.archive_path, self.date_str, self._archive_records(wal_path))
+            os.remove(wal_path)
+            files = {'archive': self.archive_path}
+            if self.chunker is not None:
+                tokens = self.chunker.metadata(self.token_model)
+        else:
+            self.raw.commit()
+            self.filtered.commit()
+            tokens = None
+            n_raw, n_filtered = self.n_raw, self.n_filtered
+            if self.append:
+                previous = load_manifest(self.group)['days'].get(self.date_str, {})
+                n_raw += previous.get('raw', 0)
+                n_filtered += previous.get('filtered', 0)
+            files = {kind: writer.path for kind, writer in (('raw', self.raw), ('filtered', self.filtered)) if os.path.exists(writer.path)}
+
+        record_manifest_day(self.group, self.date_str, files, n_raw, n_filtered, dedupe=self.dedupe, tokens=tokens)
+        print(f"Telegram messages for {self.group} {self.date_str} saved: {self.n_raw} raw, {self.n_filtered} filtered.")
+
+    def discard(self):
+        """Abandon the day without touching any previously committed files."""
+        if self.storage == 'archive':
+            self.wal.discard()
+        else:
+            self.raw.discard()
+            self.filtered.discard()
+
+
+class DayMessageBuffer:
+    """In-memory stand-in for TelegramDayLog that keeps a day's messages as lists of fetcher entries."""
+
+    def __init__(self, day=None):
+        self.raw = []
+        self.filtered = []
+        self.last_entry = None
+        self.dedupe = None
+        self._filtered_by_id = {}
+
+    @property
+    def n_raw(self):
+        return len(self.raw)
+
+    @property
+    def n_filtered(self):
+        return len(self.filtered)
+
+    def add(self, entry, keep, repeat_of=None):
+        self.raw.append(entry)
+        if keep:
+            self.filtered.append(entry)
+            self._filtered_by_id[entry.get('id')] = entry
+        if repeat_of in self._filtered_by_id:
+            original = self._filtered_by_id[repeat_of]
+            original['repeats'] = original.get('repeats', 0) + 1
+        self.last_entry = entry
+
+    def commit(self):
+        pass
+
+    def discard(self):
+        pass
+
+
+def load_discussions(path, which='filtered'):
+    """
+    Read a stored chat log as the list of {'date', 'user', 'message'} dicts used by the analysis stage.
+
+    Handles .tglog day archives, streamed .jsonl day logs and the older {"discussions": [...]} .json files.
+
+    Parameters:
+    - path (str): The stored log.
+    - which (str): For archives, 'filtered' or 'raw' messages. Other formats hold one set per file.
+    """
+    if path.endswith(ARCHIVE_EXTENSION):
+        return read_day_discussions(path, which)
+
+    if path.endswith('.jsonl'):
+        discussions = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    discussions.append({"date": record['date'], "user": record['user'], "message": record['message']})
+        return discussions
+
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('discussions', [])
+
+
+def benchmark_day_archive(n_messages=20000, filtered_share=0.3, repeat=5, directory=None):
+    """
+    Time reading one synthetic day from a .tglog archive against json.load of the older filtered .json file.
+
+    Parameters:
+    - n_messages (int): Raw messages in the day.
+    - filtered_share (float): Share of them in the filtered log.
+    - repeat (int): Reads per format; the fastest one counts.
+    - directory (str): Where to write the files (a temporary directory by default).
+
+    Returns:
+    - dict: Best read times in seconds ('json_filtered', 'archive_filtered', 'archive_raw'), the archive
+      codec, the file sizes in bytes and the speedup of the filtered read.
+    """
+    rng = random.Random(0)
+    words = ['gm', 'wen', 'moon', 'pump', 'dev', 'chart', 'buy', 'sell', 'dip', 'lfg', 'ser', 'rug', 'ath', 'based']
+    day = datetime(2024, 10, 1)
+    records = []
+    for i in range(n_messages):
+        records.append(({
+            "id": 100000 + i * rng.randint(1, 3),
+            "date": (day + timedelta(seconds=i * 86400 // n_messages)).strftime('%Y-%m-%d %H:%M'),
+            "user": f"user{rng.randint(0, n_messages // 20)}",
+            "message": ' '.join(rng.choice(words) for _ in range(rng.randint(3, 30)))
+        }, rng.random() < filtered_share))
+    filtered = [{"date": r['date'], "user": r['user'], "message": r['message']} for r, keep in records if keep]
+
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        json_path = os.path.join(tmp, 'day_filtered.json')
+        write_json_atomic(json_path, {"discussions": filtered})
+        archive_path = os.path.join(tmp, f"day{ARCHIVE_EXTENSION}")
+        write_day_archive(archive_path, day.strftime('%Y-%m-%d'), records)
+
+        def best(read):
+            times = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                read()
+                times.append(time.perf_counter() - started)
+            return min(times)
+
+        result = {
+            'json_filtered': best(lambda: load_discussions(json_path)),
+            'archive_filtered': best(lambda: load_discussions(archive_path)),
+            'archive_raw': best(lambda: load_discussions(archive_path, 'raw')),
+            'codec': 'zstd' if zstandard is not None else 'zlib',
+            'bytes': {'json_filtered': os.path.getsize(json_path), 'archive': os.path.getsize(archive_path)}
+        }
+        assert load_discussions(archive_path) == filtered
+
+    result['speedup'] = round(result['json_filtered'] / result['archive_filtered'], 1)
+    print(f"Day of {n_messages} messages ({len(filtered)} filtered, {result['codec']}): "
+          f"json {result['json_filtered'] * 1000:.1f}ms, archive filtered {result['archive_filtered'] * 1000:.1f}ms "
+          f"({result['speedup']}x), archive raw {result['archive_raw'] * 1000:.1f}ms.")
+    return result
+
+
+def compact_group_logs(group, remove_originals=True):
+    """
+    Convert a group's existing raw/filtered .json and .jsonl day files into .tglog archives.
+
+    The filtered log is matched back onto the raw log in order to build the filtered bitmap. Days where
+    the filtered messages are not a subsequence of the raw messages are left untouched.
+
+    Parameters:
+    - group (str): Name of the group.
+    - remove_originals (bool): Delete the raw/filtered files once their archive is written.
+    """
+    project_dir = os.path.join('tg', group)
+    if not os.path.exists(project_dir):
+        print(f"Project directory '{project_dir}' does not exist.")
+        return
+
+    for date_str in sorted(os.listdir(project_dir)):
+        date_dir = os.path.join(project_dir, date_str)
+        if not os.path.isdir(date_dir):
+            continue
+
+        sources = {}
+        for which in ('raw', 'filtered'):
+            for extension in ('.jsonl', '.json'):
+                path = os.path.join(date_dir, f"{group}_{which}_{date_str}{extension}")
+                if os.path.exists(path):
+                    sources[which] = path
+                    break
+
+        if 'raw' not in sources or os.path.exists(day_archive_path(group, date_str)):
+            continue
+
+        raw = load_discussions(sources['raw'])
+        filtered = load_discussions(sources['filtered']) if 'filtered' in sources else []
+
+        # Walk the raw log, marking the messages that make up the filtered log
+        flags = []
+        next_filtered = 0
+        for record in raw:
+            is_filtered = next_filtered < len(filtered) and filtered[next_filtered] == record
+            flags.append(is_filtered)
+            next_filtered += int(is_filtered)
+
+        if next_filtered != len(filtered):
+            print(f"Skipping {date_str}: filtered log does not line up with the raw log.")
+            continue
+
+        archive_path = day_archive_path(group, date_str)
+        n_raw, n_filtered = write_day_archive(archive_path, date_str, zip(raw, flags))
+        record_manifest_day(group, date_str, {'archive': archive_path}, n_raw, n_filtered)
+        before = sum(os.path.getsize(path) for path in sources.values())
+        print(f"Compacted {date_str}: {before} -> {os.path.getsize(archive_path)} bytes.")
+
+        if remove_originals:
+            for path in sources.values():
+                os.remove(path)
+
+
+def manifest_path(group):
+    """Return the path of a group's manifest of scraped days."""
+    return os.path.join('tg', group, f"{group}_manifest.json")
+
+
+def output_key(llm_model, prompt_version):
+    """Return the manifest key for an LLM analysis output, matching the 'llm=..._prompt=...' filename part."""
+    return f"llm={llm_model}_prompt={prompt_version}"
+
+
+def manifest_file_entry(path):
+    """Describe a stored file for the manifest: its name, size in bytes and sha256 content hash."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return {
+        "name": os.path.basename(path),
+        "bytes": os.path.getsize(path),
+        "sha256": digest.hexdigest()
+    }
+
+
+def load_manifest(group):
+    """
+    Load a group's manifest, building it from the files on disk the first time.
+
+    The manifest holds one entry per saved day:
+
+        "days": {
+            "2024-10-01": {
+                "raw": 812, "filtered": 240,
+                "files": {"archive": {"name": ..., "bytes": ..., "sha256": ...}},
+                "outputs": {"llm=gpt-4o-mini_prompt=1.0.5": {"name": ..., "bytes": ..., "sha256": ...}}
+            }
+        }
+
+    Parameters:
+    - group (str): Name of the group.
+
+    Returns:
+    - dict: The manifest, with an empty 'days' dict if the group has no data.
+    """
+    path = manifest_path(group)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    if os.path.isdir(os.path.join('tg', group)):
+        return rebuild_manifest(group)
+
+    return {"group": group, "days": {}}
+
+
+def save_manifest(group, manifest):
+    """Write a group's manifest atomically."""
+    os.makedirs(os.path.join('tg', group), exist_ok=True)
+    manifest['updated'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    write_json_atomic(manifest_path(group), manifest)
+
+
+def record_manifest_day(group, date_str, files, n_raw, n_filtered, dedupe=None, tokens=None):
+    """
+    Record a day's message files in the group manifest, replacing what was recorded for it before.
+
+    If the files' contents changed, for example when an incremental sync appended to the day, the day's
+    recorded LLM outputs are dropped so the day is analysed again.
+
+    Parameters:
+    - group (str): Name of the group.
+    - date_str (str): The day, 'YYYY-MM-DD'.
+    - files (dict): Kind ('archive', 'raw' or 'filtered') to file path.
+    - n_raw (int): Number of raw messages stored for the day.
+    - n_filtered (int): Number of filtered messages stored for the day.
+    - dedupe (dict): Near-duplicate stats of the last fetch ('duplicates', 'bytes_saved', 'tokens_saved').
+    - tokens (dict): Token counts and analysis chunks of the filtered messages, from TokenChunker.metadata().
+    """
+    manifest = load_manifest(group)
+    day = manifest['days'].setdefault(date_str, {"outputs": {}})
+    previous = {kind: entry['sha256'] for kind, entry in day.get('files', {}).items()}
+    day['raw'] = n_raw
+    day['filtered'] = n_filtered
+    if dedupe is not None:
+        day['dedupe'] = dedupe
+    if tokens is not None:
+        day['tokens'] = tokens
+    else:
+        day.pop('tokens', None)
+    day['files'] = {kind: manifest_file_entry(path) for kind, path in files.items()}
+    if any(previous.get(kind, entry['sha256']) != entry['sha256'] for kind, entry in day['files'].items()):
+        # The analyses were made from the day's old messages, so the day has to be analysed again
+        # (converting the day to another file kind, as compact_group_logs() does, keeps them)
+        day['outputs'] = {}
+    save_manifest(group, manifest)
+
+
+def record_manifest_output(group, date_str, llm_model, prompt_version, path):
+    """Record an LLM analysis output file for a day in the group manifest."""
+    manifest = load_manifest(group)
+    day = manifest['days'].setdefault(date_str, {"raw": 0, "filtered": 0, "files": {}, "outputs": {}})
+    day['outputs'][output_key(llm_model, prompt_version)] = manifest_file_entry(path)
+    save_manifest(group, manifest)
+
+
+def manifest_input_file(group, date_str, day):
+    """
+    Return the path of the file holding a day's filtered messages, or None if the day has none.
+
+    Parameters:
+    - group (str): Name of the group.
+    - date_str (str): The day, 'YYYY-MM-DD'.
+    - day (dict): The day's manifest entry.
+    """
+    for kind in ('archive', 'filtered'):
+        if kind in day.get('files', {}):
+            return os.path.join('tg', group, date_str, day['files'][kind]['name'])
+    return None
+
+
+def rebuild_manifest(group):
+    """
+    Build a group's manifest by scanning its day directories once, and save it.
+
+    Used for trees written before the manifest existed; afterwards every writer keeps it up to date.
+
+    Parameters:
+    - group (str): Name of the group.
+
+    Returns:
+    - dict: The rebuilt manifest.
+    """
+    project_dir = os.path.join('tg', group)
+    manifest = {"group": group, "days": {}}
+
+    for date_str in sorted(os.listdir(project_dir)):
+        date_dir = os.path.join(project_dir, date_str)
+        if not os.path.isdir(date_dir):
+            continue
+        try:
+            datetime.strptime(date_str, '%Y-%m-%d')
+        except ValueError:
+            continue
+
+        day = {"raw": 0, "filtered": 0, "files": {}, "outputs": {}}
+        for name in sorted(os.listdir(date_dir)):
+            path = os.path.join(date_dir, name)
+            if name.endswith('.part') or not os.path.isfile(path):
+                continue
+
+            if name.endswith(ARCHIVE_EXTENSION):
+                records = read_day_archive(path)
+                day['files']['archive'] = manifest_file_entry(path)
+                day['raw'] = len(records)
+                day['filtered'] = sum(1 for _, is_filtered in records if is_filtered)
+            elif 'llm=' in name and 'prompt=' in name and name.endswith('.json'):
+                key = name[name.index('llm='):-len('.json')]
+                day['outputs'][key] = manifest_file_entry(path)
+            elif name.endswith(('.json', '.jsonl')):
+                for kind in ('raw', 'filtered'):
+                    if f"_{kind}_" in name and 'archive' not in day['files']:
+                        day['files'][kind] = manifest_file_entry(path)
+                        day[kind] = len(load_discussions(path))
+
+        if day['files'] or day['outputs']:
+            manifest['days'][date_str] = day
+
+    save_manifest(group, manifest)
+    print(f"Rebuilt manifest for {group}: {len(manifest['days'])} days.")
+    return manifest
+
+
+if __name__ == '__main__':
+    # python tg_store.py [messages per day]
+    benchmark_day_archive(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)